@@ -13,8 +13,11 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-import sys, warnings, string, os
+import sys, warnings, string, os, weakref, threading
+import hashlib, pickle, shutil, tempfile
+import gzip, bz2, io, zipfile, fnmatch
 import numpy
+from collections import OrderedDict
 
 try:
     import pandas
@@ -26,6 +29,18 @@ except Exception as e:
     print('pandas installation is improperly configured. It raised the following error {0}'.format(e))
     pandas_found = False
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    import lzma
+except ImportError: # python 2
+    lzma = None
+
+_native_code = '<' if (sys.byteorder == 'little') else '>'
+
 def raise_parser_feature_not_implemented(message):
     print(""" Some of the parser features have not yet been implemented.
               If you would like to see this feature implemented, please send a sample FCS file
@@ -34,6 +49,840 @@ def raise_parser_feature_not_implemented(message):
               {0} """.format(message))
     raise NotImplementedError(message)
 
+def _read_header(file_handle, offset=0):
+    """
+    Reads the HEADER segment of the data set that starts at the given offset.
+    The segment locations are returned as found in the file (relative to the offset).
+    """
+    file_handle.seek(offset, 0)
+
+    header = {}
+    header['FCS format'] = file_handle.read(6)
+
+    file_handle.read(4) # 4 space characters after the FCS format
+
+    for field in ['text start', 'text end', 'data start', 'data end', 'analysis start', 'analysis end']:
+        s = file_handle.read(8)
+        try:
+            ival = int(s)
+        except ValueError as e:
+            ival = 0
+        header[field] = ival
+    return header
+
+def _decode_text(raw_text):
+    """ Decodes the raw TEXT segment into a string (on python 2, raw_text is already a str). """
+    if isinstance(raw_text, str):
+        return raw_text
+    try:
+        return raw_text.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw_text.decode('latin-1')
+
+def _parse_text(raw_text):
+    """
+    Parses the raw TEXT segment into a dictionary of keyword : value (both strings).
+
+    The whole segment is decoded at once and split on the delimiter.
+    Delimiters that appear within keywords or values are escaped by doubling them;
+    when present, they are swapped for a placeholder character before splitting.
+    """
+    raw_text = _decode_text(raw_text)
+    delimiter = raw_text[0]
+
+    if raw_text[-1] != delimiter:
+        raw_text = raw_text.strip()
+        if raw_text[-1] != delimiter:
+            print('The first two characters were: ')
+            print(repr(raw_text[:2]))
+            print('The last two characters were: ')
+            print(repr(raw_text[-2:]))
+            raise_parser_feature_not_implemented('Parser expects the same delimiter character in beginning and end of TEXT segment')
+
+    raw_text = raw_text[1:-1] # Remove first and last characters which should be reserved for delimiter
+    escaped = delimiter * 2
+
+    if escaped not in raw_text:
+        raw_text_segments = raw_text.split(delimiter)
+    else:
+        placeholder = next(c for c in '\x00\x01\x02\x03\x04\x05\x06\x07' if c not in raw_text)
+        raw_text_segments = raw_text.replace(escaped, placeholder).split(delimiter)
+        raw_text_segments = [segment.replace(placeholder, delimiter) for segment in raw_text_segments]
+
+    keys, values = raw_text_segments[0::2], raw_text_segments[1::2]
+    return dict(zip(keys, values)) # Build dictionary
+
+class TextSegment(dict):
+    """
+    Dictionary holding the keywords of a TEXT segment.
+
+    Numeric keywords registered with set_converter are kept as strings
+    and converted the first time they are accessed, so that TEXT segments
+    with thousands of keywords do not have to be converted up front.
+    Iterating over the values (items, values, copying or pickling) converts all of them.
+
+    On python 2, dict(segment) and dict.update(segment) read the stored values directly,
+    without converting them; use dict(segment.items()) or segment.copy() instead.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._converters = {}
+
+    def set_converter(self, keys, converter):
+        """ Registers a function (e.g., int) converting the values of the given keywords on access. """
+        for key in keys:
+            if dict.__contains__(self, key):
+                self._converters[key] = converter
+
+    def _convert(self, key):
+        converter = self._converters.pop(key, None)
+        if converter is not None:
+            dict.__setitem__(self, key, converter(dict.__getitem__(self, key)))
+
+    def _convert_all(self):
+        for key in list(self._converters):
+            self._convert(key)
+
+    def __getitem__(self, key):
+        if key in self._converters:
+            self._convert(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self._converters:
+            self._convert(key)
+        return dict.get(self, key, default)
+
+    def pop(self, key, *args):
+        if key in self._converters:
+            self._convert(key)
+        return dict.pop(self, key, *args)
+
+    def setdefault(self, key, default=None):
+        if key in self._converters:
+            self._convert(key)
+        return dict.setdefault(self, key, default)
+
+    def __setitem__(self, key, value):
+        self._converters.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._converters.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def __iter__(self):
+        # Defined so that, on python 3, dict(...) and dict.update(...) go through __getitem__
+        return dict.__iter__(self)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        for key in other:
+            self._converters.pop(key, None)
+        dict.update(self, other)
+
+    def __eq__(self, other):
+        self._convert_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def items(self):
+        self._convert_all()
+        return dict.items(self)
+
+    def values(self):
+        self._convert_all()
+        return dict.values(self)
+
+    if hasattr(dict, 'iteritems'): # python 2
+        def iteritems(self):
+            self._convert_all()
+            return dict.iteritems(self)
+
+        def itervalues(self):
+            self._convert_all()
+            return dict.itervalues(self)
+
+    def popitem(self):
+        self._convert_all()
+        return dict.popitem(self)
+
+    def copy(self):
+        self._convert_all()
+        return TextSegment(self)
+
+    def __reduce__(self):
+        self._convert_all()
+        return (TextSegment, (dict(self),))
+
+# Channel tables are interned: files acquired with the same panel share one table.
+_channel_tables = weakref.WeakValueDictionary()
+
+def _intern_channel_table(fields, numbers, columns):
+    key = (fields, numbers, columns)
+    table = _channel_tables.get(key)
+    if table is None:
+        table = ChannelTable(fields, numbers, columns)
+        table = _channel_tables.setdefault(key, table)
+    return table
+
+class ChannelTable(object):
+    """
+    Compact table of the channel properties of a data set ($PnN, $PnS, $PnR, ...).
+
+    Stored in the '_channels_' key of the reformatted meta data (see FCS_Parser.reformat_meta).
+    Tables are immutable, and identical tables (e.g., those of files acquired with the
+    same panel) are shared. Channels are looked up by name ($PnN or $PnS) or by number.
+
+    Examples
+    --------
+    >>> table = meta['_channels_']
+    >>> table['$PnN']              # the $PnN values of all the channels
+    >>> table.get('FSC-A', '$PnR') # range of the FSC-A channel
+    >>> table.to_frame()           # DataFrame indexed by channel number
+    """
+    __slots__ = ('fields', 'numbers', '_columns', '_positions', '__weakref__')
+
+    def __init__(self, fields, numbers, columns):
+        self.fields = tuple(fields)
+        self.numbers = tuple(numbers)
+        self._columns = tuple(tuple(column) for column in columns)
+        positions = dict((number, i) for i, number in enumerate(self.numbers))
+        for field in ('$PnS', '$PnN'): # $PnN (unique) takes precedence over $PnS
+            if field in self.fields:
+                for i, name in enumerate(self[field]):
+                    if name is not None:
+                        positions[name] = i
+        self._positions = positions
+
+    @classmethod
+    def from_text(cls, text, numbers, properties):
+        """
+        Creates the (shared) table holding the given channel properties (e.g., 'N', 'S', 'R')
+        from the keywords of a TEXT segment.
+        """
+        columns = []
+        for p in properties:
+            column = [text.get('$P{0}{1}'.format(ch, p)) for ch in numbers]
+            if p == 'E':
+                column = [tuple(x.split(',')) if isinstance(x, string_types) else x for x in column]
+            columns.append(tuple(column))
+        return _intern_channel_table(tuple('$Pn{0}'.format(p) for p in properties), tuple(numbers), tuple(columns))
+
+    def __reduce__(self):
+        return (_intern_channel_table, (self.fields, self.numbers, self._columns))
+
+    def __repr__(self):
+        return '<ChannelTable: {0} channels, fields {1}>'.format(len(self), ', '.join(self.fields))
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __getitem__(self, field):
+        """ Returns the values of the given field (e.g., '$PnR') for all the channels. """
+        try:
+            return self._columns[self.fields.index(field)]
+        except ValueError:
+            raise KeyError(field)
+
+    def __eq__(self, other):
+        if not isinstance(other, ChannelTable):
+            return NotImplemented
+        return (self.fields, self.numbers, self._columns) == (other.fields, other.numbers, other._columns)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.fields, self.numbers, self._columns))
+
+    def position(self, channel):
+        """
+        Returns the position (starting from 0) of the channel given by name or number,
+        or None if there is no such channel.
+        """
+        return self._positions.get(channel)
+
+    def get(self, channel, field, default=None):
+        """ Returns the value of a field (e.g., '$PnR') of the channel given by name or number. """
+        i = self._positions.get(channel)
+        if i is None or field not in self.fields:
+            return default
+        return self[field][i]
+
+    def to_frame(self):
+        """ Returns a DataFrame holding the table, indexed by channel number. """
+        columns = [list(column) for column in self._columns]
+        if '$PnE' in self.fields:
+            i = self.fields.index('$PnE')
+            columns[i] = [list(x) if isinstance(x, tuple) else x for x in columns[i]]
+        df = pandas.DataFrame(dict(zip(self.fields, columns)), columns=list(self.fields),
+                              index=pandas.Index(list(self.numbers), name='Channel Number'))
+        return df
+
+def _extract_keywords(raw_text, keys):
+    """
+    Extracts the values of the given keywords from the TEXT segment
+    without splitting the whole segment.
+
+    Only matches at keyword positions (even-numbered fields) are used, so a value
+    equal to a keyword name (e.g., $P1N = $TOT) is not taken for that keyword.
+    Missing keywords are returned as None.
+    """
+    delimiter = raw_text[0]
+    escaped = delimiter * 2
+    if raw_text[-1] != delimiter:
+        raw_text = raw_text.strip()
+    text = raw_text[1:-1]
+    placeholder = None
+    if escaped in text:
+        placeholder = next(c for c in '\x00\x01\x02\x03\x04\x05\x06\x07' if c not in text)
+        text = text.replace(escaped, placeholder)
+    text = delimiter + text + delimiter
+    values = {}
+    for key in keys:
+        target = delimiter + key + delimiter
+        start = text.find(target)
+        # The delimiter preceding field k is the k-th one; keywords are the even-numbered fields
+        while start != -1 and text.count(delimiter, 0, start) % 2:
+            start = text.find(target, start + 1)
+        if start == -1:
+            values[key] = None
+            continue
+        start += len(key) + 2
+        end = text.find(delimiter, start)
+        if end == -1:
+            end = len(text)
+        value = text[start:end]
+        if placeholder is not None:
+            value = value.replace(placeholder, delimiter)
+        values[key] = value
+    return values
+
+def _scan_file_metadata(path, keys):
+    """ Reads the HEADER and TEXT segments of a single file (see scan_metadata). """
+    with _open_fcs(path, _get_compression(path)) as f:
+        header = _read_header(f)
+        if header['text start'] == 0:
+            raise ValueError("The FCS file '{0}' seems corrupted. (Parser cannot locate information "
+                             "about the 'text start' segment.)".format(path))
+        f.seek(header['text start'], 0)
+        raw_text = _decode_text(f.read(header['text end'] - header['text start'] + 1))
+
+    if keys is None:
+        return _parse_text(raw_text)
+    return _extract_keywords(raw_text, keys)
+
+def _unpack_bits(raw, num_events, bit_widths, indexes=None, first_bit=0, msb_first=True):
+    """
+    Decodes list mode integer data in which parameters are bit packed
+    (i.e., their widths, $PnB, are not restricted to 8, 16, 32 or 64 bits).
+
+    The decoding is vectorized over events: for every parameter, the bytes spanning
+    its bits are gathered for all events at once, combined into 64 bit integers,
+    then shifted and masked.
+
+    Parameters
+    ----------
+    raw : ndarray of uint8
+        The raw bytes of the DATA segment (starting at the byte that holds first_bit).
+    num_events : int
+        Number of events to decode.
+    bit_widths : list of int
+        Number of bits of each parameter ($PnB).
+    indexes : None | list of int
+        Positions of the parameters to decode (all by default).
+    first_bit : int
+        Position of the first bit of the first event within raw[0].
+    msb_first : bool
+        True if the bits are stored from the most significant bit of each byte ($BYTEORD 4,3,2,1),
+        False if from the least significant bit ($BYTEORD 1,2,3,4).
+
+    Returns
+    -------
+    ndarray (events x parameters) of the smallest unsigned integer type that holds the values.
+    """
+    if indexes is None:
+        indexes = range(len(bit_widths))
+    widths = [bit_widths[i] for i in indexes]
+
+    if max(widths) > 56:
+        raise_parser_feature_not_implemented('Bit packed parameters wider than 56 bits are not supported.')
+
+    bits_per_event = sum(bit_widths)
+    field_offsets = numpy.cumsum([0] + list(bit_widths[:-1]))
+    out_dtype = numpy.dtype('u{0}'.format(min(s for s in (1, 2, 4, 8) if 8 * s >= max(widths))))
+
+    # Pad so that the gathering of bytes never reads past the end of the buffer
+    max_span = (7 + max(widths) + 7) // 8
+    raw = numpy.concatenate([numpy.asarray(raw, dtype=numpy.uint8), numpy.zeros(max_span, dtype=numpy.uint8)])
+
+    event_bits = first_bit + numpy.arange(num_events, dtype=numpy.int64) * bits_per_event
+    data = numpy.empty((num_events, len(widths)), dtype=out_dtype)
+
+    for j, (i, width) in enumerate(zip(indexes, widths)):
+        positions = event_bits + field_offsets[i]
+        byte_index = positions >> 3
+        shift = (positions & 7).astype(numpy.uint64)
+        span = (7 + width + 7) // 8
+
+        accumulator = numpy.zeros(num_events, dtype=numpy.uint64)
+        for k in range(span):
+            byte = raw[byte_index + k].astype(numpy.uint64)
+            if msb_first:
+                accumulator = (accumulator << numpy.uint64(8)) | byte
+            else:
+                accumulator |= byte << numpy.uint64(8 * k)
+
+        if msb_first:
+            accumulator >>= numpy.uint64(8 * span - width) - shift
+        else:
+            accumulator >>= shift
+        data[:, j] = accumulator & numpy.uint64((1 << width) - 1)
+    return data
+
+class ZipMember(str):
+    """
+    Refers to an FCS file stored in a zip archive, without extracting it.
+
+    A ZipMember is a str ('archive.zip/member.fcs') so it can be used wherever a path
+    to an FCS file is expected (e.g., as the datafile of an FCMeasurement).
+    The member is read directly from the archive when it is parsed.
+
+    Examples
+    --------
+    >>> meta, data = parse_fcs(ZipMember('plate.zip', 'Well_A1.fcs'))
+    """
+    def __new__(cls, archive, member):
+        self = str.__new__(cls, os.path.join(archive, member))
+        self.archive = archive
+        self.member = member
+        return self
+
+    def __getnewargs__(self):
+        return (self.archive, self.member)
+
+def list_zip_members(path, pattern='*.fcs'):
+    """
+    Lists the files of a zip archive whose names match the pattern.
+
+    Returns
+    -------
+    A list of ZipMember (sorted by name).
+    """
+    with zipfile.ZipFile(path) as archive:
+        names = [info.filename for info in archive.infolist() if not info.filename.endswith('/')]
+    return [ZipMember(path, name) for name in sorted(names)
+            if fnmatch.fnmatch(os.path.basename(name), pattern) and not name.startswith('__MACOSX/')]
+
+class _WrappedFile(object):
+    """
+    File handle over a stream that is not a plain file on disk: a decompressing stream,
+    a member of a zip archive, bytes or a file-like object provided by the user.
+    Closing it only closes the streams that were opened for it.
+    """
+    def __init__(self, stream, owned=()):
+        self._stream = stream
+        self._owned = list(owned)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def close(self):
+        for stream in self._owned:
+            stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _ForwardStream(object):
+    """
+    Base class of read-only streams that can only be decoded from their start
+    (e.g., a bz2 stream, or a member of a zip archive on python 2).
+    Seeking forward decodes up to the new position; seeking backward starts over.
+
+    Subclasses implement _start_over and _read_block.
+    """
+    _block_size = 1 << 16
+
+    def __init__(self):
+        self._rewind()
+
+    def _start_over(self):
+        """ Restarts the decoding from the start of the stream. """
+        raise NotImplementedError
+
+    def _read_block(self):
+        """ Returns the next decoded bytes (possibly empty), or None at the end of the stream. """
+        raise NotImplementedError
+
+    def _rewind(self):
+        self._start_over()
+        self._buffer = b''
+        self._position = 0 # Position (in the decoded stream) of the start of the buffer
+        self._offset = 0 # Position of the next byte to be read, within the buffer
+
+    def _fill(self, size):
+        """ Decodes until the buffer holds size bytes past the offset (or the stream ends). """
+        blocks = []
+        available = len(self._buffer) - self._offset
+        while available < size:
+            block = self._read_block()
+            if block is None:
+                break
+            blocks.append(block)
+            available += len(block)
+        if blocks:
+            self._position += self._offset
+            self._buffer = self._buffer[self._offset:] + b''.join(blocks)
+            self._offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill(float('inf'))
+            size = len(self._buffer) - self._offset
+        else:
+            self._fill(size)
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def tell(self):
+        return self._position + self._offset
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            raise ValueError('Seeking from the end of the stream is not supported.')
+        if offset < self._position:
+            self._rewind()
+        while offset > self._position + len(self._buffer):
+            # Skip the buffered data and decode the following blocks
+            self._offset = len(self._buffer)
+            self._fill(min(offset - self.tell(), self._block_size))
+            if self._offset == len(self._buffer): # The stream ended
+                break
+        self._offset = min(offset - self._position, len(self._buffer))
+        return self.tell()
+
+    def close(self):
+        self._buffer = b''
+
+class _BZ2Stream(_ForwardStream):
+    """
+    Decompresses a bz2 stream as it is read.
+    Used instead of bz2.BZ2File, which only accepts file names on python 2.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._start = stream.tell()
+        _ForwardStream.__init__(self)
+
+    def _start_over(self):
+        self._stream.seek(self._start, 0)
+        self._decompressor = bz2.BZ2Decompressor()
+
+    def _read_block(self):
+        raw = self._stream.read(self._block_size)
+        if not raw:
+            return None
+        blocks = []
+        while raw:
+            try:
+                blocks.append(self._decompressor.decompress(raw))
+            except EOFError: # The previous stream ended; files may hold several streams (e.g., pbzip2)
+                self._decompressor = bz2.BZ2Decompressor()
+                continue
+            raw = self._decompressor.unused_data
+            if raw:
+                self._decompressor = bz2.BZ2Decompressor()
+        return b''.join(blocks)
+
+class _ZipMemberStream(_ForwardStream):
+    """ Member of a zip archive, for pythons whose zip members cannot seek (python 2). """
+    def __init__(self, archive, member):
+        self._archive = archive
+        self._member = member
+        self._stream = None
+        _ForwardStream.__init__(self)
+
+    def _start_over(self):
+        if self._stream is not None:
+            self._stream.close()
+        self._stream = self._archive.open(self._member)
+
+    def _read_block(self):
+        return self._stream.read(self._block_size) or None
+
+    def close(self):
+        _ForwardStream.close(self)
+        self._stream.close()
+
+_compression_magic = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz')]
+
+def _is_content(source):
+    """
+    Whether the source is the content of an FCS file (bytes) rather than a path.
+
+    On python 2, bytes are str, so the content is told apart from a path by its first bytes
+    (the FCS header or the signature of a compressed file); paths never hold null bytes either.
+    """
+    if isinstance(source, bytearray):
+        return True
+    if not isinstance(source, bytes) or isinstance(source, ZipMember):
+        return False
+    if bytes is not str: # python 3
+        return True
+    return ((source[:3] == b'FCS' and source[6:10] == b'    ') or
+            source[:2] == b'\x1f\x8b' or source[:6] == b'\xfd7zXZ\x00' or
+            (source[:3] == b'BZh' and source[4:10] == b'1AY&SY') or
+            b'\x00' in source)
+
+def _is_path(source):
+    """ Whether the source is the path of a file on disk (or a ZipMember). """
+    return isinstance(source, string_types) and not _is_content(source)
+
+def _open_fcs(source, compression=None):
+    """
+    Opens an FCS file for reading.
+
+    The file may be given as a path, a ZipMember, bytes (or bytearray) or a seekable binary
+    file-like object. On python 2, where bytes are str, see _is_content.
+    Compressed files (gzip, bz2 or xz) are decompressed on the fly as they are read,
+    without writing anything to disk. Reading forward (HEADER, then TEXT, then DATA)
+    decompresses the file only once.
+    """
+    owned = []
+    if isinstance(source, ZipMember):
+        archive = zipfile.ZipFile(source.archive)
+        stream = archive.open(source.member)
+        if not (hasattr(stream, 'seekable') and stream.seekable()):
+            stream.close()
+            stream = _ZipMemberStream(archive, source.member)
+        owned = [stream, archive]
+    elif _is_content(source):
+        stream = io.BytesIO(bytes(source))
+    elif isinstance(source, string_types):
+        stream = open(source, 'rb')
+        if compression is None:
+            return stream
+        owned = [stream]
+    elif hasattr(source, 'read') and hasattr(source, 'seek'):
+        stream = source
+    else:
+        raise TypeError('An FCS file must be given as a path, bytes or a seekable binary file-like object. '
+                        'Encountered {0}'.format(type(source)))
+
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif compression == 'bz2':
+        stream = _BZ2Stream(stream)
+    elif compression == 'xz':
+        if lzma is None:
+            raise ImportError('Reading xz compressed FCS files requires the lzma module (python 3.3 or later).')
+        stream = lzma.LZMAFile(stream)
+    elif compression is not None:
+        raise ValueError('Unknown compression {0}'.format(compression))
+    if compression is not None:
+        owned.insert(0, stream)
+    return _WrappedFile(stream, owned)
+
+def _get_compression(source):
+    """ Returns the compression of the file ('gzip', 'bz2' or 'xz'), detected from its first bytes, or None. """
+    with _open_fcs(source) as f:
+        f.seek(0, 0)
+        start = f.read(6)
+    for magic, compression in _compression_magic:
+        if start.startswith(magic):
+            return compression
+    return None
+
+def _get_size(source):
+    """ Size (in bytes) of the (possibly compressed) file. """
+    if isinstance(source, ZipMember):
+        with zipfile.ZipFile(source.archive) as archive:
+            return archive.getinfo(source.member).file_size
+    elif _is_content(source):
+        return len(source)
+    elif isinstance(source, string_types):
+        return os.path.getsize(source)
+    source.seek(0, 2)
+    return source.tell()
+
+def _get_source_key(source):
+    """
+    Identifies the content of a file on disk (by path, size and modification time).
+    None is returned for bytes and file-like objects, whose content cannot be identified.
+    """
+    if isinstance(source, ZipMember):
+        stat = os.stat(source.archive)
+        return (os.path.abspath(source.archive), source.member, stat.st_size, stat.st_mtime)
+    elif _is_path(source):
+        stat = os.stat(source)
+        return (os.path.abspath(source), stat.st_size, stat.st_mtime)
+    return None
+
+def _get_source_name(source):
+    """ Name of the file used in messages. """
+    if _is_content(source):
+        return '<bytes>'
+    elif isinstance(source, string_types):
+        return source
+    return getattr(source, 'name', '<file-like object>')
+
+def _is_regular_file(file_handle):
+    """ True if the file handle refers to a file on disk (so that numpy.fromfile and numpy.memmap can be used). """
+    if isinstance(file_handle, _WrappedFile):
+        return False
+    try:
+        file_handle.fileno()
+    except Exception:
+        return False
+    return True
+
+def _read_array(file_handle, dtype, count):
+    """
+    Reads count items of the given dtype from the current position of the file handle.
+
+    Files on disk are read with numpy.fromfile. Other file objects (e.g., decompressing streams)
+    are decoded directly into the output array. Fewer items are returned if the file ends early.
+    """
+    dtype = numpy.dtype(dtype)
+    if _is_regular_file(file_handle):
+        return numpy.fromfile(file_handle, dtype=dtype, count=count)
+
+    data = numpy.empty(count, dtype=dtype)
+    buffer = memoryview(data.view(numpy.uint8))
+    num_bytes, position = len(buffer), 0
+    while position < num_bytes:
+        if hasattr(file_handle, 'readinto'):
+            read = file_handle.readinto(buffer[position:])
+        else:
+            block = file_handle.read(num_bytes - position)
+            read = len(block)
+            buffer[position:position + read] = block
+        if not read:
+            break
+        position += read
+    if position < num_bytes:
+        data = data[:position // dtype.itemsize]
+    return data
+
+class _LRUCache(object):
+    """
+    A thread-safe mapping holding at most max_size entries.
+    Once it is full, the least recently used entry is dropped to make room for a new one.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value  # Most recently used entries are last
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+            self._entries[key] = value
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_dataset_index_cache = _LRUCache(1024)
+
+def index_datasets(path):
+    """
+    Walks the chain of data sets stored in an FCS file (linked through the $NEXTDATA keyword).
+
+    Only the HEADER and TEXT segments of each data set are read.
+    The index is cached (per path, size and modification time, for the 1024 most
+    recently indexed files), so data sets can later be opened individually without
+    walking the chain again.
+
+    Parameters
+    ----------
+    path : str | ZipMember | bytes | file-like object
+        The FCS file (see parse_fcs)
+
+    Returns
+    -------
+    list of dict (one per data set) holding the absolute byte locations
+    ('offset', 'text start', 'text end', 'data start', 'data end') of the data set
+    and its number of events ('$TOT') and parameters ('$PAR').
+    """
+    key = _get_source_key(path)
+    datasets = _dataset_index_cache.get(key) if key is not None else None
+    if datasets is not None:
+        return [dict(d) for d in datasets]
+
+    datasets = []
+    offset = 0
+    compression = _get_compression(path)
+    file_size = _get_size(path) if compression is None else None # Unknown until decompressed
+    name = _get_source_name(path)
+
+    with _open_fcs(path, compression) as f:
+        while True:
+            header = _read_header(f, offset)
+            if header['text start'] == 0 or (file_size is not None and offset + header['text end'] > file_size):
+                raise ValueError("The FCS file '{0}' is corrupted. Cannot locate the TEXT segment "
+                                 "of data set {1}.".format(name, len(datasets)))
+            f.seek(offset + header['text start'], 0)
+            text = _parse_text(f.read(header['text end'] - header['text start'] + 1))
+
+            data_start = header['data start'] or int(text['$BEGINDATA'])
+            data_end = header['data end'] or int(text['$ENDDATA'])
+
+            datasets.append({'offset': offset,
+                             'text start': offset + header['text start'],
+                             'text end': offset + header['text end'],
+                             'data start': offset + data_start,
+                             'data end': offset + data_end,
+                             '$TOT': int(text['$TOT']),
+                             '$PAR': int(text['$PAR'])})
+
+            nextdata = int(text.get('$NEXTDATA', 0))
+            if nextdata == 0:
+                break
+            offset += nextdata
+            if file_size is not None and offset >= file_size:
+                raise ValueError("The FCS file '{0}' is corrupted. $NEXTDATA points beyond "
+                                 "the end of the file.".format(name))
+
+    if key is not None:
+        _dataset_index_cache[key] = datasets
+    return [dict(d) for d in datasets]
+
 class FCS_Parser(object):
     """
     A Parser for .fcs files.
@@ -52,12 +901,14 @@ class FCS_Parser(object):
         self.channel_names holds the chosen names of the channels
         self.channel_names_alternate holds the alternate names of the channels
     """
-    def __init__(self, path, read_data=True, channel_naming='$PnS'):
+    def __init__(self, path, read_data=True, channel_naming='$PnS', memory_map=False, channels=None,
+                 dataset=0):
         """
         Parameters
         ----------
-        path : str
-            Path of .fcs file
+        path : str | ZipMember | bytes | file-like object
+            Path of .fcs file (see parse_fcs for the other inputs).
+            Files compressed with gzip, bz2 or xz are decompressed while being read.
         read_data : bool
             If True, reads the data immediately.
             Otherwise, use read_data method to read in the data from the fcs file.
@@ -75,54 +926,93 @@ class FCS_Parser(object):
 
             Note: These names are not flipped in the implementation.
             It looks like they were swapped for some reason in the official FCS specification.
+        memory_map : bool
+            If True, the DATA segment is not copied into memory. Instead, self.data
+            is a read-only numpy.memmap view of the file (kept in the byte order of the file,
+            and for integer data, without masking to $PnR).
+            Use get_channel_data to obtain individual channels in native byte order.
+            (Bit packed integer data, compressed files, archive members, bytes and file-like objects
+            cannot be memory mapped, and are always decoded into memory.)
+        channels : None | list of str | list of int
+            If given, only these channels are read from the DATA segment
+            (by name, using either naming convention, or by position).
+            Other channels are skipped without being copied into memory.
+        dataset : int
+            Index of the data set to read, for files that hold several data sets
+            (chained through the $NEXTDATA keyword). See index_datasets.
         """
         self._data = None
+        self._analysis = None
         self._channel_naming = channel_naming
-
-        self._file_size = os.path.getsize(path)
+        self._memory_map = memory_map
+        if isinstance(channels, string_types):
+            channels = [channels]
+        self._channels = None if channels is None else list(channels)
+
+        self._source = path
+        self._compression = _get_compression(path)
+        self._file_size = _get_size(path) if self._compression is None else None # Unknown until decompressed
+        # Only plain files on disk can be memory mapped. Compressed files, archive members,
+        # bytes and file-like objects are streamed into memory instead.
+        self._memory_mappable = (_is_path(path) and not isinstance(path, ZipMember)
+                                 and self._compression is None)
+        if not self._memory_mappable:
+            self._memory_map = False
 
         if channel_naming not in ('$PnN', '$PnS'):
             raise ValueError("channel_naming must be either '$PnN' or '$PnS")
 
         self.annotation = {}
-        self.path = path
+        self.path = _get_source_name(path)
+        self.dataset = dataset
+
+        if dataset == 0:
+            self._dataset_offset = 0
+        else:
+            datasets = index_datasets(path)
+            if not 0 <= dataset < len(datasets):
+                raise ValueError("The FCS file '{0}' holds {1} data set(s). Cannot read data set {2}.".format(
+                                 path, len(datasets), dataset))
+            self._dataset_offset = datasets[dataset]['offset']
 
-        with open(path,'rb') as f:
+        with self._open() as f:
             self.read_header(f)
             self.read_text(f)
             if read_data:
                 self.read_data(f)
 
+    def _open(self):
+        """ Opens the FCS file for reading (decompressing it on the fly if needed). """
+        return _open_fcs(self._source, self._compression)
+
+    def _is_truncated(self, position):
+        """ True if the file is known to end before the given position. """
+        return self._file_size is not None and position > self._file_size
+
+    def _read_array(self, file_handle, dtype, count):
+        """ Reads count items of dtype from the file handle, raising if the file ends early. """
+        data = _read_array(file_handle, dtype, count)
+        if len(data) < count:
+            raise ValueError("The FCS file '{}' is corrupted. Part of the data segment is missing.".format(self.path))
+        return data
+
     def read_header(self, file_handle):
         """
         Reads the header of the FCS file.
         The header specifies where the annotation, data and analysis are located inside the binary file.
+        (The locations are relative to the beginning of the data set.)
         """
-        header = {}
-        header['FCS format'] = file_handle.read(6)
-
-        file_handle.read(4) # 4 space characters after the FCS format
-
-        for field in ['text start', 'text end', 'data start', 'data end', 'analysis start', 'analysis end']:
-            s = file_handle.read(8)
-            try:
-                ival = int(s)
-            except ValueError as e:
-                ival = 0
-            header[field] = ival
+        header = _read_header(file_handle, self._dataset_offset)
 
         # Checking that the location of the TEXT segment is specified
         for k in ['text start', 'text end']:
             if header[k] == 0:
                 raise ValueError("The FCS file '{}' seems corrupted. (Parser cannot locate information " \
                 "about the '{}' segment.)".format(self.path, k))
-            elif header[k] > self._file_size:
+            elif self._is_truncated(header[k] + self._dataset_offset):
                 raise ValueError("The FCS file '{}' is corrupted. '{}' segment " \
                                  "is larger than file size".format(self.path, k))
 
-        self._data_start = header['data start']
-        self._data_end = header['data start']
-
         if header['analysis start'] != 0:
             warnings.warn('There appears to be some information in the ANALYSIS segment of file {0}. However, it might not be read correctly.'.format(self.path))
 
@@ -139,68 +1029,52 @@ class FCS_Parser(object):
         #####
         # Read in the TEXT segment of the FCS file
         # There are some differences in how the 
-        file_handle.seek(header['text start'], 0)
+        file_handle.seek(header['text start'] + self._dataset_offset, 0)
         raw_text = file_handle.read(header['text end'] - header['text start'] + 1)
 
         #####
         # Parse the TEXT segment of the FCS file into a python dictionary
-        delimiter = raw_text[0]
-
-        if raw_text[-1] != delimiter:
-            raw_text = raw_text.strip()
-            if raw_text[-1] != delimiter:
-                print('The first two characters were: ')
-                print(repr(raw_text[:2]))
-                print('The last two characters were: ')
-                print(repr(raw_text[-2:]))
-                raise_parser_feature_not_implemented('Parser expects the same delimiter character in beginning and end of TEXT segment')
-
-        raw_text_segments = raw_text[1:-1].split(delimiter) # Using 1:-1 to remove first and last characters which should be reserved for delimiter
-        keys, values = raw_text_segments[0::2], raw_text_segments[1::2]
-        text = {key : value for key, value in zip(keys, values)} # Build dictionary
+        text = TextSegment(self.annotation)
+        text.update(_parse_text(raw_text))
 
         ####
         # Extract channel names and convert some of the channel properties and other fields into numeric data types (from string)
         # Note: do not use regular expressions for manipulations here. Regular expressions are too heavy in terms of computation time.
         pars = int(text['$PAR'])
-        if '$P0B' in keys: # Checking whether channel number count starts from 0 or from 1
+        if '$P0B' in text: # Checking whether channel number count starts from 0 or from 1
             self.channel_numbers = range(0, pars) # Channel number count starts from 0
         else:
             self.channel_numbers = range(1, pars + 1) # Channel numbers start from 1
+        self._channel_keys = {}
 
         ## Extract parameter names
         try:
-            names_n = tuple([text['$P{0}N'.format(i)] for i in self.channel_numbers])
+            names_n = tuple([text[key] for key in self.get_channel_keys('N')])
         except KeyError:
             names_n = []
 
         try:
-            names_s = tuple([text['$P{0}S'.format(i)] for i in self.channel_numbers])
+            names_s = tuple([text[key] for key in self.get_channel_keys('S')])
         except KeyError:
             names_s = []
 
         self.channel_names_s = names_s
         self.channel_names_n = names_n
 
-        # Convert some of the fields into integer values
-        keys_encoding_bits  = ['$P{0}B'.format(i) for i in self.channel_numbers]
-        keys_encoding_range = ['$P{0}R'.format(i) for i in self.channel_numbers]
-        add_keys_to_convert_to_int = ['$NEXTDATA', '$PAR', '$TOT']
-
-        keys_to_convert_to_int = keys_encoding_bits + add_keys_to_convert_to_int
-
-        for key in keys_to_convert_to_int:
-            value = text[key]
-            text[key] = int(value)
-
-        self.annotation.update(text)
+        # Some fields are converted into integer values (when they are first accessed)
+        text.set_converter(self.get_channel_keys('B') + ['$NEXTDATA', '$PAR', '$TOT'], int)
+        self.annotation = text
 
         # Update data start segments if needed
+        data_start, data_end = header['data start'], header['data end']
 
-        if self._data_start == 0:
-            self._data_start = int(text['$BEGINDATA'])
-        if self._data_end == 0:
-            self._data_end = int(text['$ENDDATA'])
+        if data_start == 0:
+            data_start = int(text['$BEGINDATA'])
+        if data_end == 0:
+            data_end = int(text['$ENDDATA'])
+
+        self._data_start = self._dataset_offset + data_start
+        self._data_end = self._dataset_offset + data_end
 
         ### Keep for debugging
         #key_list = self.header['text'].keys()
@@ -216,11 +1090,20 @@ class FCS_Parser(object):
         start = self.annotation['__header__']['analysis start']
         end = self.annotation['__header__']['analysis end']
         if start != 0 and end != 0:
-            file_handle.seek(self.start, 0)
-            self._analysis = file_handle.read(self.end - self.start)
+            file_handle.seek(start + self._dataset_offset, 0)
+            self._analysis = file_handle.read(end - start + 1)
         else:
             self._analysis = ''
 
+    def get_channel_keys(self, parameter):
+        """
+        Returns the keywords holding the given property of all the channels
+        (e.g., 'B' gives ['$P1B', '$P2B', ...]).
+        """
+        if parameter not in self._channel_keys:
+            self._channel_keys[parameter] = ['$P{0}{1}'.format(i, parameter) for i in self.channel_numbers]
+        return self._channel_keys[parameter]
+
     def _check_assumptions(self):
         """
         Checks the FCS file to make sure that some of the assumptions made by the parser are met.
@@ -228,9 +1111,6 @@ class FCS_Parser(object):
         text = self.annotation
         keys = text.keys()
 
-        if '$NEXTDATA' in text and text['$NEXTDATA'] != 0:
-            raise_parser_feature_not_implemented('Not implemented $NEXTDATA is not 0')
-
         if '$MODE' not in text or text['$MODE'] != 'L':
             raise_parser_feature_not_implemented('Mode not implemented')
 
@@ -271,121 +1151,816 @@ class FCS_Parser(object):
 
         return channel_names
 
+    def _get_event_layout(self):
+        """
+        Figures out how a single event (one record of the list mode DATA segment) is laid out.
+
+        Returns
+        -------
+        formats : list of str
+            numpy type of each parameter (in the byte order of the file)
+        offsets : list of int
+            byte offset of each parameter within an event
+        bytes_per_event : int
+        """
+        text = self.annotation
+        endian = self._get_endian()
+
+        #conversion_dict = {'F' : 'f4', 'D' : 'f8', 'I' : 'u'} # matching FCS naming convention with numpy naming convention f4 - 4 byte (32 bit) single precision float
+        conversion_dict = {'F' : 'f', 'D' : 'f', 'I' : 'u'} # matching FCS naming convention with numpy naming convention f4 - 4 byte (32 bit) single precision float
+
+        if text['$DATATYPE'] not in conversion_dict.keys():
+            raise_parser_feature_not_implemented('$DATATYPE = {0} is not yet supported.'.format(text['$DATATYPE']))
+
+        # Calculations to figure out data types of each of parameters
+        bytes_per_par_list   = [text[key] // 8  for key in self.get_channel_keys('B')] # $PnB specifies the number of bits reserved for a measurement of parameter n
+        par_numeric_type_list   = ['{endian}{type}{size}'.format(endian=endian, type=conversion_dict[text['$DATATYPE']], size=bytes_per_par) for bytes_per_par in bytes_per_par_list]
+        offsets = list(numpy.cumsum([0] + bytes_per_par_list[:-1]))
+        bytes_per_event = sum(bytes_per_par_list)
+
+        return par_numeric_type_list, offsets, bytes_per_event
+
+    def _get_endian(self):
+        """ Byte order of the DATA segment ('<' or '>') as specified by $BYTEORD. """
+        byteord = self.annotation['$BYTEORD'].strip()
+        if byteord == '1,2,3,4' or byteord == '1,2':
+            endian = '<'
+        elif byteord == '4,3,2,1' or byteord == '2,1':
+            endian = '>'
+        self._endian = endian
+        return endian
+
+    def _get_bit_widths(self):
+        """ Number of bits reserved for each parameter ($PnB). """
+        return [self.annotation[key] for key in self.get_channel_keys('B')]
+
+    def _is_bit_packed(self):
+        """ True if integer parameters are stored with widths that do not map onto numpy types. """
+        return (self.annotation['$DATATYPE'] == 'I' and
+                any(b not in (8, 16, 32, 64) for b in self._get_bit_widths()))
+
+    def _get_range_masks(self, indexes):
+        """
+        For integer data, returns the bit masks implied by the range ($PnR) of the given parameters.
+
+        Values of integer parameters should be masked to the smallest power of 2 that
+        is at least $PnR (bits above it may hold garbage).
+        None is returned for parameters that do not require masking.
+        """
+        text = self.annotation
+        bits_keys, range_keys = self.get_channel_keys('B'), self.get_channel_keys('R')
+        masks = []
+        for i in indexes:
+            mask = None
+            if text['$DATATYPE'] == 'I':
+                bits = text[bits_keys[i]]
+                try:
+                    value_range = int(float(text[range_keys[i]]))
+                except (KeyError, ValueError):
+                    value_range = 0
+                if value_range > 0:
+                    range_bits = int(value_range - 1).bit_length()
+                    if range_bits < bits:
+                        mask = (1 << range_bits) - 1
+            masks.append(mask)
+        return masks
+
+    def _apply_range_masks(self, data, indexes):
+        """ Masks integer data in place (see _get_range_masks). """
+        for j, mask in enumerate(self._get_range_masks(indexes)):
+            if mask is None:
+                continue
+            if data.dtype.names is not None:
+                name = data.dtype.names[j]
+                data[name] &= numpy.array(mask, dtype=data.dtype[name])
+            else:
+                data[:, j] &= numpy.array(mask, dtype=data.dtype)
+
+    def _read_packed(self, file_handle, start, count, indexes):
+        """ Reads and unpacks count events (starting at event start) of bit packed integer data. """
+        widths = self._get_bit_widths()
+        bits_per_event = sum(widths)
+        first_bit = start * bits_per_event
+        byte_start = first_bit // 8
+        byte_stop = ((start + count) * bits_per_event + 7) // 8
+
+        file_handle.seek(self._data_start + byte_start, 0)
+        raw = self._read_array(file_handle, numpy.uint8, byte_stop - byte_start)
+        return _unpack_bits(raw, count, widths, indexes, first_bit - 8 * byte_start,
+                            msb_first=(self._get_endian() == '>'))
+
+    def _get_channel_indexes(self, channels):
+        """ Returns the positions of the given channels (names or positions) in the DATA segment. """
+        channel_names = list(self.get_channel_names())
+        alternate_names = list(self.channel_names_n if self._channel_naming == '$PnS' else self.channel_names_s)
+
+        indexes = []
+        for channel in channels:
+            if isinstance(channel, (int, numpy.integer)):
+                index = channel
+            elif channel in channel_names:
+                index = channel_names.index(channel)
+            elif channel in alternate_names:
+                index = alternate_names.index(channel)
+            else:
+                raise ValueError("Channel '{0}' does not exist in the FCS file '{1}'. "
+                                 "Available channels: {2}".format(channel, self.path, channel_names))
+            indexes.append(index)
+        return indexes
+
     def read_data(self, file_handle):
         """ Reads the DATA segment of the FCS file. """
         self._check_assumptions()
         text = self.annotation
 
-        if (self._data_start > self._file_size) or (self._data_end > self._file_size):
+        if self._is_truncated(self._data_start) or self._is_truncated(self._data_end):
             raise ValueError("The FCS file '{}' is corrupted. Part of the data segment is missing.".format(self.path))
 
         num_events = text['$TOT'] # Number of events recorded
         num_pars   = text['$PAR'] # Number of parameters recorded
 
-        if text['$BYTEORD'].strip() == '1,2,3,4' or text['$BYTEORD'].strip() == '1,2':
-            endian = '<'
-        elif text['$BYTEORD'].strip() == '4,3,2,1' or text['$BYTEORD'].strip() == '2,1':
-            endian = '>'
-
-        #conversion_dict = {'F' : 'f4', 'D' : 'f8', 'I' : 'u'} # matching FCS naming convention with numpy naming convention f4 - 4 byte (32 bit) single precision float
-        conversion_dict = {'F' : 'f', 'D' : 'f', 'I' : 'u'} # matching FCS naming convention with numpy naming convention f4 - 4 byte (32 bit) single precision float
+        channel_names = list(self.get_channel_names())
 
-        if text['$DATATYPE'] not in conversion_dict.keys():
-            raise_parser_feature_not_implemented('$DATATYPE = {0} is not yet supported.'.format(text['$DATATYPE']))
+        if self._channels is None:
+            indexes = range(num_pars)
+        else:
+            indexes = self._get_channel_indexes(self._channels)
 
-        # Calculations to figure out data types of each of parameters
-        bytes_per_par_list   = [text['$P{0}B'.format(i)] // 8  for i in self.channel_numbers] # $PnB specifies the number of bits reserved for a measurement of parameter n
-        par_numeric_type_list   = ['{endian}{type}{size}'.format(endian=endian, type=conversion_dict[text['$DATATYPE']], size=bytes_per_par) for bytes_per_par in bytes_per_par_list]
-        bytes_per_event = sum(bytes_per_par_list)
-        total_bytes = bytes_per_event * num_events
+        self._data_channel_names = tuple(channel_names[i] for i in indexes)
 
         # Parser for list mode. Here, the order is a list of tuples. where each tuples stores event related information
         file_handle.seek(self._data_start, 0) # Go to the part of the file where data starts
 
         ##
         # Read in the data
-        if len(set(par_numeric_type_list)) > 1:
-            # values saved in mixed data formats
-            dtype = ','.join(par_numeric_type_list)
-            data = numpy.fromfile(file_handle, dtype=dtype, count=num_events)
-            data.dtype.names = self.get_channel_names()
+        if self._is_bit_packed():
+            # Bit packed data cannot be viewed in place, so it is decoded into memory
+            data = self._read_packed(file_handle, 0, num_events, indexes)
+            self._apply_range_masks(data, indexes)
+            self._data = data
+            return
+
+        par_numeric_type_list, offsets, bytes_per_event = self._get_event_layout()
+        endian = self._endian
+
+        if self._channels is not None:
+            data = self._read_channels(file_handle, indexes, par_numeric_type_list, offsets, bytes_per_event)
         else:
-            # values saved in a single data format
-            dtype = par_numeric_type_list[0]
-            data = numpy.fromfile(file_handle, dtype=dtype, count=num_events * num_pars)
-            data = data.reshape((num_events, num_pars))
-        ##
-        # Convert to native byte order 
-        # This is needed for working with pandas datastructures
-        native_code = '<' if (sys.byteorder == 'little') else '>'
-        if endian != native_code:
-            # swaps the actual bytes and also the endianness
-            data = data.byteswap().newbyteorder()
+            if len(set(par_numeric_type_list)) > 1:
+                # values saved in mixed data formats
+                dtype = ','.join(par_numeric_type_list)
+                shape = (num_events,)
+            else:
+                # values saved in a single data format
+                dtype = par_numeric_type_list[0]
+                shape = (num_events, num_pars)
+
+            if self._memory_map:
+                # No copy is made here. Byte order is dealt with on a per channel basis
+                # when the channels are accessed (see get_channel_data).
+                data = numpy.memmap(self.path, dtype=dtype, mode='r', offset=self._data_start, shape=shape)
+            else:
+                data = self._read_array(file_handle, dtype, numpy.prod(shape))
+                data = data.reshape(shape)
+                ##
+                # Convert to native byte order
+                # This is needed for working with pandas datastructures
+                if endian != _native_code:
+                    # swaps the actual bytes (in place) and also the endianness
+                    data = data.byteswap(True).newbyteorder()
+
+            if data.dtype.names is not None:
+                data.dtype.names = channel_names
+
+        if not self._memory_map:
+            self._apply_range_masks(data, indexes)
 
         self._data = data
 
+    def _get_record_dtype(self, indexes, formats, offsets, bytes_per_event):
+        """
+        Returns a structured dtype describing a list mode record, restricted
+        to the parameters at the given positions. The itemsize is the full size of an event
+        so the other parameters are skipped over.
+        """
+        names = [self.get_channel_names()[i] for i in indexes]
+        return numpy.dtype({'names': names,
+                            'formats': [formats[i] for i in indexes],
+                            'offsets': [offsets[i] for i in indexes],
+                            'itemsize': bytes_per_event})
+
+    @staticmethod
+    def _records_to_array(records):
+        """
+        Copies the fields of structured (list mode) records into a native byte order array.
+        If all the fields share the same type, a 2D array is returned (events x channels).
+        """
+        names = records.dtype.names
+        native_formats = [records.dtype.fields[name][0].newbyteorder('=') for name in names]
+
+        if len(set(native_formats)) > 1:
+            data = numpy.empty(len(records), dtype=list(zip(names, native_formats)))
+            for name in names:
+                data[name] = records[name]
+        else:
+            data = numpy.empty((len(records), len(names)), dtype=native_formats[0])
+            for j, name in enumerate(names):
+                data[:, j] = records[name]
+        return data
+
+    def _read_channels(self, file_handle, indexes, formats, offsets, bytes_per_event):
+        """
+        Reads only the parameters at the given positions from the DATA segment.
+
+        The list mode records are viewed through a structured dtype that only
+        describes the requested parameters (with their offsets within an event),
+        so the other parameters are skipped by strided access and are never copied.
+        (Files that cannot be memory mapped are streamed through instead.)
+
+        When memory mapping, the returned array is (events x channels), like the
+        array returned for the other sources, if the requested parameters share the same
+        data type. It is a view of the file if the parameters are evenly spaced within
+        an event (e.g., a single parameter), and a copy otherwise.
+        Parameters saved in mixed data types are returned as a memory mapped structured array.
+        """
+        num_events = self.annotation['$TOT']
+        record_dtype = self._get_record_dtype(indexes, formats, offsets, bytes_per_event)
+        if self._memory_mappable:
+            records = numpy.memmap(self.path, dtype=record_dtype, mode='r',
+                                   offset=self._data_start, shape=(num_events,))
+        else:
+            records = self._read_array(file_handle, record_dtype, num_events)
+
+        if not self._memory_map:
+            return self._records_to_array(records)
+
+        selected_formats = [formats[i] for i in indexes]
+        if len(set(selected_formats)) > 1:
+            return records
+        selected_offsets = [offsets[i] for i in indexes]
+        steps = set(numpy.diff(selected_offsets))
+        if len(steps) > 1 or num_events == 0:
+            return self._records_to_array(records)
+        step = steps.pop() if steps else numpy.dtype(selected_formats[0]).itemsize
+        return numpy.ndarray(shape=(num_events, len(indexes)), dtype=selected_formats[0],
+                             buffer=records, offset=selected_offsets[0],
+                             strides=(bytes_per_event, step))
+
+    def iter_events(self, chunk_size=100000, channels=None, output_format='ndarray', dtype=None):
+        """
+        Iterates over the events of the DATA segment in blocks of fixed size.
+
+        Only one block is held in memory at a time, which makes it possible
+        to process files that are larger than the available memory.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of events in each block (the last block may be smaller).
+        channels : None | str | list of str
+            If given, only these channels are read.
+            Otherwise, the channels specified when the parser was created are used (all by default).
+        output_format : 'ndarray' | 'DataFrame'
+            Format of the yielded blocks. The index of a DataFrame block holds
+            the positions of its events in the file.
+        dtype : None | str | numpy.dtype
+            Data type of the yielded values. If None, the policy set by set_dtype_policy is used.
+
+        Yields
+        ------
+        The values of a block of events in native byte order.
+        As an ndarray: (events x channels) if all channels share the same data type, a structured array otherwise.
+        """
+        if output_format not in ('ndarray', 'DataFrame'):
+            raise ValueError("The output_format must be either 'ndarray' or 'DataFrame'")
+        if output_format == 'DataFrame' and pandas_found == False:
+            raise ImportError('You do not have pandas installed.')
+
+        self._check_assumptions()
+
+        if self._is_truncated(self._data_start) or self._is_truncated(self._data_end):
+            raise ValueError("The FCS file '{}' is corrupted. Part of the data segment is missing.".format(self.path))
+
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer. Encountered {0}'.format(chunk_size))
+
+        if dtype is None:
+            dtype = _dtype_policy
+
+        if channels is None:
+            channels = self._channels
+        elif isinstance(channels, string_types):
+            channels = [channels]
+
+        if channels is None:
+            indexes = range(self.annotation['$PAR'])
+        else:
+            indexes = self._get_channel_indexes(channels)
+
+        names = [self.get_channel_names()[i] for i in indexes]
+        bit_packed = self._is_bit_packed()
+        if not bit_packed:
+            formats, offsets, bytes_per_event = self._get_event_layout()
+            record_dtype = self._get_record_dtype(indexes, formats, offsets, bytes_per_event)
+        num_events = self.annotation['$TOT']
+
+        with self._open() as f:
+            f.seek(self._data_start, 0)
+            for start in range(0, num_events, chunk_size):
+                count = min(chunk_size, num_events - start)
+                if bit_packed:
+                    data = self._read_packed(f, start, count, indexes)
+                else:
+                    records = self._read_array(f, record_dtype, count)
+                    data = self._records_to_array(records)
+                self._apply_range_masks(data, indexes)
+                data = _apply_dtype(data, dtype)
+                if output_format == 'DataFrame':
+                    data = pandas.DataFrame(data, columns=names,
+                                            index=numpy.arange(start, start + count))
+                yield data
+
+    def get_channel_data(self, channel):
+        """
+        Returns the values of a single channel in native byte order.
+
+        When the DATA segment is memory mapped, only the requested channel is
+        read from the file (and byte swapped if needed).
+
+        Parameters
+        ----------
+        channel : str | int
+            Name of the channel (as returned by get_channel_names) or its position.
+        """
+        data = self.data
+        channel_names = list(self.data_channel_names)
+
+        if isinstance(channel, (int, numpy.integer)):
+            index, name = channel, channel_names[channel]
+        else:
+            index, name = channel_names.index(channel), channel
+
+        if data.dtype.names is not None:
+            column = data[name]
+        else:
+            column = data[:, index]
+
+        if column.dtype.byteorder not in ('=', '|', _native_code):
+            column = column.astype(column.dtype.newbyteorder('='))
+        column = numpy.asarray(column)
+
+        if self._memory_map:
+            # Integer data is masked to $PnR here, since the memory mapped data is left as is.
+            all_index = list(self.get_channel_names()).index(name)
+            mask = self._get_range_masks([all_index])[0]
+            if mask is not None:
+                column = column & numpy.array(mask, dtype=column.dtype)
+        return column
+
+    @property
+    def data_channel_names(self):
+        """ Names of the channels held in self.data (all channels unless a subset was requested). """
+        if self._channels is None:
+            return self.get_channel_names()
+        if self._data is None:
+            self.data
+        return self._data_channel_names
+
     @property
     def data(self):
         """ Holds the parsed DATA segment of the FCS file. """
         if self._data is None:
-            with open(self.path, 'rb') as f:
-                self.read_data()
+            with self._open() as f:
+                self.read_data(f)
         return self._data
 
     @property
     def analysis(self):
         """ Holds the parsed ANALYSIS segment of the FCS file. """
-        if self._analysis == '':
-            with open(self.path, 'rb') as f:
-                self.read_analysis()
+        if self._analysis is None:
+            with self._open() as f:
+                self.read_analysis(f)
         return self._analysis
 
     def reformat_meta(self):
         """ Collects the meta data information in a more user friendly format.
-        Function looks through the meta data, collecting the channel related information into a dataframe and moving it into the _channels_ key
+        Function looks through the meta data, moving the channel related information into
+        a ChannelTable stored in the _channels_ key
         """
         meta = self.annotation # For shorthand (passed by reference)
-        channel_properties = []
-
-        for key, value in meta.items():
-            if key[:3] == '$P1':
-                if key[3] not in string.digits:
-                    channel_properties.append(key[3:])
+        channel_properties = [key[3:] for key in meta.keys()
+                              if key[:3] == '$P1' and key[3:4] not in string.digits]
 
-        # Capture all the channel information in a list of lists -- used to create a data frame
-        channel_matrix = [[meta.get('$P{0}{1}'.format(ch, p)) for p in channel_properties] for ch in self.channel_numbers]
+        meta['_channels_'] = ChannelTable.from_text(meta, self.channel_numbers, channel_properties)
 
         # Remove this information from the dictionary
-        for ch in self.channel_numbers:
-            for p in channel_properties:
-                key = '$P{0}{1}'.format(ch, p)
-                if key in meta:
-                    meta.pop(key)
+        for p in channel_properties:
+            for key in self.get_channel_keys(p):
+                meta.pop(key, None)
 
-        num_channels = meta['$PAR']
-        column_names = ['$Pn{0}'.format(p) for p in channel_properties]
+        meta['_channel_names_'] = self.get_channel_names()
 
-        df = pandas.DataFrame(channel_matrix, columns=column_names, index=(1+numpy.arange(num_channels)))
+_size_units = {'B': 1, 'KB': 2 ** 10, 'MB': 2 ** 20, 'GB': 2 ** 30, 'TB': 2 ** 40}
 
-        if '$PnE' in column_names:
-            df['$PnE'] = df['$PnE'].apply(lambda x : x.split(','))
+def to_bytes(size):
+    """
+    Converts a size given as a number of bytes or as a string (e.g., '500MB', '4GB') into a number of bytes.
+    """
+    if isinstance(size, string_types):
+        value = size.strip().upper()
+        for unit in sorted(_size_units, key=len, reverse=True):
+            if value.endswith(unit):
+                return int(float(value[:-len(unit)]) * _size_units[unit])
+        return int(float(value))
+    return int(size)
+
+class ParseCache(object):
+    """
+    A persistent on-disk cache of parsed FCS files.
 
-        df.index.name = 'Channel Number'
-        meta['_channels_'] = df
-        meta['_channel_names_'] = self.get_channel_names()
+    Each parsed file is written once into a sidecar directory holding its meta data
+    and one native byte order .npy file per channel. Later parses of the same file
+    (same path, size and modification time) reopen the channels memory mapped
+    instead of parsing the file again.
+
+    When the total size of the cache exceeds max_size, the least recently used entries are evicted.
+
+    Examples
+    --------
+    >>> cache = ParseCache('~/.fcs_cache', max_size='10GB')
+    >>> meta, data = parse_fcs(path, cache=cache)
+    >>> enable_parse_cache('~/.fcs_cache')  # Use a cache for all subsequent parses
+    """
+    _meta_file = 'meta.pkl'
+
+    def __init__(self, directory, max_size='4GB'):
+        """
+        Parameters
+        ----------
+        directory : str
+            Directory in which the cache entries are stored (created if needed).
+        max_size : int | str
+            Maximal size of the cache, in bytes or as a string such as '500MB' or '4GB'.
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_size = to_bytes(max_size)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return '<ParseCache {0!r} (max_size={1})>'.format(self.directory, self.max_size)
+
+    def __deepcopy__(self, memo):
+        # The cache is shared (e.g., when copying the readdata_kwargs of a measurement)
+        return self
+
+    def _entry_path(self, path, options):
+        key = repr((_get_source_key(path), sorted(options.items())))
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def load(self, path, meta_data_only=False, **options):
+        """
+        Loads a cached file.
+
+        Returns
+        -------
+        None if the file is not in the cache. Otherwise, a 3-tuple with the meta data,
+        the information about the channels (dict) and a list of memory mapped channel
+        arrays (or None, if meta_data_only).
+        """
+        entry = self._entry_path(path, options)
+        try:
+            with open(os.path.join(entry, self._meta_file), 'rb') as f:
+                meta, channel_info = pickle.load(f)
+            os.utime(entry, None)  # Mark as recently used
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if meta_data_only:
+            return meta, channel_info, None
+        columns = [numpy.load(os.path.join(entry, '{0}.npy'.format(i)), mmap_mode='r')
+                   for i in range(len(channel_info['names']))]
+        return meta, channel_info, columns
+
+    def store(self, path, meta, channel_info, columns, **options):
+        """ Writes a parsed file into the cache (then evicts entries if the cache is too large). """
+        entry = self._entry_path(path, options)
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.staging-')
+        try:
+            for i, column in enumerate(columns):
+                numpy.save(os.path.join(staging, '{0}.npy'.format(i)), numpy.ascontiguousarray(column))
+            with open(os.path.join(staging, self._meta_file), 'wb') as f:
+                pickle.dump((meta, channel_info), f, protocol=pickle.HIGHEST_PROTOCOL)
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(staging, entry)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict()
+
+    def _entries(self):
+        """ Returns a list of (last used time, size, path) of the cache entries. """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        return entries
+
+    @property
+    def size(self):
+        """ Total size of the cache entries (in bytes). """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_size=None):
+        """ Removes the least recently used entries until the cache is not larger than max_size. """
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """ Removes all the entries of the cache. """
+        self.evict(max_size=0)
+
+_dtype_policy = None
+
+def set_dtype_policy(dtype):
+    """
+    Sets the data type of the event data when no dtype is given to parse_fcs (or to a transformation).
+
+    Parameters
+    ----------
+    dtype : None | str | numpy.dtype
+        None keeps the values in the data type in which they are stored in the file
+        (e.g., float32 for $DATATYPE=F, unsigned integers for $DATATYPE=I), and transformations return float64.
+        'float32' keeps the events in single precision through parsing, transformations, gating and subsampling.
+        Integer types keep raw counts (transformations then return float64).
+
+    Examples
+    --------
+    >>> set_dtype_policy('float32')
+    """
+    global _dtype_policy
+    _dtype_policy = None if dtype is None else numpy.dtype(dtype)
+
+def get_dtype_policy():
+    """ Returns the data type set by set_dtype_policy (None if the stored data types are kept). """
+    return _dtype_policy
+
+def _apply_dtype(data, dtype):
+    """
+    Casts parsed event data (DataFrame, ndarray or structured array) to dtype, in native byte order.
+    Structured arrays are converted to a 2D array. Nothing is done if dtype is None.
+    """
+    if dtype is None:
+        return data
+    dtype = numpy.dtype(dtype)
+    if pandas_found and isinstance(data, pandas.DataFrame):
+        return data.astype(dtype, copy=False)
+    if data.dtype.names is not None:
+        return numpy.column_stack([data[name].astype(dtype) for name in data.dtype.names])
+    return data.astype(dtype, copy=False)
+
+_parse_cache = None
+
+def enable_parse_cache(directory, max_size='4GB'):
+    """
+    Uses a ParseCache (see ParseCache for the parameters) for all calls
+    to parse_fcs that do not specify the cache argument.
+    This includes the parsing done by FCMeasurement and the collections.
+
+    Returns
+    -------
+    The enabled ParseCache.
+    """
+    global _parse_cache
+    _parse_cache = ParseCache(directory, max_size=max_size)
+    return _parse_cache
+
+def disable_parse_cache():
+    """ Stops using the cache enabled with enable_parse_cache (the cached files are kept on disk). """
+    global _parse_cache
+    _parse_cache = None
+
+_spillover_keywords = ('$SPILLOVER', '$SPILL', 'SPILL', 'SPILLOVER')
+
+def parse_spillover(value):
+    """
+    Decodes the value of a spillover keyword ($SPILLOVER, $SPILL or SPILL).
+
+    The value holds the number of channels n, the names of the n channels,
+    then the n x n entries of the matrix (row by row), all separated by commas.
+
+    Returns
+    -------
+    A 2-tuple with the channel names (list of str) and the spillover matrix (n x n ndarray),
+    in which row i holds the spillover of the fluorochrome of channel i into every channel.
+    """
+    fields = [field.strip() for field in value.strip().split(',')]
+    try:
+        n = int(fields[0])
+    except ValueError:
+        raise ValueError('The spillover value does not start with the number of channels: {0!r}'.format(value[:50]))
+    if len(fields) != 1 + n + n * n:
+        raise ValueError('A spillover matrix over {0} channels should hold {1} fields. '
+                         'Found {2}.'.format(n, 1 + n + n * n, len(fields)))
+    names = fields[1:n + 1]
+    matrix = numpy.array(fields[n + 1:], dtype=numpy.float64).reshape(n, n)
+    return names, matrix
+
+def get_spillover(meta):
+    """
+    Returns the spillover matrix stored in the meta data of an FCS file
+    as a 2-tuple (channel names, matrix) (see parse_spillover), or None if there is none.
+    """
+    for key in _spillover_keywords:
+        if key in meta:
+            return parse_spillover(meta[key])
+    return None
+
+_compensation_matrices = _LRUCache(256)
+
+def get_compensation_matrix(spillover):
+    """
+    Returns the inverse of the spillover matrix (the compensation matrix).
+
+    The inverse is computed once per distinct spillover matrix and then shared
+    (read-only), e.g., by all the wells of a plate acquired with the same settings.
+    The inverses of the 256 most recently used matrices are kept.
+    """
+    spillover = numpy.ascontiguousarray(spillover, dtype=numpy.float64)
+    key = (spillover.shape, spillover.tobytes())
+    inverse = _compensation_matrices.get(key)
+    if inverse is None:
+        inverse = numpy.linalg.inv(spillover)
+        inverse.flags.writeable = False
+        _compensation_matrices[key] = inverse
+    return inverse
+
+def apply_compensation(values, spillover):
+    """
+    Compensates the fluorescence values of a block of events.
 
-def parse_fcs(path, meta_data_only=False, output_format='DataFrame', compensate=False, channel_naming='$PnS', reformat_meta=False):
+    The observed values are the actual values multiplied by the spillover matrix,
+    so all the events are compensated with a single product with its (cached) inverse.
+
+    Parameters
+    ----------
+    values : array (events x channels)
+        Values of the channels of the spillover matrix (in the order of its rows).
+    spillover : array (channels x channels)
+        Spillover matrix.
+
+    Returns
+    -------
+    Compensated values (float32 values stay float32, other types give float64).
+    """
+    values = numpy.asarray(values)
+    dtype = values.dtype if values.dtype.kind == 'f' else numpy.dtype(numpy.float64)
+    inverse = get_compensation_matrix(spillover).astype(dtype, copy=False)
+    return numpy.dot(values.astype(dtype, copy=False), inverse)
+
+def _compensate_output(meta, data, data_channel_names, channel_names, alternate_names, path):
+    """
+    Compensates parsed data (DataFrame or ndarray) with the spillover matrix found in the meta data.
+
+    The channels of the spillover matrix may be named with either naming convention
+    and all of them must have been read.
+    """
+    spillover = get_spillover(meta)
+    if spillover is None:
+        raise ValueError("The FCS file '{0}' does not hold a spillover matrix "
+                         "({1}).".format(path, ', '.join(_spillover_keywords)))
+    spillover_names, matrix = spillover
+
+    channel_names, alternate_names = list(channel_names), list(alternate_names)
+    data_channel_names = list(data_channel_names)
+    positions = []
+    for name in spillover_names:
+        if name in channel_names:
+            name = channel_names[channel_names.index(name)]
+        elif name in alternate_names:
+            name = channel_names[alternate_names.index(name)]
+        else:
+            raise ValueError("Channel '{0}' of the spillover matrix does not exist in the FCS file '{1}'.".format(name, path))
+        if name not in data_channel_names:
+            raise ValueError("Compensation requires channel '{0}', which was not read.".format(name))
+        positions.append(data_channel_names.index(name))
+
+    if pandas_found and isinstance(data, pandas.DataFrame):
+        columns = [data.columns[i] for i in positions]
+        compensated = apply_compensation(data[columns].values, matrix)
+        for j, column in enumerate(columns):
+            data[column] = compensated[:, j]
+        return data
+
+    if data.dtype.names is not None or data.dtype.kind != 'f':
+        data = _apply_dtype(data, numpy.float64)
+    else:
+        data = numpy.array(data) # Memory mapped arrays are read-only
+    data[:, positions] = apply_compensation(data[:, positions], matrix)
+    return data
+
+def _parse_cached(path, cache, meta_data_only, output_format, channel_naming, reformat_meta, channels, dataset,
+                  compensate=False):
+    """
+    parse_fcs through a ParseCache. On a cache miss, all the channels of the
+    file are parsed and stored, so that any subset of channels can be served afterwards.
+
+    Returns None if the request cannot be served (meta data only requests for files not in the cache).
+    """
+    options = dict(channel_naming=channel_naming, dataset=dataset)
+    cached = cache.load(path, meta_data_only=meta_data_only, **options)
+
+    if cached is None:
+        if meta_data_only:
+            return None
+        parsed_FCS = FCS_Parser(path, read_data=True, channel_naming=channel_naming, dataset=dataset)
+        names = list(parsed_FCS.data_channel_names)
+        columns = [parsed_FCS.get_channel_data(i) for i in range(len(names))]
+        # Both forms of the meta data are kept so that a single entry serves either request
+        meta = {'raw': dict(parsed_FCS.annotation.items()), 'reformatted': None}
+        parsed_FCS.reformat_meta()
+        meta['reformatted'] = parsed_FCS.annotation
+        channel_info = {'names': names,
+                        'alternate names': list(parsed_FCS.channel_names_n if channel_naming == '$PnS'
+                                                else parsed_FCS.channel_names_s)}
+        cache.store(path, meta, channel_info, columns, **options)
+        cached = cache.load(path, **options)
+
+    meta, channel_info, columns = cached
+    meta = meta['reformatted' if reformat_meta else 'raw']
+    if meta_data_only:
+        return meta
+
+    names = channel_info['names']
+    if channels is None:
+        indexes = range(len(names))
+    else:
+        if isinstance(channels, string_types):
+            channels = [channels]
+        indexes = []
+        for channel in channels:
+            if isinstance(channel, (int, numpy.integer)):
+                indexes.append(channel)
+            elif channel in names:
+                indexes.append(names.index(channel))
+            elif channel in channel_info['alternate names']:
+                indexes.append(channel_info['alternate names'].index(channel))
+            else:
+                raise ValueError("Channel '{0}' does not exist in the FCS file '{1}'. "
+                                 "Available channels: {2}".format(channel, path, names))
+    selected_names = [names[i] for i in indexes]
+    selected = [columns[i] for i in indexes]
+
+    if output_format == 'DataFrame':
+        if pandas_found == False:
+            raise ImportError('You do not have pandas installed.')
+        data = pandas.DataFrame(dict(zip(selected_names, selected)), columns=selected_names)
+    elif output_format == 'ndarray':
+        if len(set(c.dtype for c in selected)) > 1:
+            data = numpy.empty(len(selected[0]), dtype=[(n, c.dtype) for n, c in zip(selected_names, selected)])
+            for n, c in zip(selected_names, selected):
+                data[n] = c
+        else:
+            data = numpy.column_stack(selected)
+    else:
+        raise ValueError("The output_format must be either 'ndarray' or 'DataFrame'")
+
+    if compensate:
+        data = _compensate_output(meta, data, selected_names, names, channel_info['alternate names'], path)
+    return meta, data
+
+def parse_fcs(path, meta_data_only=False, output_format='DataFrame', compensate=False, channel_naming='$PnS', reformat_meta=False,
+              memory_map=False, channels=None, dataset=0, cache=None, dtype=None):
     """
     Parse an fcs file at the location specified by the path.
 
     Parameters
     ----------
-    path : str
-        Path of .fcs file
+    path : str | ZipMember | bytes | file-like object
+        Path of .fcs file. Files compressed with gzip, bz2 or xz (e.g., .fcs.gz) are decompressed
+        while being read (nothing is written to disk).
+        The content of the file may also be given as bytes, as a seekable binary file-like object
+        (read from its beginning, whatever its current position), or as a ZipMember
+        to read a file straight from a zip archive.
     meta_data_only : bool
         If True, the parse_fcs only returns the meta_data (the TEXT segment of the FCS file)
     output_format : 'DataFrame' | 'ndarray'
         If set to 'DataFrame' the returned
+    compensate : bool
+        If True, the fluorescence channels are compensated with the spillover matrix stored
+        in the file ($SPILLOVER, $SPILL or SPILL). See apply_compensation.
+        All the channels of the spillover matrix must be read.
     channel_naming : '$PnS' | '$PnN'
         Determines which meta data field is used for naming the channels.
         The default should be $PnS (even though it is not guaranteed to be unique)
@@ -399,8 +1974,27 @@ def parse_fcs(path, meta_data_only=False, output_format='DataFrame', compensate=
         It looks like they were swapped for some reason in the official FCS specification.
 
     reformat_meta : bool
-        If true, the meta data is reformatted with the channel information organized into a DataFrame an moved
-        into the '_channels_' key
+        If true, the meta data is reformatted with the channel information organized into a ChannelTable
+        moved into the '_channels_' key
+    memory_map : bool
+        If True, the DATA segment is memory mapped rather than read into memory.
+        With output_format='ndarray' a read-only numpy.memmap (in the byte order of the file) is returned.
+        With output_format='DataFrame' the channels are converted to native byte order one at a time,
+        so no intermediate copy of the whole DATA segment is made.
+    channels : None | str | list of str
+        If given, only the requested channels are decoded from the DATA segment.
+        Channels may be specified by either of their names ($PnS or $PnN) or by position.
+        The meta data still describes all the channels in the file.
+    dataset : int
+        Index of the data set to parse, for files that hold several data sets
+        (chained through the $NEXTDATA keyword). Use index_datasets to list them.
+    cache : None | False | ParseCache
+        Cache in which the parsed file is stored, and from which it is reopened (memory mapped) on later parses.
+        If None, the cache enabled by enable_parse_cache is used (if any). If False, no cache is used.
+    dtype : None | str | numpy.dtype
+        Data type of the returned events (e.g., 'float32'). If None, the policy set by set_dtype_policy is used,
+        which by default keeps the data type in which the values are stored in the file.
+        A memory mapped ndarray is copied if it needs to be cast.
 
     Returns
     -------
@@ -419,12 +2013,23 @@ def parse_fcs(path, meta_data_only=False, output_format='DataFrame', compensate=
     meta, data_pandas = parse_fcs(fname, meta_data_only=False, output_format='DataFrame')
     meta, data_numpy  = parse_fcs(fname, meta_data_only=False, output_format='ndarray')
     """
-    if compensate == True:
-        raise_parser_feature_not_implemented('Compensation has not been implemented yet.')
+    if dtype is None:
+        dtype = _dtype_policy
+    if cache is None:
+        cache = _parse_cache
+    if cache and _get_source_key(path) is not None: # bytes and file-like objects are not cached
+        output = _parse_cached(path, cache, meta_data_only, output_format, channel_naming,
+                               reformat_meta, channels, dataset, compensate)
+        if meta_data_only and output is not None:
+            return output
+        elif output is not None:
+            meta, data = output
+            return meta, _apply_dtype(data, dtype)
 
     read_data = not meta_data_only
 
-    parsed_FCS = FCS_Parser(path, read_data=read_data, channel_naming=channel_naming)
+    parsed_FCS = FCS_Parser(path, read_data=read_data, channel_naming=channel_naming, memory_map=memory_map,
+                            channels=channels, dataset=dataset)
 
     if reformat_meta:
         parsed_FCS.reformat_meta()
@@ -438,15 +2043,174 @@ def parse_fcs(path, meta_data_only=False, output_format='DataFrame', compensate=
         if pandas_found == False:
             raise ImportError('You do not have pandas installed.')
         data = parsed_FCS.data
-        channel_names = parsed_FCS.get_channel_names()
-        data = pandas.DataFrame(data, columns=channel_names)
-        return meta, data
+        channel_names = parsed_FCS.data_channel_names
+        if memory_map or data.dtype.names is not None:
+            columns = dict((name, _apply_dtype(parsed_FCS.get_channel_data(i), dtype))
+                           for i, name in enumerate(channel_names))
+            data = pandas.DataFrame(columns, columns=channel_names)
+        else:
+            data = pandas.DataFrame(_apply_dtype(data, dtype), columns=channel_names)
     elif output_format == 'ndarray':
         """ Constructs numpy matrix """
-        return meta, parsed_FCS.data
+        data = _apply_dtype(parsed_FCS.data, dtype)
     else:
         raise ValueError("The output_format must be either 'ndarray' or 'DataFrame'")
 
+    if compensate:
+        alternate_names = parsed_FCS.channel_names_n if channel_naming == '$PnS' else parsed_FCS.channel_names_s
+        data = _compensate_output(meta, data, parsed_FCS.data_channel_names, parsed_FCS.get_channel_names(),
+                                  alternate_names, parsed_FCS.path)
+        data = _apply_dtype(data, dtype)
+    return meta, data
+
+def _parse_one(args):
+    """ Parses a single file for parse_many (module level, so that it can be sent to worker processes). """
+    path, parse_kwargs, errors = args
+    try:
+        return path, parse_fcs(path, **parse_kwargs)
+    except Exception as e:
+        if errors == 'raise':
+            raise
+        return path, e
+
+def parse_many(paths, workers=1, backend='thread', ordered=True, errors='raise', **parse_kwargs):
+    """
+    Parses several FCS files concurrently.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Paths of the FCS files.
+    workers : int
+        Number of files parsed at the same time. If 1, the files are parsed one after the other.
+    backend : 'thread' | 'process'
+        'thread' parses the files in a pool of threads. Reading the DATA segments (numpy.fromfile)
+        releases the GIL, so threads work well when reading the data dominates.
+        'process' parses the files in a pool of processes, which also runs the parsing of the TEXT
+        segment and the reformatting of the meta data in parallel. The results are pickled back to
+        the calling process (memory mapped arrays are copied).
+    ordered : bool
+        If True, a list with the results in the order of the paths is returned.
+        If False, an iterator over (path, result) pairs is returned, yielding each file as soon as it is parsed.
+    errors : 'raise' | 'return'
+        If 'raise', the first error encountered is raised.
+        If 'return', the exception raised while parsing a file is returned in place of its result.
+    parse_kwargs :
+        Keyword arguments passed to parse_fcs for every file.
+
+    Returns
+    -------
+    A list of the outputs of parse_fcs (if ordered), otherwise an iterator over (path, output) pairs.
+
+    Examples
+    --------
+    >>> results = parse_many(glob.glob('plate/*.fcs'), workers=8, reformat_meta=True)
+    >>> for path, (meta, data) in parse_many(paths, workers=4, backend='process', ordered=False):
+    ...     print(path, data.shape)
+    """
+    if backend not in ('thread', 'process'):
+        raise ValueError("backend must be either 'thread' or 'process'. Encountered {0}".format(backend))
+    if errors not in ('raise', 'return'):
+        raise ValueError("errors must be either 'raise' or 'return'")
+    tasks = [(path, parse_kwargs, errors) for path in paths]
+
+    if workers <= 1:
+        results = (_parse_one(task) for task in tasks)
+        if ordered:
+            return [result for _, result in results]
+        return results
+
+    if backend == 'thread':
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+    else:
+        from multiprocessing import Pool
+        pool = Pool(workers)
+
+    if ordered:
+        try:
+            return [result for _, result in pool.map(_parse_one, tasks)]
+        finally:
+            pool.close()
+            pool.join()
+
+    def iterate():
+        try:
+            for output in pool.imap_unordered(_parse_one, tasks):
+                yield output
+        finally:
+            pool.terminate()
+            pool.join()
+    return iterate()
+
+def scan_metadata(paths, keys=None, workers=1, output_format='DataFrame', errors='raise'):
+    """
+    Reads the meta data (TEXT segment) of many FCS files into a single table.
+
+    Only the HEADER and TEXT segments of the files are read.
+    When keys are specified, only these keywords are extracted (the TEXT segment is not split
+    into a full dictionary), which makes scanning large archives of files fast.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Paths of .fcs files
+    keys : None | str | list of str
+        Keywords to extract (e.g., ['$CYT', '$TOT', '$DATE']).
+        If None, all the keywords found in the files are returned.
+    workers : int
+        Number of files read concurrently (using threads).
+    output_format : 'DataFrame' | 'dict'
+        'DataFrame' : a DataFrame indexed by path, with a column per keyword.
+        'dict' : a dictionary mapping each keyword to a list of values (one per path, None when missing).
+    errors : 'raise' | 'ignore'
+        What to do with files that cannot be read. If 'ignore', their values are left missing.
+
+    Returns
+    -------
+    Table of keyword values (as strings) in the specified output_format.
+
+    Examples
+    --------
+    >>> table = scan_metadata(glob.glob('archive/*.fcs'), keys=['$CYT', '$TOT'], workers=8)
+    >>> table[table['$CYT'] == 'LSRII']
+    """
+    paths = list(paths)
+    if isinstance(keys, string_types):
+        keys = [keys]
+    if output_format not in ('DataFrame', 'dict'):
+        raise ValueError("The output_format must be either 'DataFrame' or 'dict'")
+    if errors not in ('raise', 'ignore'):
+        raise ValueError("errors must be either 'raise' or 'ignore'")
+
+    def scan(path):
+        try:
+            return _scan_file_metadata(path, keys)
+        except Exception:
+            if errors == 'raise':
+                raise
+            return {}
+
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            records = pool.map(scan, paths)
+        finally:
+            pool.close()
+    else:
+        records = [scan(path) for path in paths]
+
+    if keys is None:
+        keys = sorted(set().union(*records)) if records else []
+    columns = dict((key, [record.get(key) for record in records]) for key in keys)
+
+    if output_format == 'dict':
+        return columns
+    if pandas_found == False:
+        raise ImportError('You do not have pandas installed.')
+    return pandas.DataFrame(columns, index=paths, columns=keys)
+
 if __name__ == '__main__':
     import glob
     fname = glob.glob('../tests/data/Plate01/*.fcs')[0]
@@ -4,10 +4,13 @@ from FlowCytometryTools._version import version as __version__
 from FlowCytometryTools._doc import __doc__
 
 import os
-from fcsparser.api import parse as parse_fcs
+from FlowCytometryTools.IO.fcsreader import parse_fcs
 
-from FlowCytometryTools.core.containers import FCMeasurement, FCCollection, FCOrderedCollection, FCPlate
+from FlowCytometryTools.core.containers import (FCMeasurement, FCCollection, FCDiskCollection,
+                                               FCOrderedCollection, FCPlate)
+from FlowCytometryTools.core.bases import DataCache
 from FlowCytometryTools.core.gates import ThresholdGate, IntervalGate, QuadGate, PolyGate
+from FlowCytometryTools.core.sharedmem import SharedMemoryPool
 import FlowCytometryTools.core.graph as graph
 from FlowCytometryTools.core.graph import plotFCM
 
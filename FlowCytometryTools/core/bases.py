@@ -12,13 +12,16 @@ factory methods for construction from files.
 - consider always reading in data in measurements, perhaps storing on disk
 using shelve|PyTables|pandas HDFStore
 '''
-import os, inspect, decorator
+import os, re, numbers, inspect, decorator, itertools, threading, weakref
+from collections import OrderedDict
 import pylab as pl
+import pandas
 from pandas import DataFrame as DF
-from numpy import nan, unravel_index
+from numpy import nan, unravel_index, array, empty, full
 from GoreUtilities.util import get_files, save, load, to_list, get_tag_value
 from GoreUtilities import graph
 from FlowCytometryTools.core.common_doc import doc_replacer
+from FlowCytometryTools.IO.fcsreader import to_bytes
 
 
 @doc_replacer
@@ -89,6 +92,57 @@ def int2letters(x, alphabet):
     return ''.join(letters)
 
 
+def _get_n_jobs(n_jobs):
+    '''
+    Number of concurrent jobs to use.
+    None means all cpus; negative values count back from the number of cpus (-1 means all cpus).
+    '''
+    if n_jobs is None:
+        n_jobs = -1
+    if n_jobs < 0:
+        from multiprocessing import cpu_count
+        n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+# pandas >= 2.0 replaces the arrays of the columns assigned with frame[columns] = values,
+# rather than writing into them, so frames may share the arrays of their other columns.
+_setitem_replaces_arrays = tuple(int(v) for v in re.findall(r'\d+', pandas.__version__)[:2]) >= (2, 0)
+
+
+def _copy_for_update(data):
+    '''
+    Returns a copy of the DataFrame whose columns may be assigned without modifying data.
+    The arrays of the columns are shared with data when pandas allows it.
+    '''
+    return data.copy(deep=not _setitem_replaces_arrays)
+
+
+# Meta data fields referred to in queries, e.g., $TOT in "$TOT > 5000"
+_meta_field_pattern = re.compile(r'\$\w+')
+_quoted_pattern = re.compile(r'''('[^']*'|"[^"]*")''')
+
+
+def _query_meta_table(table, query):
+    '''
+    Returns the index of the rows of the meta data table that satisfy the query.
+    Fields such as $TOT are renamed to valid identifiers before the query is evaluated.
+    '''
+    names = {}
+
+    def rename(match):
+        field = match.group(0)
+        if field not in table.columns:
+            raise KeyError('Meta data field %s was not found in any of the measurements.' % field)
+        return names.setdefault(field, '_meta_field_%d' % len(names))
+
+    # Fields are not renamed inside string literals
+    parts = _quoted_pattern.split(query)
+    parts[::2] = [_meta_field_pattern.sub(rename, part) for part in parts[::2]]
+    renamed = table.rename(columns=names)
+    return renamed.query(''.join(parts)).index
+
+
 _now = 'apply_now'
 
 
@@ -107,7 +161,7 @@ def queueable(fun, *args, **kwargs):
         out.history.append((f_name, params))
         return out
     else:
-        new = params['self'].copy()
+        new = params['self']._copy_sharing_data()
         del params['self']
         params[_now] = True
 
@@ -157,11 +211,170 @@ class BaseObject(object):
             return copy(self)
 
 
+class DataCache(object):
+    '''
+    Memory-budgeted cache of the data that measurements read from their data files.
+
+    Data read by a measurement attached to the cache is kept in memory (as if it
+    had been read with setdata=True) until the total size of the cached data exceeds
+    the budget. The data of the least recently used measurements is then dropped,
+    and is read again from the data file when it is next needed.
+
+    Only data read from the data files is managed by the cache; data assigned to
+    a measurement (e.g., the output of transform or gate) is never dropped.
+
+    A single cache may be shared by several collections, which then share the budget.
+
+    The measurements returned by operations such as transform or gate (and shallow copies,
+    see Measurement.copy) share the cached data of the measurement they derive from until
+    they assign new data; it is counted once and dropped from all of them together.
+    Deep copies hold their own copy of the data, which is not counted.
+
+    Parameters
+    ----------
+    max_size : int | str
+        Budget, in bytes, or as a string such as '512MB' or '4GB'.
+
+    Examples
+    --------
+    >>> cache = DataCache('4GB')
+    >>> plate1 = FCPlate.from_dir('plate1', 'plate1/', data_cache=cache)
+    >>> plate2 = FCPlate.from_dir('plate2', 'plate2/', data_cache=cache)
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = to_bytes(max_size)
+        # Each entry is the data read from a file by a measurement, held by that measurement and its copies.
+        self._entries = OrderedDict()  # entry key -> (size, {id(measurement): (weakref to measurement, id(data))})
+        self._keys = {}  # id(measurement) -> entry key
+        self._counter = itertools.count()
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return '<DataCache {0}/{1} bytes, {2} measurements>'.format(self._size, self.max_size,
+                                                                    len(self._keys))
+
+    def __deepcopy__(self, memo):
+        # Copies of measurements and collections share the cache
+        return self
+
+    def __reduce__(self):
+        # The cached data is not pickled along with the cache.
+        return (DataCache, (self.max_size,))
+
+    @property
+    def size(self):
+        ''' Total size (bytes) of the cached data. '''
+        return self._size
+
+    @staticmethod
+    def _get_size(data):
+        if isinstance(data, DF):
+            return int(data.memory_usage(index=True).sum())
+        return int(getattr(data, 'nbytes', 0))
+
+    def add(self, measurement, data):
+        '''
+        Registers the data read by the measurement, dropping the data of
+        the least recently used measurements if the budget is exceeded.
+        '''
+        with self._lock:
+            self._remove(id(measurement))
+            key = next(self._counter)
+            size = self._get_size(data)
+            self._entries[key] = (size, {})
+            self._size += size
+            self._hold(key, measurement, data)
+            self._evict()
+
+    def share(self, measurement, copy):
+        '''
+        Registers a copy of the measurement that shares its data
+        (if that data is managed by the cache).
+        '''
+        with self._lock:
+            key = self._keys.get(id(measurement))
+            if key is None:
+                return
+            ref, data_id = self._entries[key][1][id(measurement)]
+            if data_id == id(measurement._data) and copy._data is not None:
+                self._remove(id(copy))
+                self._hold(key, copy, copy._data)
+
+    def touch(self, measurement):
+        ''' Marks the data of the measurement as recently used. '''
+        with self._lock:
+            key = self._keys.get(id(measurement))
+            if key is not None:
+                self._entries[key] = self._entries.pop(key)
+
+    def discard(self, measurement):
+        ''' Stops managing the data of the measurement (without dropping it). '''
+        with self._lock:
+            self._remove(id(measurement))
+
+    def clear(self):
+        ''' Drops all the cached data. '''
+        with self._lock:
+            while self._entries:
+                self._drop(next(iter(self._entries)))
+
+    def _hold(self, key, measurement, data):
+        holder = id(measurement)
+        ref = weakref.ref(measurement, lambda ref, holder=holder: self._remove(holder, ref))
+        self._entries[key][1][holder] = (ref, id(data))
+        self._keys[holder] = key
+
+    def _remove(self, holder, ref=None):
+        with self._lock:
+            key = self._keys.get(holder)
+            if key is None:
+                return
+            size, holders = self._entries[key]
+            if ref is not None and holders[holder][0] is not ref:
+                return
+            del holders[holder]
+            del self._keys[holder]
+            if not holders:
+                del self._entries[key]
+                self._size -= size
+
+    def _drop(self, key):
+        for holder, (ref, data_id) in list(self._entries[key][1].items()):
+            self._remove(holder)
+            measurement = ref()
+            if measurement is not None and id(measurement._data) == data_id:
+                measurement._data = None
+
+    def _prune(self):
+        # Forgets the measurements that were assigned other data (e.g., copies made by transform).
+        for key, (size, holders) in list(self._entries.items()):
+            for holder, (ref, data_id) in list(holders.items()):
+                measurement = ref()
+                if measurement is None or id(measurement._data) != data_id:
+                    self._remove(holder)
+
+    def _evict(self):
+        if self._size > self.max_size:
+            self._prune()
+        # The most recently read data is kept even if it exceeds the budget by itself.
+        while self._size > self.max_size and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+
+
+def _get_data_cache(data_cache):
+    if data_cache is None or isinstance(data_cache, DataCache):
+        return data_cache
+    return DataCache(data_cache)
+
+
 class Measurement(BaseObject):
     '''
     A class for holding data from a single measurement, i.e.
     a single well or a single tube.
     '''
+    _data_cache = None
 
     def __init__(self, ID,
                  datafile=None, readdata=False, readdata_kwargs={},
@@ -179,15 +392,78 @@ class Measurement(BaseObject):
         self.history = []
         self.queue = []
 
+    def __deepcopy__(self, memo):
+        from copy import deepcopy
+        # The datafile is shared by copies (it may be a file-like object, which cannot be copied).
+        memo[id(self.datafile)] = self.datafile
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        new.__dict__.update(deepcopy(self.__dict__, memo))
+        return new
+
+    def copy(self, deep=True):
+        """
+        Make a copy of this measurement.
+
+        Parameters
+        ----------
+        deep : boolean, default True
+            Make a deep copy, i.e. also copy the data and metadata
+            (the data file is shared by the copies).
+            If False, the data, metadata and attributes are shared with this measurement.
+
+        Returns
+        -------
+        copy : type of caller
+        """
+        from copy import copy, deepcopy
+        if deep:
+            return deepcopy(self)
+        new = copy(self)
+        if self._data_cache is not None:
+            self._data_cache.share(self, new)
+        return new
+
+    def _copy_sharing_data(self):
+        """
+        Returns a copy of this measurement (with copies of its attributes) that shares
+        its data and metadata.
+
+        For operations that assign new data to the copy rather than modify it in place
+        (transform, gate, ...), so the data is only copied when it changes.
+        Data held by a DataCache remains managed by the cache (see DataCache).
+        """
+        from copy import copy, deepcopy
+        memo = {id(self.datafile): self.datafile}
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        for name, value in self.__dict__.items():
+            if name == '_data' and isinstance(value, DF):
+                value = value.copy(deep=False)
+            elif name in ('_data', '_meta'):
+                value = copy(value)
+            else:
+                value = deepcopy(value, memo)
+            new.__dict__[name] = value
+        if self._data_cache is not None:
+            self._data_cache.share(self, new)
+        return new
+
     def _set_position(self, orderedcollection_id, pos):
         self.position[orderedcollection_id] = pos
 
     @property
     def shape(self):
-        if self.data is None:
+        if self._data is None and not self.queue:
+            # Avoid reading the data when the meta data tells its shape
+            shape = self._get_shape_from_meta()
+            if shape is not None:
+                return shape
+        data = self.data
+        if data is None:
             return None
         else:
-            return self.data.shape
+            return data.shape
 
     def apply_queued(self):
         new = self.copy()
@@ -245,6 +521,8 @@ class Measurement(BaseObject):
         '''
         if data is None:
             data = self.get_data(**kwargs)
+        if self._data_cache is not None:
+            self._data_cache.discard(self)
         setattr(self, '_data', data)
         self.history += self.queue
         self.queue = []
@@ -258,6 +536,19 @@ class Measurement(BaseObject):
             meta = self.get_meta(**kwargs)
         setattr(self, '_meta', meta)
 
+    @classmethod
+    def _set_meta_many(cls, measurements, workers=1, backend='thread'):
+        '''
+        Assign values to the meta of several measurements.
+        Subclasses may read the meta data of the measurements concurrently.
+        '''
+        for measurement in measurements:
+            try:
+                measurement.set_meta()
+            except:
+                msg = 'Error occurred while trying to parse file: %s' % measurement.datafile
+                raise IOError(msg)
+
     def _get_attr_from_file(self, name, **kwargs):
         '''
         return values of attribute of self.
@@ -272,11 +563,20 @@ class Measurement(BaseObject):
             'meta' a 'metafile' attribute will be created).
         '''
         current_value = getattr(self, '_' + name)
+        data_cache = self._data_cache if name == 'data' else None
         if current_value is not None:
             value = current_value
+            if data_cache is not None:
+                data_cache.touch(self)
         else:
             parser_kwargs = getattr(self, 'read%s_kwargs' % name, {})
             value = getattr(self, 'read_%s' % name)(**parser_kwargs)
+            if name == 'meta':
+                # The meta data is small; it is kept once read
+                self._meta = value
+            elif data_cache is not None and value is not None:
+                self._data = value
+                data_cache.add(self, value)
         return value
 
     def get_data(self, **kwargs):
@@ -310,6 +610,16 @@ class Measurement(BaseObject):
         '''
         pass
 
+    def _get_shape_from_meta(self):
+        '''
+        Get the shape of the data from the metadata (without reading the data).
+        Returns None if the shape cannot be told from the metadata.
+
+        This function should be overwritten for each
+        specific data type.
+        '''
+        return None
+
     def ID_from_data(self):
         '''
         Get measurement ID from loaded data.
@@ -366,8 +676,11 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
     A collection of measurements
     '''
     _measurement_class = Measurement  # to be replaced when inheriting
+    data_cache = None
+    _meta_table = None
 
-    def __init__(self, ID, measurements):
+    @doc_replacer
+    def __init__(self, ID, measurements, data_cache=None):
         '''
         A dictionary-like container for holding multiple Measurements.
 
@@ -380,9 +693,11 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
             Collection ID
         measurements : mappable | iterable
             values are measurements of appropriate type (type is explicitly check for).
+        {_bases_data_cache}
         '''
         self.ID = ID
         self.data = {}
+        self.data_cache = _get_data_cache(data_cache)
         if isinstance(measurements, collections.Mapping):
             self.update(measurements)
         else:
@@ -391,7 +706,8 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
 
     @classmethod
     @doc_replacer
-    def from_files(cls, ID, datafiles, parser, readdata_kwargs={}, readmeta_kwargs={}, **ID_kwargs):
+    def from_files(cls, ID, datafiles, parser, readdata_kwargs={}, readmeta_kwargs={},
+                   readmeta=True, workers=1, backend='thread', data_cache=None, **ID_kwargs):
         """
         Create a Collection of measurements from a set of data files.
 
@@ -400,24 +716,25 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
         {_bases_ID}
         {_bases_data_files}
         {_bases_filename_parser}
+        {_bases_readdata_kwargs}
+        {_bases_workers}
+        {_bases_data_cache}
         {_bases_ID_kwargs}
         """
         d = _assign_IDS_to_datafiles(datafiles, parser, cls._measurement_class, **ID_kwargs)
-        measurements = []
-        for sID, dfile in d.iteritems():
-            try:
-                measurements.append(cls._measurement_class(sID, datafile=dfile,
-                                                           readdata_kwargs=readdata_kwargs,
-                                                           readmeta_kwargs=readmeta_kwargs))
-            except:
-                msg = 'Error occurred while trying to parse file: %s' % dfile
-                raise IOError(msg)
-        return cls(ID, measurements)
+        measurements = [cls._measurement_class(sID, datafile=dfile, readmeta=False,
+                                               readdata_kwargs=readdata_kwargs,
+                                               readmeta_kwargs=readmeta_kwargs)
+                        for sID, dfile in d.iteritems()]
+        if readmeta:
+            cls._measurement_class._set_meta_many(measurements, workers=workers, backend=backend)
+        return cls(ID, measurements, data_cache=data_cache)
 
     @classmethod
     @doc_replacer
     def from_dir(cls, ID, datadir, parser, pattern='*.fcs', recursive=False,
-                 readdata_kwargs={}, readmeta_kwargs={}, **ID_kwargs):
+                 readdata_kwargs={}, readmeta_kwargs={}, readmeta=True, workers=1, backend='thread',
+                 data_cache=None, **ID_kwargs):
         """
         Create a Collection of measurements from data files contained in a directory.
 
@@ -432,12 +749,16 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
         recursive : bool
             Recursively look for files matching pattern in subdirectories.
         {_bases_filename_parser}
+        {_bases_readdata_kwargs}
+        {_bases_workers}
+        {_bases_data_cache}
         {_bases_ID_kwargs}
         """
         datafiles = get_files(datadir, pattern, recursive)
         return cls.from_files(ID, datafiles, parser,
                               readdata_kwargs=readdata_kwargs, readmeta_kwargs=readmeta_kwargs,
-                              **ID_kwargs)
+                              readmeta=readmeta, workers=workers, backend=backend,
+                              data_cache=data_cache, **ID_kwargs)
 
     # ----------------------
     # MutableMapping methods
@@ -454,10 +775,47 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
                 type(self), type(self._measurement_class)) +
                    'Encountered type %s.' % type(value))
             raise TypeError(msg)
+        if self.data_cache is not None:
+            value._data_cache = self.data_cache
         self.data[key] = value
+        self._meta_table = None
 
     def __delitem__(self, key):
         del self.data[key]
+        self._meta_table = None
+
+    def copy(self, deep=True):
+        """
+        Make a copy of this collection.
+
+        Parameters
+        ----------
+        deep : boolean, default True
+            Copy the measurements (see Measurement.copy) and the attributes of the collection.
+            If False, they are shared with this collection.
+
+        Returns
+        -------
+        copy : type of caller
+        """
+        if not deep:
+            return super(MeasurementCollection, self).copy(deep=False)
+        new = self._copy_without_measurements()
+        for key, measurement in self.iteritems():
+            new.data[key] = measurement.copy()
+        return new
+
+    def _copy_without_measurements(self):
+        '''
+        Returns a copy of this collection (with copies of its attributes) holding no measurements.
+        '''
+        from copy import deepcopy
+        new = self.__class__.__new__(self.__class__)
+        attrs = dict((k, v) for k, v in self.__dict__.items() if k not in ('data', '_meta_table'))
+        new.__dict__.update(deepcopy(attrs, {id(self): new}))
+        new.data = {}
+        new._meta_table = self._meta_table  # shared, it is not modified
+        return new
 
     def __iter__(self):
         return iter(self.data)
@@ -469,8 +827,8 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
     # User methods
     # ----------------------
     def apply(self, func, ids=None, applyto='measurement', noneval=nan,
-              setdata=False, output_format='dict', ID=None,
-              **kwargs):
+              setdata=False, output_format='dict', ID=None, pool=None,
+              n_jobs=1, backend='thread', chunksize=1, **kwargs):
         '''
         Apply func to each of the specified measurements.
 
@@ -493,6 +851,23 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
             * collection : keeps result as collection
             WARNING: For collection, func should return a copy of the measurement instance rather
             than the original measurement instance.
+        ID : hashable | None
+            ID of the output collection (if output_format='collection').
+            If None, the ID of this collection is used.
+        pool : SharedMemoryPool | None
+            If given, func is applied in the worker processes of the pool,
+            which receive the measurement data through shared memory.
+            func must then be picklable (see FlowCytometryTools.core.sharedmem).
+        n_jobs : int | None
+            Number of measurements processed concurrently (used if no pool is given).
+            None or -1 means all cpus.
+        backend : 'thread' | 'process'
+            * 'thread'  : func is applied in a pool of threads (within this process).
+            * 'process' : func is applied in a temporary SharedMemoryPool
+              (available on all versions of python; before python 3.8 the data is passed
+              through memory mapped files). func must then be picklable.
+        chunksize : int
+            Number of measurements handed to a worker at once.
         Returns
         -------
         Dictionary keyed by measurement keys containing the corresponding output of func
@@ -502,7 +877,28 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
             ids = self.keys()
         else:
             ids = to_list(ids)
-        result = dict((i, self[i].apply(func, applyto, noneval, setdata)) for i in ids)
+        n_jobs = min(_get_n_jobs(n_jobs), len(ids))
+        if pool is not None:
+            outputs = pool.map(func, [self[i] for i in ids], applyto, noneval, setdata, chunksize)
+            result = dict(zip(ids, outputs))
+        elif n_jobs <= 1:
+            result = dict((i, self[i].apply(func, applyto, noneval, setdata)) for i in ids)
+        elif backend == 'thread':
+            from multiprocessing.pool import ThreadPool
+            thread_pool = ThreadPool(n_jobs)
+            try:
+                outputs = thread_pool.map(lambda i: self[i].apply(func, applyto, noneval, setdata),
+                                          ids, chunksize)
+            finally:
+                thread_pool.close()
+            result = dict(zip(ids, outputs))
+        elif backend == 'process':
+            from FlowCytometryTools.core.sharedmem import SharedMemoryPool
+            with SharedMemoryPool(n_jobs) as process_pool:
+                outputs = process_pool.map(func, [self[i] for i in ids], applyto, noneval, setdata, chunksize)
+            result = dict(zip(ids, outputs))
+        else:
+            raise ValueError('Encountered unsupported value "%s" for backend parameter.' % backend)
 
         if output_format == 'collection':
             can_keep_as_collection = all(
@@ -512,15 +908,11 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
                     'Cannot turn output into a collection. The provided func must return results of type {}'.format(
                         self._measurement_class))
 
-            new_collection = self.copy()
-            # Locate IDs to remove
-            ids_to_remove = [x for x in self.keys() if x not in ids]
-            # Remove data for these IDs
-            for ids in ids_to_remove:
-                new_collection.pop(ids)
-            # Update keys with new values
-            for k, v in new_collection.iteritems():
-                new_collection[k] = result[k]
+            # The measurements are all replaced, so they are not copied
+            new_collection = self._copy_without_measurements()
+            for k in self.iterkeys():
+                if k in result:
+                    new_collection[k] = result[k]
             if ID is not None:
                 new_collection.ID = ID
             return new_collection
@@ -535,6 +927,27 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
         fun = lambda x: x.set_data()
         self.apply(fun, ids=ids, applyto='measurement')
 
+    def set_meta(self, ids=None, workers=1, backend='thread'):
+        """
+        Read the meta data of all specified measurements (all if None given)
+        whose meta data has not been read yet.
+
+        Parameters
+        ----------
+        ids : hashable| iterable of hashables | None
+            Keys of measurements whose meta data is read.
+        workers : int
+            Number of measurements whose meta data is read concurrently.
+        backend : 'thread' | 'process'
+            Whether the files are read in a pool of threads or of processes (used if workers > 1).
+        """
+        if ids is None:
+            ids = self.keys()
+        else:
+            ids = to_list(ids)
+        measurements = [self[i] for i in ids if self[i]._meta is None]
+        self._measurement_class._set_meta_many(measurements, workers=workers, backend=backend)
+
     def _clear_measurement_attr(self, attr, ids=None):
         fun = lambda x: setattr(x, attr, None)
         self.apply(fun, ids=ids, applyto='measurement')
@@ -588,10 +1001,36 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
                    "Encountered unsupported value %s." % repr(output_format))
             raise Exception(msg)
 
+    @property
+    def meta_table(self):
+        """
+        A DataFrame holding the meta data of the measurements, with a row per measurement key
+        and a column per (scalar) meta data field. Fields whose values are all numbers are numeric.
+
+        The table is built once, from the meta data of the measurements (their data is not read),
+        and is kept until measurements are added to or removed from the collection.
+        """
+        if self._meta_table is None:
+            rows = {}
+            for key, measurement in self.iteritems():
+                meta = measurement.get_meta()
+                if meta is None:
+                    meta = {}
+                rows[key] = dict((field, value) for field, value in meta.items()
+                                 if isinstance(value, (basestring, numbers.Number)))
+            table = DF.from_dict(rows, orient='index')
+            for field in table.columns:
+                try:
+                    table[field] = table[field].astype(float)
+                except (TypeError, ValueError):
+                    pass
+            self._meta_table = table
+        return self._meta_table
+
     # ----------------------
     # Filtering methods
     # ----------------------
-    def filter(self, criteria, applyto='measurement', ID=None):
+    def filter(self, criteria, applyto='measurement', ID=None, meta=None):
         """
         Filter measurements according to given criteria. 
         Retain only Measurements for which criteria returns True.
@@ -602,14 +1041,19 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
         ----------
         criteria : callable
             Returns bool.
-        applyto : 'measurement' | 'keys' | 'data' | mapping
+        applyto : 'measurement' | 'keys' | 'data' | 'meta' | mapping
              'measurement' : criteria is applied to Measurement objects
              'keys'         : criteria is applied to the keys.
              'data'         : criteria is applied to the Measurement objects' data.
+             'meta'         : criteria is applied to the Measurement objects' meta data.
              mapping        : for each key criteria is applied to mapping value with same key. 
         ID : str
             ID of the filtered collection. 
             If None is given, append '.filterd' to the current sample ID.
+        meta : str | None
+            Query on the meta data of the measurements (see filter_by_meta).
+            It is evaluated first, on the meta data table, so criteria is applied
+            (and data is read) only for the measurements that satisfy it.
              
         Returns
         -------
@@ -617,14 +1061,24 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
         """
         fil = criteria
         new = self.copy()
+        if meta is not None:
+            selected = set(_query_meta_table(self.meta_table, meta))
+            items = [(k, v) for k, v in self.iteritems() if k in selected]
+            for k in self.iterkeys():
+                if k not in selected:
+                    del new[k]
+        else:
+            items = list(self.iteritems())
         if isinstance(applyto, collections.Mapping):
-            remove = (k for k, v in self.iteritems() if not fil(applyto[k]))
+            remove = (k for k, v in items if not fil(applyto[k]))
         elif applyto == 'measurement':
-            remove = (k for k, v in self.iteritems() if not fil(v))
+            remove = (k for k, v in items if not fil(v))
         elif applyto == 'keys':
-            remove = (k for k, v in self.iteritems() if not fil(k))
+            remove = (k for k, v in items if not fil(k))
         elif applyto == 'data':
-            remove = (k for k, v in self.iteritems() if not fil(v.get_data()))
+            remove = (k for k, v in items if not fil(v.get_data()))
+        elif applyto == 'meta':
+            remove = (k for k, v in items if not fil(v.get_meta()))
         else:
             raise ValueError('Unsupported value "%s" for applyto parameter.' % applyto)
         for r in remove:
@@ -658,7 +1112,42 @@ class MeasurementCollection(collections.MutableMapping, BaseObject):
         return self.filter_by_attr('ID', fil, ID)
 
     def filter_by_meta(self, criteria, ID=None):
-        raise NotImplementedError
+        """
+        Keep only Measurements whose meta data satisfies the criteria.
+
+        The criteria is evaluated column-wise on the meta data table (see meta_table),
+        without reading the data of the measurements.
+
+        Parameters
+        ----------
+        criteria : str | callable
+            str : query on the meta data fields, with the syntax of DataFrame.query.
+                  Fields starting with $ may be used as is (e.g., "$CYT == 'LSRII' and $TOT > 5000").
+            callable : accepts the meta data table and returns a boolean Series (indexed like the table).
+        ID : str
+            ID of the filtered collection.
+            If None is given, the ID of this collection is used.
+
+        Returns
+        -------
+        Filtered Collection.
+
+        Examples
+        --------
+        >>> bright = plate.filter_by_meta("$TOT > 5000 and $CYT == 'MACSQuant'")
+        >>> recent = plate.filter_by_meta(lambda table: table['$DATE'].str.endswith('2013'))
+        """
+        table = self.meta_table
+        if isinstance(criteria, basestring):
+            keys = set(_query_meta_table(table, criteria))
+        else:
+            mask = criteria(table)
+            if hasattr(mask, 'reindex'):
+                mask = mask.reindex(table.index).fillna(False)
+            keys = set(table.index[array(mask, dtype=bool)])
+        new = self.filter(lambda key: key in keys, applyto='keys', ID=ID)
+        new._meta_table = table.loc[[k for k in new.iterkeys()]]
+        return new
 
     def filter_by_rows(self, rows, ID=None):
         """
@@ -693,7 +1182,7 @@ class OrderedCollection(MeasurementCollection):
 
     @doc_replacer
     def __init__(self, ID, measurements, position_mapper, shape=(8, 12),
-                 positions=None, row_labels=None, col_labels=None):
+                 positions=None, row_labels=None, col_labels=None, data_cache=None):
         """
         A dictionary-like container for holding multiple Measurements in a 2D array.
 
@@ -716,9 +1205,10 @@ class OrderedCollection(MeasurementCollection):
             If None is given, rows will be labeled 'A','B','C', ...
         col_labels : iterable of str
             If None is given, columns will be labeled 1,2,3, ...
+        {_bases_data_cache}
         """
         ## init the collection
-        super(OrderedCollection, self).__init__(ID, measurements)
+        super(OrderedCollection, self).__init__(ID, measurements, data_cache=data_cache)
         ## set shape-related attributes
         if row_labels is None:
             row_labels = self._default_labels('rows', shape)
@@ -745,7 +1235,8 @@ class OrderedCollection(MeasurementCollection):
     @doc_replacer
     def from_files(cls, ID, datafiles, parser='name',
                    position_mapper=None,
-                   readdata_kwargs={}, readmeta_kwargs={}, ID_kwargs={}, **kwargs):
+                   readdata_kwargs={}, readmeta_kwargs={}, ID_kwargs={},
+                   readmeta=True, workers=1, backend='thread', **kwargs):
         """
         Create an OrderedCollection of measurements from a set of data files.
 
@@ -755,6 +1246,8 @@ class OrderedCollection(MeasurementCollection):
         {_bases_data_files}
         {_bases_filename_parser}
         {_bases_position_mapper}
+        {_bases_readdata_kwargs}
+        {_bases_workers}
         {_bases_ID_kwargs}
         kwargs : dict
             Additional key word arguments to be passed to constructor.
@@ -766,15 +1259,12 @@ class OrderedCollection(MeasurementCollection):
                 msg = "When using a custom parser, you must specify the position_mapper keyword."
                 raise ValueError(msg)
         d = _assign_IDS_to_datafiles(datafiles, parser, cls._measurement_class, **ID_kwargs)
-        measurements = []
-        for sID, dfile in d.iteritems():
-            try:
-                measurements.append(cls._measurement_class(sID, datafile=dfile,
-                                                           readdata_kwargs=readdata_kwargs,
-                                                           readmeta_kwargs=readmeta_kwargs))
-            except:
-                msg = 'Error occured while trying to parse file: %s' % dfile
-                raise IOError(msg)
+        measurements = [cls._measurement_class(sID, datafile=dfile, readmeta=False,
+                                               readdata_kwargs=readdata_kwargs,
+                                               readmeta_kwargs=readmeta_kwargs)
+                        for sID, dfile in d.iteritems()]
+        if readmeta:
+            cls._measurement_class._set_meta_many(measurements, workers=workers, backend=backend)
         return cls(ID, measurements, position_mapper, **kwargs)
 
     @classmethod
@@ -782,7 +1272,8 @@ class OrderedCollection(MeasurementCollection):
     def from_dir(cls, ID, path,
                  parser='name',
                  position_mapper=None, pattern='*.fcs', recursive=False,
-                 readdata_kwargs={}, readmeta_kwargs={}, ID_kwargs={}, **kwargs):
+                 readdata_kwargs={}, readmeta_kwargs={}, ID_kwargs={},
+                 readmeta=True, workers=1, backend='thread', **kwargs):
         """
         Create a Collection of measurements from data files contained in a directory.
 
@@ -797,6 +1288,8 @@ class OrderedCollection(MeasurementCollection):
             Recursively look for files matching pattern in subdirectories.
         {_bases_filename_parser}
         {_bases_position_mapper}
+        {_bases_readdata_kwargs}
+        {_bases_workers}
         {_bases_ID_kwargs}
         kwargs : dict
             Additional key word arguments to be passed to constructor.
@@ -804,7 +1297,8 @@ class OrderedCollection(MeasurementCollection):
         datafiles = get_files(path, pattern, recursive)
         return cls.from_files(ID, datafiles, parser=parser, position_mapper=position_mapper,
                               readdata_kwargs=readdata_kwargs, readmeta_kwargs=readmeta_kwargs,
-                              ID_kwargs=ID_kwargs, **kwargs)
+                              ID_kwargs=ID_kwargs, readmeta=readmeta, workers=workers, backend=backend,
+                              **kwargs)
 
     def set_labels(self, labels, axis='rows'):
         '''
@@ -923,15 +1417,44 @@ class OrderedCollection(MeasurementCollection):
         else:
             return self._positions
 
+    def _get_position_indices(self, ids):
+        '''
+        Get the (row, col) indices of the specified measurements in the layout,
+        as two integer arrays.
+        '''
+        row_index = dict((label, i) for i, label in enumerate(self.row_labels))
+        col_index = dict((label, j) for j, label in enumerate(self.col_labels))
+        positions = [self._positions[k] for k in ids]
+        rows = array([row_index[row] for row, col in positions], dtype=int)
+        cols = array([col_index[col] for row, col in positions], dtype=int)
+        return rows, cols
+
     def _dict2DF(self, d, noneval, dropna=False):
-        df = DF(noneval, index=self.row_labels, columns=self.col_labels, dtype=object)
-        for k, res in d.iteritems():
-            i, j = self._positions[k]
-            df[j][i] = res
-        try:
-            df = df.astype(float)
-        except:
-            pass
+        keys = list(d.keys())
+        values = [d[k] for k in keys]
+        rows, cols = self._get_position_indices(keys)
+        grid = None
+        if all(isinstance(v, numbers.Real) for v in values):
+            try:
+                grid = full(self.shape, noneval, dtype=float)
+            except (TypeError, ValueError):
+                pass
+        if grid is not None:
+            grid[rows, cols] = values
+            df = DF(grid, index=self.row_labels, columns=self.col_labels)
+        else:
+            # Results of any type (e.g., arrays of statistics) are held in the cells
+            cells = empty(len(values), dtype=object)
+            for n, v in enumerate(values):
+                cells[n] = v
+            grid = empty(self.shape, dtype=object)
+            grid.fill(noneval)
+            grid[rows, cols] = cells
+            df = DF(grid, index=self.row_labels, columns=self.col_labels, dtype=object)
+            try:
+                df = df.astype(float)
+            except:
+                pass
         if dropna:
             return df.dropna(axis=0, how='all').dropna(axis=1, how='all')
         else:
@@ -958,7 +1481,8 @@ class OrderedCollection(MeasurementCollection):
 
     def apply(self, func, ids=None, applyto='measurement',
               output_format='DataFrame', noneval=nan,
-              setdata=False, dropna=False, ID=None):
+              setdata=False, dropna=False, ID=None, pool=None,
+              n_jobs=1, backend='thread', chunksize=1):
         """
         Apply func to each of the specified measurements.
 
@@ -984,6 +1508,16 @@ class OrderedCollection(MeasurementCollection):
             ID is used as the new ID for the collection.
             If None, then the old ID is retained.
             Note: Only applicable when output is a collection.
+        pool : SharedMemoryPool | None
+            If given, func is applied in the worker processes of the pool,
+            which receive the measurement data through shared memory.
+        n_jobs : int | None
+            Number of measurements processed concurrently (used if no pool is given).
+            None or -1 means all cpus.
+        backend : 'thread' | 'process'
+            Whether measurements are processed in a pool of threads or in a temporary SharedMemoryPool.
+        chunksize : int
+            Number of measurements handed to a worker at once.
 
         Returns
         -------
@@ -992,7 +1526,8 @@ class OrderedCollection(MeasurementCollection):
         _output = 'collection' if output_format == 'collection' else 'dict'
         result = super(OrderedCollection, self).apply(func, ids, applyto,
                                                       noneval, setdata,
-                                                      output_format=_output)
+                                                      output_format=_output, ID=ID, pool=pool,
+                                                      n_jobs=n_jobs, backend=backend, chunksize=chunksize)
 
         # Note: result should be of type dict or collection for the code
         # below to work
@@ -1076,9 +1611,6 @@ class OrderedCollection(MeasurementCollection):
 
         for ID in ids:
             measurement = self[ID]
-            if not hasattr(measurement, 'data'):
-                continue
-
             row, col = self._positions[ID]
             ax = subplots_ax[col][row]
             pl.sca(ax)  # sets the current axis
@@ -0,0 +1,179 @@
+'''
+Columnar on-disk format for collections of measurements.
+
+A collection saved with format='columnar' is a directory holding:
+
+* manifest.pickle : the collection without its event data, i.e., the IDs and positions
+  of the measurements, their meta data and the history of the operations
+  (transforms, gates, ...) applied to them.
+* a .npy file per measurement, holding its events in native byte order,
+  stored column by column (one column per channel).
+* a .index.npy file for measurements whose events are not numbered 0, 1, 2, ...
+  (e.g., gated measurements).
+
+Loading a collection reads only the manifest. The events of a measurement are
+memory mapped from its file when its data is first accessed.
+'''
+import os
+import pickle
+
+import numpy
+from numpy.lib.format import open_memmap
+from pandas import DataFrame, Index, RangeIndex
+
+from FlowCytometryTools.IO.fcsreader import string_types
+
+_manifest_name = 'manifest.pickle'
+_format_version = 1
+
+
+class ArrayFile(object):
+    '''
+    Base class for files holding events written by FlowCytometryTools
+    (rather than by an instrument), used as the datafile of measurements.
+
+    Subclasses set the columns and shape attributes and implement read.
+    '''
+    columns = None
+    shape = None
+
+    def read(self, channels=None):
+        ''' Returns the events (of the given channels) as a DataFrame. '''
+        raise NotImplementedError
+
+    def iter_chunks(self, chunk_size, channels=None):
+        ''' Iterates over the events in blocks of chunk_size events. '''
+        data = self.read(channels)
+        for start in range(0, data.shape[0], chunk_size):
+            yield data.iloc[start:start + chunk_size]
+
+
+class ColumnarFile(ArrayFile):
+    '''
+    Data file of a measurement saved in a columnar collection directory.
+
+    Used as the datafile of the measurements of a loaded collection.
+    '''
+
+    def __init__(self, name, columns, shape, dtype, index=None, source=None):
+        self.name = name
+        self.columns = columns
+        self.shape = shape
+        self.dtype = dtype
+        self.index = index  # None, 'file' or the values of a non numeric index
+        self.source = source  # the file the data was originally read from (if a path)
+        self.directory = None  # set when the collection is loaded
+
+    def __repr__(self):
+        return '<ColumnarFile {0} {1} {2}>'.format(self.name, self.shape, self.dtype)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.name + '.npy')
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, self.name + '.index.npy')
+
+    def read(self, channels=None, memory_map=True):
+        '''
+        Returns the events (of the given channels) as a DataFrame.
+        If memory_map is True, the DataFrame is backed by a read-only memory map of the file.
+        '''
+        mode = 'r' if memory_map else None
+        values = numpy.load(self.path, mmap_mode=mode)
+        if self.index == 'file':
+            index = Index(numpy.load(self.index_path, mmap_mode=mode))
+        elif self.index is not None:
+            index = Index(self.index)
+        else:
+            index = RangeIndex(self.shape[0])
+        data = DataFrame(values, index=index, columns=self.columns, copy=False)
+        if channels is not None:
+            data = data[list(channels)]
+        return data
+
+    @classmethod
+    def write(cls, data, directory, name, source=None):
+        '''
+        Writes the events held in a DataFrame, one column at a time.
+        '''
+        if data.shape[1]:
+            dtype = numpy.result_type(*data.dtypes).newbyteorder('=')
+        else:
+            dtype = numpy.dtype(numpy.float64)
+        new = cls(name, list(data.columns), data.shape, dtype.str,
+                  source=source if isinstance(source, string_types) else None)
+        new.directory = directory
+
+        values = open_memmap(new.path, mode='w+', dtype=dtype, shape=data.shape, fortran_order=True)
+        for j in range(data.shape[1]):
+            values[:, j] = data.iloc[:, j].values
+        values.flush()
+        del values
+
+        index = data.index
+        if not index.equals(RangeIndex(data.shape[0])):
+            if index.nlevels == 1 and index.dtype.kind in 'iuf':
+                numpy.save(new.index_path, numpy.asarray(index))
+                new.index = 'file'
+            else:
+                new.index = list(index)
+        return new
+
+
+def save_collection(collection, path):
+    '''
+    Saves a collection in the columnar format (see module documentation).
+
+    The data of each measurement (with its queued operations applied) is written
+    to its own file. The queued operations are recorded in the history of the
+    saved measurements.
+    '''
+    path = os.path.abspath(path)
+    for measurement in collection.values():
+        datafile = measurement.datafile
+        if isinstance(datafile, ColumnarFile) and os.path.abspath(datafile.directory) == path:
+            raise ValueError('Cannot save a collection into the directory it was loaded from (%s).' % path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    shell = collection._copy_without_measurements()
+    for n, (key, measurement) in enumerate(collection.iteritems()):
+        new = measurement._copy_sharing_data()
+        data = measurement.get_data()
+        if data is not None:
+            datafile = measurement.datafile
+            if isinstance(datafile, ColumnarFile):
+                datafile = datafile.source
+            new.datafile = ColumnarFile.write(data, path, 'measurement_%d' % n, source=datafile)
+        new._meta = measurement.get_meta()
+        new._data = None
+        new.history = new.history + new.queue
+        new.queue = []
+        shell.data[key] = new
+
+    # The manifest is written last, so that an interrupted save leaves no loadable collection.
+    with open(os.path.join(path, _manifest_name), 'wb') as f:
+        pickle.dump((_format_version, shell), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_collection(path):
+    '''
+    Loads a collection saved in the columnar format.
+    Only the manifest is read; the data of the measurements is memory mapped when first accessed.
+    '''
+    with open(os.path.join(path, _manifest_name), 'rb') as f:
+        version, collection = pickle.load(f)
+    if version > _format_version:
+        raise ValueError('Unsupported columnar format version %s (expected %s or older).' % (version, _format_version))
+    path = os.path.abspath(path)
+    for measurement in collection.values():
+        if isinstance(measurement.datafile, ColumnarFile):
+            measurement.datafile.directory = path
+    return collection
+
+
+def is_columnar(path):
+    ''' Whether the path is a directory holding a collection in the columnar format. '''
+    return os.path.isfile(os.path.join(path, _manifest_name))
@@ -48,6 +48,34 @@ _bases_data_files="""\
 datafiles : str | iterable
     A set of data files containing the measurements.""",
 
+_bases_readdata_kwargs="""\
+readdata_kwargs : dict
+    Keyword arguments passed to the measurements' read_data method.
+    For FCS files these are passed on to parse_fcs, e.g.,
+    readdata_kwargs={{'channels': ['FSC-A', 'SSC-A']}} reads only
+    the listed channels of every file.
+readmeta_kwargs : dict
+    Keyword arguments passed to the measurements' read_meta method.""",
+
+_bases_workers="""\
+readmeta : bool
+    If True, the meta data of the files is read when the collection is created.
+    If False, the meta data of each measurement is read when it is first accessed
+    (the set_meta method of the collection reads it for many measurements at once).
+workers : int
+    Number of files whose meta data is read concurrently.
+    For FCS files the files are parsed with parse_many.
+backend : 'thread' | 'process'
+    Whether the files are read in a pool of threads or of processes (used if workers > 1).""",
+
+_bases_data_cache="""\
+data_cache : None | int | str | DataCache
+    Memory budget for the data the measurements read from their data files (e.g., '4GB').
+    Read data is kept in memory, and the data of the least recently used measurements
+    is dropped (and read again when needed) once the budget is exceeded.
+    Pass a DataCache to share a budget between collections.
+    If None, data is read from the file on every access (unless set with setdata=True).""",
+
 _bases_ID_kwargs="""\
 ID_kwargs: dict
     Additional parameters to be used when assigning IDs.
@@ -94,6 +122,9 @@ use_spln : bool
     See Transformation.transform for more details.
 get_transformer : bool
     If True the transformer is returned in addition to the new Measurement.
+dtype : None | str | numpy.dtype
+    Floating point type of the transformed data (e.g., 'float32').
+    If None, the policy set by FlowCytometryTools.IO.fcsreader.set_dtype_policy is used (float64 by default).
 args :
     Additional positional arguments to be passed to the Transformation.
 kwargs :
@@ -195,7 +226,16 @@ _containers_held_in_memory_warning="""\
     The new Collection will hold the data for **ALL** Measurements in memory!
     When analyzing multiple collections (e.g., multiple 96-well plates), it may be necessary
     to only work one collection at a time. Please refer to the tutorials to see how
-    this can be done."""
+    this can be done.""",
+
+_containers_parallel="""\
+n_jobs : int | None
+    Number of measurements processed concurrently. None or -1 means all cpus.
+backend : 'thread' | 'process'
+    Whether the measurements are processed in a pool of threads or in a temporary SharedMemoryPool.
+pool : SharedMemoryPool | None
+    If given, the measurements are processed in the worker processes of the pool,
+    which receive the event data through shared memory (see FlowCytometryTools.core.sharedmem)."""
 )
 
 
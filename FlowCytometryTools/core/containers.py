@@ -2,11 +2,11 @@ from __future__ import absolute_import
 
 import collections
 import inspect
+from functools import partial
 from itertools import cycle
 from random import sample
 import warnings
 
-from fcsparser import parse as parse_fcs
 from pandas import DataFrame
 import numpy as np
 import matplotlib
@@ -14,12 +14,107 @@ import matplotlib
 from GoreUtilities.util import to_list as to_iter
 from GoreUtilities.graph import plot_ndpanel
 
-from FlowCytometryTools.core.transforms import Transformation
-from FlowCytometryTools.core.bases import Measurement, MeasurementCollection, OrderedCollection, queueable
+from FlowCytometryTools.IO.fcsreader import (parse_fcs, parse_many, FCS_Parser, index_datasets,
+                                              list_zip_members, get_spillover, apply_compensation)
+from FlowCytometryTools.core.transforms import Transformation, get_float_dtype
+from FlowCytometryTools.core.plan import QueuePlan, _transform_params
+from FlowCytometryTools.core.columnar import ArrayFile, save_collection, load_collection, is_columnar
+from FlowCytometryTools.core.store import get_store
+from FlowCytometryTools.core.sharedmem import attrgetter, methodcaller
+from FlowCytometryTools.core.bases import (Measurement, MeasurementCollection, OrderedCollection, queueable,
+                                           _copy_for_update)
 import FlowCytometryTools.core.graph as graph
 from FlowCytometryTools.core.common_doc import doc_replacer
 
 
+def _get_ranges(channel_table, channels):
+    """ Returns the data ranges ($PnR) of the given channels (skipping channels not in the table). """
+    ranges = [channel_table.get(channel, '$PnR') for channel in channels]
+    return [float(r) for r in ranges if r is not None]
+
+
+def _get_subsample_positions(num_events, key, order='random', auto_resize=False):
+    """
+    Returns the positions (a slice or a list) of the events selected by FCMeasurement.subsample
+    out of num_events events.
+    """
+    if isinstance(key, float):
+        if (key > 1.0) or (key < 0.0):
+            raise ValueError('If float, key must be between 0.0 and 1.0')
+        key = int(num_events * key)
+    elif isinstance(key, tuple):
+        all_float = all([isinstance(x, float) for x in key])
+        if (len(key) > 2) or (not all_float):
+            raise ValueError('Tuple must consist of two floats, each between 0.0 and 1.0')
+        start = int(num_events * key[0])
+        stop = int(num_events * key[1])
+        key = slice(start, stop)  # Convert to a slice
+
+    if isinstance(key, slice):
+        if auto_resize:
+            stop = key.stop if key.stop < num_events else num_events
+            start = key.start if key.start < num_events else num_events
+            key = slice(start, stop, key.step)  # Generate new slice
+        return key
+    elif isinstance(key, int):
+        if auto_resize:
+            if key > num_events:
+                key = num_events
+        if key < 1:
+            # EDGE CAES: Must return an empty sample
+            order = 'start'
+        if order == 'random':
+            return sample(range(num_events), key)
+        elif order == 'start':
+            return slice(None, key)
+        elif order == 'end':
+            return slice(-key, None)
+        else:
+            raise ValueError("order must be in ('random', 'start', 'end')")
+    else:
+        raise TypeError("'key' must be of type int, float, tuple or slice.")
+
+
+def _write_to_store(measurement, store, chunk_size):
+    """
+    Returns a copy of the measurement whose data is read from the store.
+    The data (with the queued operations applied) is written to the store one block at a time.
+    Measurements whose data is only held in their data file are copied as is.
+    """
+    new = measurement._copy_sharing_data()
+    if measurement._data is None and not measurement.queue:
+        return new
+    new.datafile = store.write(measurement.iter_chunks(chunk_size))
+    new._data = None
+    new.history = new.history + new.queue
+    new.queue = []
+    return new
+
+
+def _subsample_to_store(measurement, store, chunk_size, key, order='random', auto_resize=False):
+    """
+    Subsamples the measurement (see FCMeasurement.subsample), writing the selected events
+    to the store one block at a time. The events are kept in their original order.
+    """
+    if measurement.queue:
+        measurement = _write_to_store(measurement, store, chunk_size)
+    num_events = measurement.shape[0]
+    positions = np.sort(np.arange(num_events)[_get_subsample_positions(num_events, key, order, auto_resize)])
+
+    def iter_selected():
+        start = 0
+        for chunk in measurement.iter_chunks(chunk_size):
+            stop = start + chunk.shape[0]
+            first, last = np.searchsorted(positions, [start, stop])
+            yield chunk.iloc[positions[first:last] - start]
+            start = stop
+
+    new = measurement._copy_sharing_data()
+    new.datafile = store.write(iter_selected())
+    new._data = None
+    return new
+
+
 def to_list(obj):
     """ This is a quick fix to make sure indexing of DataFrames
     takes place with lists instead of tuples. """
@@ -33,11 +128,57 @@ class FCMeasurement(Measurement):
     """
     A class for holding flow cytometry data from
     a single well or a single tube.
+
+    The datafile can be a path, a ZipMember (a file in a zip archive), bytes or
+    a seekable binary file-like object (see parse_fcs).
+
+    The readdata_kwargs are passed to parse_fcs when reading the data.
+    For example, readdata_kwargs={'channels': ['FSC-A', 'SSC-A']} decodes
+    only these two channels from the DATA segment of the file, and
+    readdata_kwargs={'cache': ParseCache(directory)} reopens the file from
+    a persistent parse cache (see FlowCytometryTools.IO.fcsreader.enable_parse_cache).
+    readdata_kwargs={'dtype': 'float32'} holds the events in single precision
+    (see also FlowCytometryTools.IO.fcsreader.set_dtype_policy).
     """
 
+    def apply_queued(self):
+        '''
+        Applies the queued operations (see explain), fusing consecutive gates,
+        transforms and compensations into single passes over the data.
+
+        Returns
+        -------
+        FCMeasurement
+            New measurement holding the resulting data.
+        '''
+        return QueuePlan(self).execute()
+
+    def explain(self):
+        '''
+        Describes how the queued operations (operations called with apply_now=False)
+        will be applied, with their estimated costs.
+
+        Returns
+        -------
+        str
+
+        Examples
+        --------
+        >>> queued = sample.transform('hlog', channels=['FITC-A'], use_spln=False, apply_now=False)
+        >>> print(queued.gate(fsc_gate, apply_now=False).explain())
+        '''
+        return QueuePlan(self).explain()
+
     @property
     def channels(self):
         """ A DataFrame containing complete channel information """
+        table = self.channel_table
+        if table is not None:
+            return table.to_frame()
+
+    @property
+    def channel_table(self):
+        """ The channel information as a ChannelTable (see FlowCytometryTools.IO.fcsreader.ChannelTable). """
         if self.meta is not None:
             return self.meta['_channels_']
 
@@ -56,6 +197,9 @@ class FCMeasurement(Measurement):
         It's advised not to use this method, but instead to access
         the data through the FCMeasurement.data attribute.
         '''
+        if isinstance(self.datafile, ArrayFile):
+            # Written by FlowCytometryTools (e.g., FCCollection.save(format='columnar'))
+            return self.datafile.read(to_list(kwargs.get('channels')))
         meta, data = parse_fcs(self.datafile, **kwargs)
         return data
 
@@ -66,16 +210,140 @@ class FCMeasurement(Measurement):
         It's advised not to use this method, but instead to access
         the meta data through the FCMeasurement.meta attribute.
         '''
+        meta = parse_fcs(self.datafile,
+                         reformat_meta=True,
+                         meta_data_only=True, **self._get_readmeta_kwargs(**kwargs))
+        return meta
+
+    def _get_readmeta_kwargs(self, **kwargs):
+        '''
+        Keyword arguments for parsing the meta data of the datafile.
+        '''
         # TODO Try to rewrite the code to be more logical
         # The reason the equivalent statement is not in the read_data method
         # above is because self.readdata_kwargs are passed
         # as **kwargs to the read_data function.
-        if 'channel_naming' in self.readdata_kwargs:
-            kwargs['channel_naming'] = self.readdata_kwargs['channel_naming']
-        meta = parse_fcs(self.datafile,
-                         reformat_meta=True,
-                         meta_data_only=True, **kwargs)
-        return meta
+        for key in ('channel_naming', 'dataset'):
+            if key in self.readdata_kwargs:
+                kwargs[key] = self.readdata_kwargs[key]
+        return kwargs
+
+    @classmethod
+    def _set_meta_many(cls, measurements, workers=1, backend='thread'):
+        '''
+        Reads the meta data of several measurements concurrently (see parse_many).
+        '''
+        if workers <= 1:
+            return super(FCMeasurement, cls)._set_meta_many(measurements)
+        # Measurements that are parsed with the same arguments are parsed together
+        groups = {}
+        for measurement in measurements:
+            kwargs = measurement._get_readmeta_kwargs(**measurement.readmeta_kwargs)
+            groups.setdefault(repr(sorted(kwargs.items())), (kwargs, []))[1].append(measurement)
+
+        for kwargs, group in groups.values():
+            paths = [measurement.datafile for measurement in group]
+            metas = parse_many(paths, workers=workers, backend=backend, errors='return',
+                               reformat_meta=True, meta_data_only=True, **kwargs)
+            for measurement, meta in zip(group, metas):
+                if isinstance(meta, Exception):
+                    msg = 'Error occurred while trying to parse file: %s' % measurement.datafile
+                    raise IOError(msg)
+                measurement.set_meta(meta)
+
+    def iter_chunks(self, chunk_size=100000, channels=None):
+        '''
+        Iterates over the events of the measurement in blocks of fixed size.
+
+        If the data is not held in memory, the blocks are streamed from the
+        DATA segment of the file (or from the store of an FCDiskCollection),
+        so only one block is in memory at a time.
+        Queued operations (e.g., gates) are applied to each block separately.
+        The splines of queued transforms are fitted to the range of all the events
+        beforehand, so the blocks do not depend on chunk_size.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of events in each block (the last block may be smaller).
+        channels : None | str | list of str
+            Channels to read. If None, the channels in readdata_kwargs are used (all by default).
+
+        Yields
+        ------
+        DataFrame holding a block of events.
+
+        Examples
+        --------
+        >>> total = sum(len(chunk) for chunk in sample.iter_chunks(10**6))
+        '''
+        if channels is not None:
+            channels = to_list(channels)
+
+        if self._data is not None:
+            data = self._data
+            if channels is not None:
+                data = data[channels]
+            chunks = (data.iloc[start:start + chunk_size] for start in range(0, data.shape[0], chunk_size))
+        else:
+            if channels is None:
+                channels = self.readdata_kwargs.get('channels')
+            if isinstance(self.datafile, ArrayFile):
+                chunks = self.datafile.iter_chunks(chunk_size, channels)
+            else:
+                parser = FCS_Parser(self.datafile, read_data=False,
+                                    channel_naming=self.readdata_kwargs.get('channel_naming', '$PnS'),
+                                    dataset=self.readdata_kwargs.get('dataset', 0))
+                chunks = parser.iter_events(chunk_size, channels=channels, output_format='DataFrame',
+                                            dtype=self.readdata_kwargs.get('dtype'))
+
+        if self.queue:
+            shell = self._copy_sharing_data()
+            shell.queue = self._fit_queued_splines(chunk_size)
+        for chunk in chunks:
+            if self.queue:
+                shell._data = chunk
+                chunk = shell.apply_queued().get_data()
+            yield chunk
+
+    def _fit_queued_splines(self, chunk_size=100000):
+        '''
+        Returns the queue, with each queued transform that uses a spline (use_spln=True)
+        replaced by a transform whose spline is fitted to the range of all the events it applies to.
+
+        The range is found by iterating over the events in blocks, so the queue can then be
+        applied block by block with the same result as when applied to all the events at once.
+        '''
+        queue = list(self.queue)
+        for i, (name, params) in enumerate(queue):
+            transform = params.get('transform')
+            if (name != 'transform' or not params.get('use_spln', True) or
+                    (isinstance(transform, Transformation) and transform.spln is not None)):
+                continue
+            shell = self._copy_sharing_data()
+            shell.queue = queue[:i]
+            channels = to_list(params.get('channels'))
+            xmin, xmax = np.inf, -np.inf
+            for chunk in shell.iter_chunks(chunk_size):
+                if channels is None:
+                    channels = list(chunk.columns)
+                if chunk.shape[0]:
+                    values = chunk[channels].values
+                    xmin, xmax = min(xmin, values.min()), max(xmax, values.max())
+            if xmin > xmax:
+                continue  # no events
+            kwargs = dict((k, v) for k, v in params.items() if k not in _transform_params)
+            transformer = self._get_transformer(transform, params.get('direction', 'forward'), channels,
+                                                params.get('auto_range', True), params.get('args', ()), kwargs)
+            if transformer is transform:
+                transformer = transformer.copy()  # the transformation may be shared
+            # The range is cast as the transformed values are (see Transformation.transform)
+            xmin, xmax = np.asarray([xmin, xmax], dtype=get_float_dtype(params.get('dtype')))
+            transformer.set_spline(xmin, xmax)
+            params = dict((k, v) for k, v in params.items() if k in _transform_params)
+            params['transform'] = transformer
+            queue[i] = (name, params)
+        return queue
 
     def get_meta_fields(self, fields, kwargs={}):
         '''
@@ -241,7 +509,7 @@ class FCMeasurement(Measurement):
     def transform(self, transform, direction='forward',
                   channels=None, return_all=True, auto_range=True,
                   use_spln=True, get_transformer=False, ID=None,
-                  apply_now=True,
+                  apply_now=True, dtype=None,
                   args=(), **kwargs):
         """
         Applies a transformation to the specified channels.
@@ -269,42 +537,18 @@ class FCMeasurement(Measurement):
         {FCMeasurement_transform_examples}
         """
         # Create new measurement
-        new = self.copy()
+        new = self._copy_sharing_data()
         data = new.data
 
         channels = to_list(channels)
         if channels is None:
             channels = data.columns
         ## create transformer
-        if isinstance(transform, Transformation):
-            transformer = transform
-        else:
-            if auto_range:  # determine transformation range
-                if 'd' in kwargs:
-                    warnings.warn(
-                        'Encountered both auto_range=True and user-specified range value in '
-                        'parameter d.\n Range value specified in parameter d is used.')
-                else:
-                    channel_meta = self.channels
-                    # the -1 below because the channel numbers begin from 1 instead of 0
-                    # (this is fragile code)
-                    ranges = [float(r['$PnR']) for i, r in channel_meta.iterrows() if
-                              self.channel_names[i - 1] in channels]
-                    if not np.allclose(ranges, ranges[0]):
-                        raise Exception("""Not all specified channels have the same data range,
-                            therefore they cannot be transformed together.\n
-                            HINT: Try transforming one channel at a time.
-                            You'll need to provide the name of the channel in the transform.""")
-
-                    if transform in {'hlog', 'tlog', 'hlog_inv', 'tlog_inv'}:
-                        # Hacky fix to make sure that 'd' is provided only
-                        # for hlog / tlog transformations
-                        kwargs['d'] = np.log10(ranges[0])
-            transformer = Transformation(transform, direction, args, **kwargs)
+        transformer = self._get_transformer(transform, direction, channels, auto_range, args, kwargs)
         ## create new data
-        transformed = transformer(data[channels], use_spln)
+        transformed = transformer(data[channels], use_spln, dtype=dtype)
         if return_all:
-            new_data = data
+            new_data = _copy_for_update(data)
         else:
             new_data = data.filter(channels)
         new_data[channels] = transformed
@@ -318,6 +562,32 @@ class FCMeasurement(Measurement):
         else:
             return new
 
+    def _get_transformer(self, transform, direction, channels, auto_range, args, kwargs):
+        '''
+        Returns the Transformation used by transform for the given channels.
+        Note that kwargs may be updated (with the range of the channels).
+        '''
+        if isinstance(transform, Transformation):
+            return transform
+        if auto_range:  # determine transformation range
+            if 'd' in kwargs:
+                warnings.warn(
+                    'Encountered both auto_range=True and user-specified range value in '
+                    'parameter d.\n Range value specified in parameter d is used.')
+            else:
+                ranges = _get_ranges(self.channel_table, channels)
+                if not np.allclose(ranges, ranges[0]):
+                    raise Exception("""Not all specified channels have the same data range,
+                        therefore they cannot be transformed together.\n
+                        HINT: Try transforming one channel at a time.
+                        You'll need to provide the name of the channel in the transform.""")
+
+                if transform in {'hlog', 'tlog', 'hlog_inv', 'tlog_inv'}:
+                    # Hacky fix to make sure that 'd' is provided only
+                    # for hlog / tlog transformations
+                    kwargs['d'] = np.log10(ranges[0])
+        return Transformation(transform, direction, args, **kwargs)
+
     @doc_replacer
     def subsample(self, key, order='random', auto_resize=False):
         """
@@ -334,49 +604,13 @@ class FCMeasurement(Measurement):
         """
 
         data = self.get_data()
-        num_events = data.shape[0]
-
-        if isinstance(key, float):
-            if (key > 1.0) or (key < 0.0):
-                raise ValueError('If float, key must be between 0.0 and 1.0')
-            key = int(num_events * key)
-        elif isinstance(key, tuple):
-            all_float = all([isinstance(x, float) for x in key])
-            if (len(key) > 2) or (not all_float):
-                raise ValueError('Tuple must consist of two floats, each between 0.0 and 1.0')
-            start = int(num_events * key[0])
-            stop = int(num_events * key[1])
-            key = slice(start, stop)  # Convert to a slice
-
         try:
-            if isinstance(key, slice):
-                if auto_resize:
-                    stop = key.stop if key.stop < num_events else num_events
-                    start = key.start if key.start < num_events else num_events
-                    key = slice(start, stop, key.step)  # Generate new slice
-                newdata = data.iloc[key]
-            elif isinstance(key, int):
-                if auto_resize:
-                    if key > num_events:
-                        key = num_events
-                if key < 1:
-                    # EDGE CAES: Must return an empty sample
-                    order = 'start'
-                if order == 'random':
-                    newdata = data.loc[sample(data.index, key)]  # Use loc not iloc here!!
-                elif order == 'start':
-                    newdata = data.iloc[:key]
-                elif order == 'end':
-                    newdata = data.iloc[-key:]
-                else:
-                    raise ValueError("order must be in ('random', 'start', 'end')")
-            else:
-                raise TypeError("'key' must be of type int, float, tuple or slice.")
+            newdata = data.iloc[_get_subsample_positions(data.shape[0], key, order, auto_resize)]
         except IndexError:
             print("If you're encountering an out-of-bounds error, "
                   "try to setting 'auto_resize' to True.")
             raise
-        newsample = self.copy()
+        newsample = self._copy_sharing_data()
         newsample.set_data(data=newdata)
         return newsample
 
@@ -398,15 +632,114 @@ class FCMeasurement(Measurement):
         '''
         data = self.get_data()
         newdata = gate(data)
-        newsample = self.copy()
+        newsample = self._copy_sharing_data()
         newsample.data = newdata
         return newsample
 
+    @queueable
+    def compensate(self, spillover=None, ID=None, apply_now=True):
+        '''
+        Compensates the fluorescence channels for the spillover between them.
+
+        All the events are compensated with a single product with the inverse
+        of the spillover matrix. The inverse is computed once per distinct matrix
+        and shared between measurements (see FlowCytometryTools.IO.fcsreader.apply_compensation).
+
+        Parameters
+        ----------
+        spillover : None | DataFrame | (list of str, array)
+            Spillover matrix, with its rows and columns labeled by channel names.
+            If None, the matrix stored in the FCS file ($SPILLOVER, $SPILL or SPILL) is used.
+        ID : hashable | None
+            ID for the resulting measurement. If None is passed, the original ID is used.
+
+        Returns
+        -------
+        FCMeasurement
+            New measurement holding the compensated data.
+
+        Examples
+        --------
+        >>> compensated = sample.compensate().transform('hlog', channels=['FITC-A', 'PE-A'])
+        '''
+        new = self._copy_sharing_data()
+        data = _copy_for_update(new.data)
+        self._compensate_data(data, spillover)
+        new.data = data
+
+        if ID is not None:
+            new.ID = ID
+        return new
+
+    def _get_spillover(self, spillover=None):
+        '''
+        Returns the spillover matrix used by compensate, as a 2-tuple (channel names, matrix).
+        '''
+        if spillover is None:
+            spillover = get_spillover(self.get_meta())
+            if spillover is None:
+                raise ValueError('No spillover matrix was found in the meta data of measurement %s.' % self.ID)
+        elif isinstance(spillover, DataFrame):
+            spillover = (list(spillover.index), spillover.values)
+        return spillover
+
+    def _compensate_data(self, data, spillover=None):
+        '''
+        Compensates the data (in place). Returns the compensated columns.
+        '''
+        names, matrix = self._get_spillover(spillover)
+        columns = [self._get_channel_column(name, data.columns) for name in names]
+        compensated = apply_compensation(data[columns].values, matrix)
+        for j, column in enumerate(columns):
+            data[column] = compensated[:, j]
+        return columns
+
+    def _get_channel_column(self, name, columns):
+        '''
+        Returns the column of the data holding the given channel, which may be named
+        with either naming convention ($PnS or $PnN).
+        '''
+        if name in columns:
+            return name
+        table = self.channel_table
+        position = table.position(name) if table is not None else None
+        if position is not None:
+            column = self.channel_names[position]
+            if column in columns:
+                return column
+        raise ValueError("Channel '%s' was not found in the data of measurement %s." % (name, self.ID))
+
+    def _get_shape_from_meta(self):
+        '''
+        Returns the shape of the data given by the TEXT segment ($TOT events),
+        or None if the data must be read to tell it.
+        '''
+        if self.datafile is None:
+            return None
+        channels = self.readdata_kwargs.get('channels')
+        if isinstance(self.datafile, ArrayFile):
+            num_events, num_channels = self.datafile.shape
+            if channels is not None:
+                num_channels = len(to_list(channels))
+            return num_events, num_channels
+        try:
+            num_events = int(self.get_meta()['$TOT'])
+            if channels is None:
+                num_channels = len(self.channel_names)
+            else:
+                num_channels = len(to_list(channels))
+        except (KeyError, TypeError, ValueError):
+            return None
+        return num_events, num_channels
+
     @property
     def counts(self):
-        """ Returns total number of events. """
-        data = self.get_data()
-        return data.shape[0]
+        """
+        Returns total number of events.
+        If the data is not in memory and no operations are queued, the count is read from
+        the meta data ($TOT), without reading the data.
+        """
+        return self.shape[0]
 
 
 class FCCollection(MeasurementCollection):
@@ -415,11 +748,90 @@ class FCCollection(MeasurementCollection):
     '''
     _measurement_class = FCMeasurement
 
+    @classmethod
+    @doc_replacer
+    def from_datasets(cls, ID, path, readdata_kwargs={}, readmeta_kwargs={}, readmeta=True,
+                      data_cache=None):
+        '''
+        Create a Collection from the data sets stored in a single FCS file.
+
+        The chain of data sets ($NEXTDATA) is walked once to index them.
+        Each data set becomes a measurement (keyed by its index in the file)
+        whose data is read on demand, without reading the other data sets.
+
+        Parameters
+        ----------
+        ID : hashable
+            Collection ID
+        path : str
+            Path of the FCS file.
+        readdata_kwargs : dict
+            Additional keyword arguments passed to parse_fcs when reading the data.
+        readmeta_kwargs : dict
+            Additional keyword arguments passed to parse_fcs when reading the meta data.
+        readmeta : bool
+            If False, the meta data of each data set is read when it is first accessed.
+        {_bases_data_cache}
+
+        Examples
+        --------
+        >>> collection = FCCollection.from_datasets('run', 'multi_dataset.fcs')
+        >>> collection[1].data  # Reads only the DATA segment of the second data set
+        '''
+        datasets = index_datasets(path)
+        measurements = []
+        for i in range(len(datasets)):
+            kwargs = dict(readdata_kwargs)
+            kwargs['dataset'] = i
+            measurements.append(cls._measurement_class(i, datafile=path,
+                                                       readdata_kwargs=kwargs, readmeta=readmeta,
+                                                       readmeta_kwargs=readmeta_kwargs))
+        return cls(ID, measurements, data_cache=data_cache)
+
+    def save(self, path, format='pickle'):
+        '''
+        Save the collection.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file (format='pickle') or directory (format='columnar') to write.
+        format : 'pickle' | 'columnar'
+            * 'pickle' : pickle the collection, including any data held in memory.
+            * 'columnar' : write a directory holding a manifest (IDs, positions, meta data,
+              history of the measurements) and the data of each measurement in its own file.
+              The queued operations are applied before the data is written.
+              See FlowCytometryTools.core.columnar for details.
+
+        Examples
+        --------
+        >>> plate.transform('hlog').save('plate_hlog', format='columnar')
+        >>> plate = FCOrderedCollection.load('plate_hlog')
+        '''
+        if format == 'pickle':
+            super(FCCollection, self).save(path)
+        elif format == 'columnar':
+            save_collection(self, path)
+        else:
+            raise ValueError("format must be 'pickle' or 'columnar' (got %s)." % format)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a collection saved with the save method.
+
+        Collections saved in the columnar format are loaded lazily: only the manifest
+        is read, and the data of each measurement is memory mapped when first accessed.
+        '''
+        if is_columnar(path):
+            return load_collection(path)
+        return super(FCCollection, cls).load(path)
+
     @doc_replacer
     def transform(self, transform, direction='forward', share_transform=True,
                   channels=None, return_all=True, auto_range=True,
                   use_spln=True, get_transformer=False, ID=None,
-                  apply_now=True,
+                  apply_now=True, dtype=None, n_jobs=1, backend='thread', pool=None,
                   args=(), **kwargs):
         '''
         Apply transform to each Measurement in the Collection.
@@ -433,6 +845,7 @@ class FCCollection(MeasurementCollection):
         {FCMeasurement_transform_pars}
         ID : hashable | None
             ID for the resulting collection. If None is passed, the original ID is used.
+        {_containers_parallel}
 
         Returns
         -------
@@ -446,9 +859,8 @@ class FCCollection(MeasurementCollection):
         --------
         {FCMeasurement_transform_examples}
         '''
-        new = self.copy()
         if share_transform:
-            channel_meta = self.values()[0].channels
+            channel_table = self.values()[0].channel_table
             channel_names = self.values()[0].channel_names
             if channels is None:
                 channels = list(channel_names)
@@ -464,9 +876,7 @@ class FCCollection(MeasurementCollection):
                                       'value in parameter d.\n '
                                       'Range value specified in parameter d is used.')
                     else:
-                        # the -1 below because the channel numbers begin from 1 instead of 0 (this is fragile code)
-                        ranges = [float(r['$PnR']) for i, r in channel_meta.iterrows() if
-                                  channel_names[i - 1] in channels]
+                        ranges = _get_ranges(channel_table, channels)
 
                         if not np.allclose(ranges, ranges[0]):
                             raise Exception('Not all specified channels have the same '
@@ -479,28 +889,33 @@ class FCCollection(MeasurementCollection):
                             kwargs['d'] = np.log10(ranges[0])
                 transformer = Transformation(transform, direction, args, **kwargs)
                 if use_spln:
-                    xmax = self.apply(lambda x: x[channels].max().max(), applyto='data').max().max()
-                    xmin = self.apply(lambda x: x[channels].min().min(), applyto='data').min().min()
-                    transformer.set_spline(xmin, xmax)
-            ## transform all measurements     
-            for k, v in new.iteritems():
-                new[k] = v.transform(transformer, channels=channels, return_all=return_all,
-                                     use_spln=use_spln, apply_now=apply_now)
+                    transformer.set_spline(*self._get_data_range(channels))
+            func = methodcaller('transform', transformer, channels=channels, return_all=return_all,
+                                use_spln=use_spln, apply_now=apply_now, dtype=dtype)
         else:
-            for k, v in new.iteritems():
-                new[k] = v.transform(transform, direction=direction, channels=channels,
-                                     return_all=return_all, auto_range=auto_range,
-                                     get_transformer=False,
-                                     use_spln=use_spln, apply_now=apply_now, args=args, **kwargs)
-        if ID is not None:
-            new.ID = ID
+            func = methodcaller('transform', transform, direction=direction, channels=channels,
+                                return_all=return_all, auto_range=auto_range,
+                                get_transformer=False,
+                                use_spln=use_spln, apply_now=apply_now, dtype=dtype,
+                                args=args, **kwargs)
+        ## transform all measurements
+        new = self.apply(func, output_format='collection', ID=ID,
+                         n_jobs=n_jobs, backend=backend, pool=pool)
         if share_transform and get_transformer:
             return new, transformer
         else:
             return new
 
+    def _get_data_range(self, channels):
+        '''
+        Returns the minimum and maximum of the data of the given channels over all the measurements.
+        '''
+        xmin = self.apply(lambda x: x[channels].min().min(), applyto='data', output_format='dict')
+        xmax = self.apply(lambda x: x[channels].max().max(), applyto='data', output_format='dict')
+        return np.nanmin(list(xmin.values())), np.nanmax(list(xmax.values()))
+
     @doc_replacer
-    def gate(self, gate, ID=None, apply_now=True):
+    def gate(self, gate, ID=None, apply_now=True, n_jobs=1, backend='thread', pool=None):
         '''
         Applies the gate to each Measurement in the Collection, returning a new Collection with gated data.
 
@@ -512,15 +927,36 @@ class FCCollection(MeasurementCollection):
 
         ID : [ str, numeric, None]
             New ID to be given to the output. If None, the ID of the current collection will be used.
+        {_containers_parallel}
         '''
+        func = methodcaller('gate', gate, apply_now=apply_now)
+        return self.apply(func, output_format='collection', ID=ID,
+                          n_jobs=n_jobs, backend=backend, pool=pool)
 
-        def func(well):
-            return well.gate(gate, apply_now=apply_now)
+    @doc_replacer
+    def compensate(self, spillover=None, ID=None, apply_now=True, n_jobs=1, backend='thread', pool=None):
+        '''
+        Compensates each Measurement in the Collection, returning a new Collection with compensated data.
 
-        return self.apply(func, output_format='collection', ID=ID)
+        The inverse of the spillover matrix is computed once for each distinct matrix,
+        and shared by all the measurements acquired with it.
+
+        Parameters
+        ----------
+        spillover : None | DataFrame | (list of str, array)
+            Spillover matrix applied to all the measurements.
+            If None, each measurement uses the matrix stored in its FCS file.
+        ID : hashable | None
+            New ID to be given to the output. If None, the ID of the current collection will be used.
+        {_containers_parallel}
+        '''
+        func = methodcaller('compensate', spillover, apply_now=apply_now)
+        return self.apply(func, output_format='collection', ID=ID,
+                          n_jobs=n_jobs, backend=backend, pool=pool)
 
     @doc_replacer
-    def subsample(self, key, order='random', auto_resize=False, ID=None):
+    def subsample(self, key, order='random', auto_resize=False, ID=None,
+                  n_jobs=1, backend='thread', pool=None):
         """
         Allows arbitrary slicing (subsampling) of the data.
 
@@ -532,22 +968,26 @@ class FCCollection(MeasurementCollection):
         Parameters
         ----------
         {FCMeasurement_subsample_parameters}
+        {_containers_parallel}
 
         Returns
         -------
         FCCollection or a subclass
             new collection of subsampled event data.
         """
+        func = methodcaller('subsample', key=key, order=order, auto_resize=auto_resize)
+        return self.apply(func, output_format='collection', ID=ID,
+                          n_jobs=n_jobs, backend=backend, pool=pool)
 
-        def func(well):
-            return well.subsample(key=key, order=order, auto_resize=auto_resize)
-
-        return self.apply(func, output_format='collection', ID=ID)
-
-    def counts(self, ids=None, setdata=False, output_format='DataFrame'):
+    @doc_replacer
+    def counts(self, ids=None, setdata=False, output_format='DataFrame',
+               n_jobs=1, backend='thread', pool=None):
         """
         Return the counts in each of the specified measurements.
 
+        The counts of measurements whose data is not in memory (and that have no
+        queued operations) are read from the meta data ($TOT) without reading the data.
+
         Parameters
         ----------
         ids : [hashable | iterable of hashables | None]
@@ -558,13 +998,209 @@ class FCCollection(MeasurementCollection):
             Used only if data is not already set.
         output_format : DataFrame | dict
             Specifies the output format for that data.
+        {_containers_parallel}
 
         Returns
         -------
         [DataFrame | Dictionary]
             Dictionary keys correspond to measurement keys.
         """
-        return self.apply(lambda x: x.counts, ids=ids, setdata=setdata, output_format=output_format)
+        return self.apply(attrgetter('counts'), ids=ids, setdata=setdata, output_format=output_format,
+                          n_jobs=n_jobs, backend=backend, pool=pool)
+
+
+class FCDiskCollection(FCCollection):
+    '''
+    An FCCollection whose measurement data is kept on disk rather than in memory.
+
+    The results of transform, gate, compensate and subsample are written to an on-disk store
+    one block of events at a time, so only a block of events per measurement is held in memory
+    while they are computed. Analyses of collections whose data does not fit in memory can thus
+    be run. The data of a measurement is read from the store when it is accessed.
+    '''
+
+    @doc_replacer
+    def __init__(self, ID, measurements, store=None, chunk_size=100000, data_cache=None):
+        '''
+        Parameters
+        ----------
+        ID : hashable
+            Collection ID
+        measurements : mappable | iterable
+            values are measurements of appropriate type (type is explicitly check for).
+        store : None | str | MemmapStore | HDF5Store
+            Where the data is written (see FlowCytometryTools.core.store).
+
+            * None : memory mapped files in a temporary directory (removed when python exits).
+            * str ending with .h5, .hdf5 or .hdf : an HDF5 file (requires PyTables).
+            * str : memory mapped files in the given directory.
+        chunk_size : int
+            Number of events of a measurement processed at a time.
+        {_bases_data_cache}
+        '''
+        super(FCDiskCollection, self).__init__(ID, measurements, data_cache=data_cache)
+        self.store = get_store(store)
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_collection(cls, collection, store=None, chunk_size=100000, ID=None):
+        '''
+        Create an FCDiskCollection holding the measurements of a collection.
+
+        The data that the measurements hold in memory, and the results of their queued
+        operations, are written to the store.
+
+        Parameters
+        ----------
+        collection : FCCollection
+        store : None | str | MemmapStore | HDF5Store
+            See FCDiskCollection.
+        chunk_size : int
+            Number of events of a measurement processed at a time.
+        ID : hashable | None
+            ID of the new collection. If None, the ID of the collection is used.
+
+        Examples
+        --------
+        >>> plate = FCPlate.from_dir('plate', 'plate1/')
+        >>> campaign = FCDiskCollection.from_collection(plate, store='campaign_store')
+        >>> gated = campaign.transform('hlog', channels=['FSC-A', 'SSC-A']).gate(gate)
+        '''
+        measurements = collections.OrderedDict((key, measurement._copy_sharing_data())
+                                               for key, measurement in collection.iteritems())
+        new = cls(collection.ID if ID is None else ID, measurements, store=store,
+                  chunk_size=chunk_size, data_cache=collection.data_cache)
+        return new.store_data()
+
+    def store_data(self, n_jobs=1):
+        '''
+        Returns a new collection whose measurements read their data from the store.
+
+        The data of the measurements that hold data in memory or have queued operations
+        is written to the store (with the queued operations applied) one block at a time.
+
+        Parameters
+        ----------
+        n_jobs : int | None
+            Number of measurements written concurrently (in threads). None or -1 means all cpus.
+        '''
+        func = partial(_write_to_store, store=self.store, chunk_size=self.chunk_size)
+        return self.apply(func, output_format='collection', n_jobs=n_jobs)
+
+    def _get_data_range(self, channels):
+        xmin, xmax = np.inf, -np.inf
+        for measurement in self.values():
+            for chunk in measurement.iter_chunks(self.chunk_size, channels=channels):
+                if chunk.shape[0]:
+                    xmin = min(xmin, np.nanmin(chunk.values))
+                    xmax = max(xmax, np.nanmax(chunk.values))
+        return xmin, xmax
+
+    @doc_replacer
+    def transform(self, transform, direction='forward', share_transform=True,
+                  channels=None, return_all=True, auto_range=True,
+                  use_spln=True, get_transformer=False, ID=None,
+                  apply_now=True, dtype=None, n_jobs=1, args=(), **kwargs):
+        '''
+        Apply transform to each Measurement in the Collection,
+        writing the transformed data to the store.
+
+        When use_spln=True and share_transform=False, the spline of each
+        measurement is fitted to the range of all its events before they are
+        transformed block by block, so the result does not depend on chunk_size.
+
+        Parameters
+        ----------
+        {FCMeasurement_transform_pars}
+        ID : hashable | None
+            ID for the resulting collection. If None is passed, the original ID is used.
+        apply_now : bool
+            If False, the transform is queued and applied when the data is next written to the store.
+        n_jobs : int | None
+            Number of measurements written concurrently (in threads). None or -1 means all cpus.
+
+        Returns
+        -------
+        new : FCDiskCollection
+            New collection containing the transformed measurements.
+        transformer : Transformation
+            The Transformation applied to the measurements.
+            Only returned if get_transformer=True & share_transform=True.
+        '''
+        new = super(FCDiskCollection, self).transform(
+            transform, direction=direction, share_transform=share_transform, channels=channels,
+            return_all=return_all, auto_range=auto_range, use_spln=use_spln,
+            get_transformer=get_transformer, ID=ID, apply_now=False, dtype=dtype, args=args, **kwargs)
+        if share_transform and get_transformer:
+            new, transformer = new
+            if apply_now:
+                new = new.store_data(n_jobs=n_jobs)
+            return new, transformer
+        if apply_now:
+            new = new.store_data(n_jobs=n_jobs)
+        return new
+
+    @doc_replacer
+    def gate(self, gate, ID=None, apply_now=True, n_jobs=1):
+        '''
+        Applies the gate to each Measurement in the Collection, writing the gated data to the store.
+
+        Parameters
+        ----------
+        gate : {_gate_available_classes}
+        ID : hashable | None
+            New ID to be given to the output. If None, the ID of the current collection will be used.
+        apply_now : bool
+            If False, the gate is queued and applied when the data is next written to the store.
+        n_jobs : int | None
+            Number of measurements written concurrently (in threads). None or -1 means all cpus.
+        '''
+        new = super(FCDiskCollection, self).gate(gate, ID=ID, apply_now=False)
+        return new.store_data(n_jobs=n_jobs) if apply_now else new
+
+    def compensate(self, spillover=None, ID=None, apply_now=True, n_jobs=1):
+        '''
+        Compensates each Measurement in the Collection, writing the compensated data to the store.
+
+        Parameters
+        ----------
+        spillover : None | DataFrame | (list of str, array)
+            Spillover matrix applied to all the measurements.
+            If None, each measurement uses the matrix stored in its FCS file.
+        ID : hashable | None
+            New ID to be given to the output. If None, the ID of the current collection will be used.
+        apply_now : bool
+            If False, the compensation is queued and applied when the data is next written to the store.
+        n_jobs : int | None
+            Number of measurements written concurrently (in threads). None or -1 means all cpus.
+        '''
+        new = super(FCDiskCollection, self).compensate(spillover, ID=ID, apply_now=False)
+        return new.store_data(n_jobs=n_jobs) if apply_now else new
+
+    @doc_replacer
+    def subsample(self, key, order='random', auto_resize=False, ID=None, n_jobs=1):
+        """
+        Subsamples the data of each Measurement in the Collection, writing the selected events to the store.
+
+        The selected events are kept in the order in which they are stored
+        (also when order='random').
+
+        Parameters
+        ----------
+        {FCMeasurement_subsample_parameters}
+        ID : hashable | None
+            New ID to be given to the output. If None, the ID of the current collection will be used.
+        n_jobs : int | None
+            Number of measurements written concurrently (in threads). None or -1 means all cpus.
+
+        Returns
+        -------
+        FCDiskCollection
+            new collection of subsampled event data.
+        """
+        func = partial(_subsample_to_store, store=self.store, chunk_size=self.chunk_size,
+                       key=key, order=order, auto_resize=auto_resize)
+        return self.apply(func, output_format='collection', ID=ID, n_jobs=n_jobs)
 
 
 class FCOrderedCollection(OrderedCollection, FCCollection):
@@ -572,6 +1208,43 @@ class FCOrderedCollection(OrderedCollection, FCCollection):
     A dict-like class for holding flow cytometry samples that are arranged in a matrix.
     '''
 
+    @classmethod
+    @doc_replacer
+    def from_zip(cls, ID, path, parser='name', position_mapper=None, pattern='*.fcs',
+                 readdata_kwargs={}, readmeta_kwargs={}, ID_kwargs={},
+                 readmeta=True, workers=1, backend='thread', **kwargs):
+        '''
+        Create a Collection of measurements from the FCS files stored in a zip archive.
+
+        The archive is not extracted. Its members are indexed, and each measurement
+        reads its file straight from the archive when its data is needed.
+
+        Parameters
+        ----------
+        {_bases_ID}
+        path : str
+            Path of the zip archive.
+        pattern : str
+            Only members whose file names match the pattern will be used to create measurements.
+        {_bases_filename_parser}
+        {_bases_position_mapper}
+        {_bases_readdata_kwargs}
+        {_bases_workers}
+        {_bases_ID_kwargs}
+        kwargs : dict
+            Additional key word arguments to be passed to constructor.
+
+        Examples
+        --------
+        >>> plate = FCOrderedCollection.from_zip('plate', 'plate_export.zip')
+        >>> plate['A3'].data  # Reads Well_A3 from the archive
+        '''
+        datafiles = list_zip_members(path, pattern)
+        return cls.from_files(ID, datafiles, parser=parser, position_mapper=position_mapper,
+                              readdata_kwargs=readdata_kwargs, readmeta_kwargs=readmeta_kwargs,
+                              ID_kwargs=ID_kwargs, readmeta=readmeta, workers=workers, backend=backend,
+                              **kwargs)
+
     @doc_replacer
     def plot(self, channel_names, kind='histogram',
              gates=None, gate_colors=None,
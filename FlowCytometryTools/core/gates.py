@@ -49,6 +49,31 @@ doc_replacer.update(_gate_plot_doc=
                     Reference to created artists.""")
 
 
+def _check_channels(channels, dataframe):
+    """ Raises a ValueError if one of the channels is not present in the dataframe. """
+    for c in channels:
+        if c not in dataframe:
+            raise ValueError(
+                'Trying to filter based on channel {channel}, which is not present in the data.'.format(
+                    channel=c))
+
+
+def get_gate_channels(gate):
+    """
+    Returns the channels a gate (or a composite gate) reads, or None if they are unknown.
+    """
+    if isinstance(gate, CompositeGate):
+        channels = []
+        for g in gate.gates:
+            sub_channels = get_gate_channels(g)
+            if sub_channels is None:
+                return None
+            channels.extend(c for c in sub_channels if c not in channels)
+        return channels
+    channels = getattr(gate, 'channels', None)
+    return None if channels is None else list(to_list(channels))
+
+
 class _ComposableMixin(object):
     """ A mixin' class that enables to compose gates using logic elements. """
 
@@ -111,11 +136,7 @@ class Gate(_ComposableMixin):
         if region is not None:
             self.region = region
 
-        for c in self.channels:
-            if c not in dataframe:
-                raise ValueError(
-                    'Trying to filter based on channel {channel}, which is not present in the data.'.format(
-                        channel=c))
+        _check_channels(self.channels, dataframe)
 
         idx = self._identify(dataframe)
 
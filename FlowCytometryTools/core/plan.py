@@ -0,0 +1,288 @@
+'''
+Lazy execution of the operations queued on a flow cytometry measurement.
+
+Operations called with apply_now=False are queued on the measurement rather than applied.
+Replaying the queue one call at a time copies the measurement (and its data) at
+every step. Instead, QueuePlan groups consecutive gates, transforms and compensations
+into fused passes over the data:
+
+* The data is copied once per pass, when it is first modified.
+* Consecutive gates are combined into a single selection of the events.
+* Gates are moved ahead of transforms (and compensations) of unrelated channels,
+  so that only the events passing the gates get transformed. This is done only when
+  the result is unaffected, i.e., when the transform does not depend on the range of
+  the data (use_spln=False, or a Transformation whose spline is already set).
+
+Other queued operations (e.g., subsample) are replayed as they are, between passes.
+'''
+import numpy
+
+from GoreUtilities.util import to_list
+
+from FlowCytometryTools.core.bases import _copy_for_update
+from FlowCytometryTools.core.gates import _check_channels, get_gate_channels
+from FlowCytometryTools.core.transforms import Transformation
+
+# Fraction of the events assumed to pass a gate when estimating costs.
+_gate_selectivity = 0.5
+
+
+class _Step(object):
+    ''' An operation of the queue, with the channels it reads and writes. '''
+
+    def __init__(self, index, name, params, measurement):
+        self.index = index
+        self.name = name
+        self.params = params
+        self.reads = None  # channels read by a gate (None if unknown)
+        self.writes = None  # channels written by a transform (None means all of them)
+        self.row_independent = False
+        self.moved_before = []
+
+        if name == 'gate':
+            self.kind = 'gate'
+            self.reads = get_gate_channels(params['gate'])
+        elif name == 'transform' and params.get('return_all', True) and not params.get('get_transformer'):
+            self.kind = 'transform'
+            self.writes = to_list(params.get('channels'))
+            transform = params['transform']
+            self.row_independent = (not params.get('use_spln', True) or
+                                    (isinstance(transform, Transformation) and transform.spln is not None))
+        elif name == 'compensate':
+            self.kind = 'compensate'
+            self.row_independent = True
+            try:
+                names = measurement._get_spillover(params.get('spillover'))[0]
+                self.writes = [measurement._get_channel_column(c, measurement.channel_names) for c in names]
+            except ValueError:
+                # Reported when the step is executed.
+                self.writes = None
+        else:
+            self.kind = 'other'
+
+    @property
+    def fusable(self):
+        return self.kind != 'other'
+
+    def commutes_with_gate(self, gate):
+        ''' Whether the gate may be applied before this step without changing the result. '''
+        if self.kind == 'gate':
+            return False  # gates keep their relative order
+        return (self.row_independent and self.writes is not None and gate.reads is not None and
+                not set(self.writes) & set(gate.reads))
+
+    def describe(self):
+        params = self.params
+        if self.kind == 'gate':
+            gate = params['gate']
+            channels = self.reads
+            name = '{0} {1}'.format(self.name, getattr(gate, 'name', None) or type(gate).__name__)
+        elif self.kind == 'transform':
+            transform = params['transform']
+            channels = self.writes
+            label = getattr(transform, 'tname', None) or getattr(transform, '__name__', transform)
+            name = '{0} {1}'.format(self.name, label)
+        elif self.kind == 'compensate':
+            channels = self.writes
+            name = self.name
+        else:
+            return self.name
+        channels = 'all channels' if channels is None else ', '.join(str(c) for c in channels)
+        return '{0}({1})'.format(name, channels)
+
+
+class QueuePlan(object):
+    '''
+    Execution plan of the operations queued on a measurement.
+
+    Parameters
+    ----------
+    measurement : FCMeasurement
+        Measurement whose queue is planned. The measurement is not modified.
+
+    Examples
+    --------
+    >>> queued = sample.transform('hlog', channels=['FITC-A'], use_spln=False, apply_now=False)
+    >>> queued = queued.gate(fsc_gate, apply_now=False)
+    >>> print(queued.explain())
+    >>> gated = queued.apply_queued()
+    '''
+
+    def __init__(self, measurement):
+        self.measurement = measurement
+        self.steps = [_Step(i + 1, name, params, measurement)
+                      for i, (name, params) in enumerate(measurement.queue)]
+        self.passes = self._make_passes()
+
+    def _make_passes(self):
+        '''
+        Splits the steps into passes: lists of fusable steps (in execution order)
+        and single steps that are replayed as they are.
+        '''
+        passes, current = [], []
+        for step in self.steps:
+            if not step.fusable:
+                if current:
+                    passes.append(current)
+                    current = []
+                passes.append([step])
+                continue
+            position = len(current)
+            if step.kind == 'gate':
+                while position > 0 and current[position - 1].commutes_with_gate(step):
+                    position -= 1
+                step.moved_before = [s.index for s in current[position:]]
+            current.insert(position, step)
+        if current:
+            passes.append(current)
+        return passes
+
+    # ----------------------
+    # Execution
+    # ----------------------
+    def execute(self):
+        '''
+        Applies the queued operations. Returns a new measurement holding the resulting data.
+        '''
+        measurement = self.measurement
+        # The copy shares the data, which is copied only when modified.
+        new = measurement._copy_sharing_data()
+        new.queue = []
+        data = measurement._get_attr_from_file('data')
+        owned = False
+
+        for steps in self.passes:
+            if steps[0].fusable:
+                data, owned = self._run_pass(new, steps, data, owned)
+                for step in sorted(steps, key=lambda step: step.index):
+                    new.history.append((step.name, step.params))
+                    if step.params.get('ID') is not None:
+                        new.ID = step.params['ID']
+            else:
+                step = steps[0]
+                new._data = data
+                new = getattr(new, step.name)(**step.params)
+                data, owned = new._data, False
+        if data is measurement._data and data is not None:
+            # Nothing was modified; the result holds its own copy of the data of the original
+            data = data.copy()
+        new._data = data
+        return new
+
+    def _run_pass(self, measurement, steps, data, owned):
+        mask = None
+        for step in steps:
+            params = step.params
+            if step.kind == 'gate':
+                gate = params['gate']
+                if step.reads is not None:
+                    _check_channels(step.reads, data)
+                selected = numpy.asarray(gate._identify(data), dtype=bool)
+                mask = selected if mask is None else mask & selected
+                continue
+            if mask is not None:
+                data, mask, owned = data[mask], None, True
+            if not owned:
+                data, owned = _copy_for_update(data), True
+            if step.kind == 'transform':
+                channels = to_list(params.get('channels'))
+                if channels is None:
+                    channels = data.columns
+                kwargs = dict((k, v) for k, v in params.items() if k not in _transform_params)
+                transformer = measurement._get_transformer(params['transform'], params.get('direction', 'forward'),
+                                                           channels, params.get('auto_range', True),
+                                                           params.get('args', ()), kwargs)
+                data[channels] = transformer(data[channels], params.get('use_spln', True),
+                                             dtype=params.get('dtype'))
+            else:
+                measurement._compensate_data(data, params.get('spillover'))
+        if mask is not None:
+            data, owned = data[mask], True
+        return data, owned
+
+    # ----------------------
+    # Cost estimates
+    # ----------------------
+    def _initial_shape(self):
+        measurement = self.measurement
+        data = measurement._data
+        if data is not None:
+            return data.shape
+        return measurement._get_shape_from_meta() or (None, None)
+
+    def explain(self):
+        '''
+        Describes the plan, with the estimated number of data cells each step touches.
+
+        Returns
+        -------
+        str
+        '''
+        n_events, n_channels = self._initial_shape()
+        lines = ['Queued operations of {0!r}: {1} step(s), {2} events x {3} channels'.format(
+            self.measurement, len(self.steps), _format_count(n_events), _format_count(n_channels))]
+        rows, fused_cost, replay_cost = n_events, 0, 0
+
+        # Cost of replaying the queue step by step (each step copies the data).
+        replay_rows = n_events
+        for step in self.steps:
+            cells = _step_cells(step, replay_rows, n_channels)
+            replay_cost = _add(replay_cost, _add(cells, _mul(replay_rows, n_channels)))
+            if step.kind == 'gate':
+                replay_rows = _mul(replay_rows, _gate_selectivity)
+
+        for i, steps in enumerate(self.passes):
+            if steps[0].fusable:
+                lines.append('Pass {0}: fused, {1} step(s), at most one copy of the data'.format(i + 1, len(steps)))
+                copied = False
+                for step in steps:
+                    cells = _step_cells(step, rows, n_channels)
+                    if step.kind != 'gate' and not copied:
+                        cells, copied = _add(cells, _mul(rows, n_channels)), True
+                    fused_cost = _add(fused_cost, cells)
+                    note = ''
+                    if step.moved_before:
+                        note = '  (moved before step {0})'.format(
+                            ', '.join(str(index) for index in step.moved_before))
+                    lines.append('    [{0}] {1:<40} ~{2} events  ~{3} cells{4}'.format(
+                        step.index, step.describe(), _format_count(rows), _format_count(cells), note))
+                    if step.kind == 'gate':
+                        rows = _mul(rows, _gate_selectivity)
+            else:
+                step = steps[0]
+                cells = _mul(rows, n_channels)
+                fused_cost = _add(fused_cost, cells)
+                lines.append('Pass {0}: replayed as is'.format(i + 1))
+                lines.append('    [{0}] {1:<40} ~{2} events  ~{3} cells'.format(
+                    step.index, step.describe(), _format_count(rows), _format_count(cells)))
+        lines.append('Estimated cost: ~{0} cells (~{1} cells when replaying the queue step by step).'.format(
+            _format_count(fused_cost), _format_count(replay_cost)))
+        lines.append('Gates are assumed to keep {0:.0%} of the events.'.format(_gate_selectivity))
+        return '\n'.join(lines)
+
+
+# Parameters of FCMeasurement.transform; any other parameter is passed to the Transformation.
+_transform_params = frozenset(['self', 'transform', 'direction', 'channels', 'return_all', 'auto_range',
+                               'use_spln', 'get_transformer', 'ID', 'apply_now', 'dtype', 'args'])
+
+
+def _mul(a, b):
+    return None if a is None or b is None else a * b
+
+
+def _add(a, b):
+    return None if a is None or b is None else a + b
+
+
+def _step_cells(step, rows, n_channels):
+    if step.kind == 'gate':
+        channels = step.reads
+    elif step.kind in ('transform', 'compensate'):
+        channels = step.writes
+    else:
+        return _mul(rows, n_channels)
+    return _mul(rows, n_channels if channels is None else len(channels))
+
+
+def _format_count(count):
+    return '?' if count is None else '{0:,}'.format(int(round(count)))
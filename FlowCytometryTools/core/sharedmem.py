@@ -0,0 +1,460 @@
+'''
+Process pool for work on the measurements of a collection, passing event data through shared memory.
+
+Sending measurements to worker processes normally pickles their event data
+on the way to the worker and the result on the way back.
+Instead, SharedMemoryPool places the event data of each measurement in a
+shared memory block and sends the workers only a small descriptor of the block
+(SharedFrame). The workers wrap the block in a DataFrame without copying it.
+Measurements and DataFrames returned by the workers (e.g., by transform or gate)
+are sent back through shared memory as well.
+
+The data is not zero-copy end to end: the parent process gets the data of each
+measurement (reading it from its file if needed) and copies it into a block,
+column by column, and results are copied out of their blocks once they are received.
+Only the transfer to and from the workers avoids pickling the events.
+
+The blocks are multiprocessing.shared_memory blocks (python 3.8 or later).
+On older versions of python, they are memory mapped temporary files,
+created in /dev/shm (which is held in memory) when available.
+'''
+import collections
+import copy
+import multiprocessing
+import operator
+import os
+import pickle
+import tempfile
+
+import numpy
+from numpy import nan
+from pandas import DataFrame, Index, RangeIndex
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # python < 3.8
+    resource_tracker = shared_memory = None
+
+from FlowCytometryTools.core.bases import Measurement
+
+
+class _FileBlock(object):
+    '''
+    Shared memory block held in a memory mapped temporary file.
+    Used when multiprocessing.shared_memory is not available (python < 3.8).
+    Has the interface of shared_memory.SharedMemory (name, buf, close and unlink).
+
+    The mapping is released once the block is closed and no array refers to it anymore.
+    '''
+    _directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+    def __init__(self, name=None, create=False, size=0):
+        if create:
+            fd, name = tempfile.mkstemp(prefix='FlowCytometryTools_', dir=self._directory)
+            try:
+                os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+        self.name = name
+        self.buf = numpy.memmap(name, dtype=numpy.uint8, mode='r+')
+
+    def close(self):
+        self.buf = None
+
+    def unlink(self):
+        os.remove(self.name)
+
+
+_SharedMemory = _FileBlock if shared_memory is None else shared_memory.SharedMemory
+
+try:
+    pickle.dumps(operator.methodcaller('copy'))
+    from operator import attrgetter, methodcaller
+except (TypeError, pickle.PicklingError):  # python 2
+    class methodcaller(object):
+        ''' Picklable version of operator.methodcaller. '''
+
+        def __init__(self, name, *args, **kwargs):
+            self.name = name
+            self.args = args
+            self.kwargs = kwargs
+
+        def __call__(self, obj):
+            return getattr(obj, self.name)(*self.args, **self.kwargs)
+
+    class attrgetter(object):
+        ''' Picklable version of operator.attrgetter (for a single attribute). '''
+
+        def __init__(self, name):
+            self.name = name
+
+        def __call__(self, obj):
+            return getattr(obj, self.name)
+
+
+class SharedFrame(object):
+    '''
+    Descriptor of a DataFrame held in a shared memory block.
+
+    The values are stored column by column (fortran order), followed by the index
+    when it is numeric. Only this descriptor is pickled when a DataFrame is
+    passed between processes.
+    '''
+
+    def __init__(self, name, shape, dtype, columns, index, index_name=None):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.columns = columns
+        self.index = index
+        self.index_name = index_name
+
+    def __repr__(self):
+        return '<SharedFrame {0} {1} {2}>'.format(self.name, self.shape, self.dtype)
+
+    @property
+    def _values_nbytes(self):
+        return int(numpy.prod(self.shape)) * numpy.dtype(self.dtype).itemsize
+
+    @property
+    def _index_offset(self):
+        # The index starts at the first 8 byte boundary after the values.
+        return -(-self._values_nbytes // 8) * 8
+
+    @classmethod
+    def from_frame(cls, data):
+        '''
+        Copies a DataFrame into a new shared memory block.
+
+        Returns
+        -------
+        A 2-tuple with the SharedMemory holding the block (owned by the caller,
+        who should close and unlink it) and the SharedFrame describing it.
+        '''
+        if data.shape[1]:
+            dtype = numpy.result_type(*data.dtypes)
+        else:
+            dtype = numpy.dtype(numpy.float64)
+        index = data.index
+        if isinstance(index, RangeIndex):
+            # RangeIndex has start, stop and step attributes only since pandas 0.25
+            index_spec = ('range',) + tuple(getattr(index, name) if hasattr(index, name) else getattr(index, '_' + name)
+                                            for name in ('start', 'stop', 'step'))
+            index_nbytes = 0
+        elif index.nlevels == 1 and index.dtype.kind in 'iuf':
+            index_spec = ('array', index.dtype.str)
+            index_nbytes = index.nbytes
+        else:
+            # Unusual index; sent along with the descriptor
+            index_spec = ('values', list(index))
+            index_nbytes = 0
+
+        frame = cls(None, data.shape, numpy.dtype(dtype).str, list(data.columns), index_spec, index.name)
+        shm = _SharedMemory(create=True, size=max(frame._index_offset + index_nbytes, 1))
+        frame.name = shm.name
+
+        values = frame._values(shm.buf)
+        for j in range(data.shape[1]):
+            values[:, j] = data.iloc[:, j].values
+        if index_spec[0] == 'array':
+            frame._index_values(shm.buf)[:] = index.values
+        del values
+        return shm, frame
+
+    def _values(self, buf):
+        return numpy.ndarray(self.shape, self.dtype, buffer=buf, order='F')
+
+    def _index_values(self, buf):
+        return numpy.ndarray(self.shape[0], self.index[1], buffer=buf, offset=self._index_offset)
+
+    def view(self, buf):
+        '''
+        Returns a read-only DataFrame backed by the given buffer of the shared memory block.
+        '''
+        values = self._values(buf)
+        values.flags.writeable = False
+        kind = self.index[0]
+        if kind == 'range':
+            index = RangeIndex(*self.index[1:], name=self.index_name)
+        elif kind == 'array':
+            index = Index(self._index_values(buf), name=self.index_name)
+        else:
+            index = Index(self.index[1], name=self.index_name)
+        return DataFrame(values, index=index, columns=self.columns, copy=False)
+
+    def read(self, unlink=True):
+        '''
+        Returns a private copy of the DataFrame held in the shared memory block,
+        and (by default) releases the block.
+        '''
+        shm = _SharedMemory(name=self.name)
+        try:
+            view = self.view(shm.buf)
+            data = view.copy()
+            del view
+        finally:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        return data
+
+
+# Shared memory blocks attached by a worker process.
+# Blocks are closed lazily, once nothing refers to their buffer anymore.
+_attached = {}
+
+
+def _attach(frame):
+    for name in list(_attached):
+        if name != frame.name:
+            try:
+                _attached[name].close()
+            except BufferError:  # A result still refers to the block
+                continue
+            del _attached[name]
+    shm = _attached.get(frame.name)
+    if shm is None:
+        shm = _SharedMemory(name=frame.name)
+        _attached[frame.name] = shm
+    return frame.view(shm.buf)
+
+
+def _export_result(result):
+    '''
+    Puts the event data of a result in shared memory before it is sent back to the parent process.
+    '''
+    if isinstance(result, Measurement) and isinstance(result._data, DataFrame):
+        shell = copy.copy(result)
+        shm, frame = SharedFrame.from_frame(result._data)
+        shm.close()
+        shell._data = None
+        return 'measurement', shell, frame
+    elif isinstance(result, DataFrame):
+        shm, frame = SharedFrame.from_frame(result)
+        shm.close()
+        return 'frame', None, frame
+    else:
+        return 'value', result, None
+
+
+def _release(shm):
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def _import_result(result, measurement):
+    kind, value, frame = result
+    if kind == 'measurement':
+        value._data = frame.read()
+        if value.datafile is None:
+            value.datafile = measurement.datafile
+        return value
+    elif kind == 'frame':
+        return frame.read()
+    else:
+        return value
+
+
+def _discard_result(result):
+    ''' Releases the shared memory block of a result that will not be imported. '''
+    frame = result[2]
+    if frame is not None:
+        try:
+            shm = _SharedMemory(name=frame.name)
+        except (IOError, OSError):  # already released
+            return
+        shm.close()
+        shm.unlink()
+
+
+def _run(task):
+    func, applyto, shell, frame = task
+    if frame is not None:
+        shell.set_data(data=_attach(frame))
+    if applyto == 'data':
+        result = func(shell._data)
+    else:
+        result = func(shell)
+    return _export_result(result)
+
+
+def _run_chunk(tasks):
+    results = []
+    try:
+        for task in tasks:
+            results.append(_run(task))
+    except BaseException:
+        for result in results:
+            _discard_result(result)
+        raise
+    return results
+
+
+class SharedMemoryPool(object):
+    '''
+    Process pool that passes the event data of measurements through shared memory.
+
+    Functions applied through the pool (and their arguments) are pickled,
+    so they must be defined at the top level of a module, or be built with
+    functools.partial, or the methodcaller and attrgetter of this module
+    (those of the operator module cannot be pickled on python 2).
+
+    Parameters
+    ----------
+    processes : int | None
+        Number of worker processes. If None, the number of cpus is used.
+    context : str | None
+        Start method of the worker processes ('fork', 'spawn', 'forkserver'; python 3.4 or later).
+        If None, the default start method of the platform is used.
+
+    Examples
+    --------
+    >>> from FlowCytometryTools.core.sharedmem import attrgetter
+    >>> with SharedMemoryPool(8) as pool:
+    >>>     gated = plate.transform('hlog', channels=['FSC-A', 'SSC-A'], pool=pool).gate(gate, pool=pool)
+    >>>     counts = gated.apply(attrgetter('counts'), pool=pool)
+    '''
+
+    def __init__(self, processes=None, context=None):
+        if resource_tracker is not None:
+            # The workers should share the resource tracker of this process, which then
+            # follows the blocks created and unlinked by all of them (rather than
+            # each worker warning about, and unlinking, the blocks it attached to).
+            resource_tracker.ensure_running()
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self._processes = processes
+        if context is None:
+            self._pool = multiprocessing.Pool(processes)
+        else:
+            self._pool = multiprocessing.get_context(context).Pool(processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        ''' Stops the worker processes. '''
+        self._pool.terminate()
+        self._pool.join()
+
+    def map(self, func, measurements, applyto='measurement', noneval=nan, setdata=False, chunksize=1):
+        '''
+        Applies func to each measurement in the worker processes.
+
+        Parameters
+        ----------
+        func : callable
+            Accepts a Measurement object or a DataFrame. Must be picklable.
+        measurements : iterable of Measurement
+        applyto : 'measurement' | 'data'
+            * 'measurement' : apply to measurements objects themselves.
+            * 'data'        : apply to measurement associated data
+        noneval : obj
+            Value returned if applyto is 'data' but no data is available.
+        setdata : bool
+            Whether to set the data in the Measurement objects (in this process).
+            Used only if data is not already set.
+        chunksize : int
+            Number of measurements sent to a worker at once.
+            The data of at most 2 * processes chunks is held in shared memory at a time.
+
+        Returns
+        -------
+        List with the output of func for each measurement (in order).
+        '''
+        applyto = applyto.lower()
+        if applyto not in ('data', 'measurement'):
+            raise ValueError('Encountered unsupported value "%s" for applyto parameter.' % applyto)
+        measurements = list(measurements)
+        results = [noneval] * len(measurements)
+        # Only the inputs of the chunks that were submitted and not yet imported
+        # are held in shared memory.
+        max_pending = 2 * self._processes
+        pending = collections.deque()  # (positions, input blocks, async result) of each submitted chunk
+        chunk = []
+        try:
+            for i, measurement in enumerate(measurements):
+                task, shm = self._make_task(func, measurement, applyto, setdata)
+                if task is None:
+                    continue
+                chunk.append((i, task, shm))
+                if len(chunk) == chunksize:
+                    self._submit(chunk, pending)
+                    chunk = []
+                    while len(pending) >= max_pending:
+                        self._collect(pending, results, measurements)
+            if chunk:
+                self._submit(chunk, pending)
+                chunk = []
+            while pending:
+                self._collect(pending, results, measurements)
+        finally:
+            for i, task, shm in chunk:
+                _release(shm)
+            while pending:
+                positions, blocks, async_result = pending.popleft()
+                try:
+                    for result in async_result.get():
+                        _discard_result(result)
+                except Exception:
+                    pass
+                finally:
+                    for shm in blocks:
+                        _release(shm)
+        return results
+
+    @staticmethod
+    def _make_task(func, measurement, applyto, setdata):
+        '''
+        Returns the task sent to the workers for the measurement and the shared memory
+        block holding its data (or None), or (None, None) if the measurement is skipped.
+        '''
+        has_data = measurement._data is not None or measurement.datafile is not None
+        if not has_data and applyto == 'data':
+            return None, None
+        shell = copy.copy(measurement)
+        shell._data = None
+        if not isinstance(shell.datafile, str):  # file-like objects are not sent
+            shell.datafile = None
+        shm = frame = None
+        if has_data:
+            data = measurement.get_data()
+            if setdata and measurement._data is None:
+                measurement.data = data
+            shm, frame = SharedFrame.from_frame(data)
+            shell.queue = list(measurement.queue)
+        return (func, applyto, shell, frame), shm
+
+    def _submit(self, chunk, pending):
+        positions = [i for i, task, shm in chunk]
+        blocks = [shm for i, task, shm in chunk]
+        try:
+            async_result = self._pool.apply_async(_run_chunk, ([task for i, task, shm in chunk],))
+        except BaseException:
+            for shm in blocks:
+                _release(shm)
+            raise
+        pending.append((positions, blocks, async_result))
+
+    @staticmethod
+    def _collect(pending, results, measurements):
+        '''
+        Imports the results of the oldest submitted chunk and releases its input blocks.
+        '''
+        positions, blocks, async_result = pending.popleft()
+        try:
+            chunk_results = async_result.get()
+        finally:
+            for shm in blocks:
+                _release(shm)
+        try:
+            for n, (i, result) in enumerate(zip(positions, chunk_results)):
+                results[i] = _import_result(result, measurements[i])
+        except BaseException:
+            for result in chunk_results[n + 1:]:
+                _discard_result(result)
+            raise
@@ -0,0 +1,256 @@
+'''
+On-disk stores for the event data of out-of-core collections (see FCDiskCollection).
+
+The events of a measurement are written to a store one block (chunk) at a time,
+so that the data of a measurement never needs to be held in memory as a whole.
+Two stores are available:
+
+* MemmapStore : a directory holding a file per measurement, to which the events are
+  appended row by row (native byte order). Read through a memory map.
+* HDF5Store : a single HDF5 file holding a table per measurement (requires PyTables).
+'''
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import numpy
+from pandas import DataFrame, Index, RangeIndex
+
+from FlowCytometryTools.IO.fcsreader import string_types
+from FlowCytometryTools.core.columnar import ArrayFile
+
+try:
+    import tables
+    hdf5_found = True
+except ImportError:
+    hdf5_found = False
+
+_hdf5_extensions = ('.h5', '.hdf5', '.hdf')
+
+
+def _get_dtype(chunk):
+    ''' Native byte order type holding all the columns of the chunk. '''
+    if chunk.shape[1]:
+        return numpy.result_type(*chunk.dtypes).newbyteorder('=')
+    return numpy.dtype(numpy.float64)
+
+
+def _is_range(index, start):
+    ''' Whether the index numbers the events start, start + 1, ... '''
+    if isinstance(index, RangeIndex):
+        return index.start == start and index.step == 1
+    if index.dtype.kind not in 'iu':
+        return False
+    return bool(numpy.array_equal(numpy.asarray(index), numpy.arange(start, start + len(index))))
+
+
+class MemmapFile(ArrayFile):
+    '''
+    Events of a measurement held in a MemmapStore.
+    '''
+
+    def __init__(self, directory, name, columns, shape, dtype, index=None):
+        self.directory = directory
+        self.name = name
+        self.columns = columns
+        self.shape = shape
+        self.dtype = dtype
+        self.index = index  # None, 'file' or the values of a non numeric index
+
+    def __repr__(self):
+        return '<MemmapFile {0} {1} {2}>'.format(self.name, self.shape, self.dtype)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.name + '.dat')
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, self.name + '.index.dat')
+
+    def _map(self, path, dtype, shape):
+        if shape[0] == 0:  # Empty files cannot be memory mapped
+            return numpy.empty(shape, dtype=dtype)
+        return numpy.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+    def read(self, channels=None):
+        ''' Returns the events (of the given channels), backed by a read-only memory map. '''
+        values = self._map(self.path, self.dtype, self.shape)
+        if self.index == 'file':
+            index = Index(self._map(self.index_path, numpy.int64, (self.shape[0],)))
+        elif self.index is not None:
+            index = Index(self.index)
+        else:
+            index = RangeIndex(self.shape[0])
+        data = DataFrame(values, index=index, columns=self.columns, copy=False)
+        if channels is not None:
+            data = data[list(channels)]
+        return data
+
+
+class MemmapStore(object):
+    '''
+    Store keeping the events of each measurement in a memory mapped file.
+
+    Parameters
+    ----------
+    path : str | None
+        Directory of the store (created if needed).
+        If None, a temporary directory is used, which is removed when python exits.
+    '''
+
+    def __init__(self, path=None):
+        if path is None:
+            path = tempfile.mkdtemp(prefix='FlowCytometryTools_')
+            atexit.register(shutil.rmtree, path, True)
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = os.path.abspath(path)
+
+    def __repr__(self):
+        return '<MemmapStore {0}>'.format(self.path)
+
+    def __deepcopy__(self, memo):
+        # Copies of collections share the store
+        return self
+
+    def write(self, chunks):
+        '''
+        Appends the events in chunks (an iterable of DataFrames) to a new file of the store.
+
+        Returns
+        -------
+        MemmapFile
+        '''
+        name = uuid.uuid4().hex
+        new = MemmapFile(self.path, name, [], (0, 0), numpy.dtype(numpy.float64).str)
+        num_events = 0
+        numeric = True  # Numeric indices are written to the index file, others are kept in memory
+        contiguous = True  # Whether the events are numbered 0, 1, 2, ... (no index is kept)
+        labels = []
+        with open(new.path, 'wb') as f, open(new.index_path, 'wb') as index_file:
+            for chunk in chunks:
+                if num_events == 0 and not new.columns:
+                    new.columns = list(chunk.columns)
+                    new.dtype = _get_dtype(chunk).str
+                    numeric = chunk.index.dtype.kind in 'iu'
+                f.write(numpy.ascontiguousarray(chunk.values, dtype=new.dtype).tobytes())
+                if numeric:
+                    contiguous = contiguous and _is_range(chunk.index, num_events)
+                    index_file.write(numpy.asarray(chunk.index, dtype=numpy.int64).tobytes())
+                else:
+                    labels.extend(chunk.index)
+                num_events += chunk.shape[0]
+        new.shape = (num_events, len(new.columns))
+        if numeric and not contiguous:
+            new.index = 'file'
+        else:
+            os.remove(new.index_path)
+            if not numeric:
+                new.index = labels
+        return new
+
+
+class HDF5File(ArrayFile):
+    '''
+    Events of a measurement held in an HDF5Store.
+    '''
+
+    def __init__(self, store, key, columns, shape):
+        self.store = store
+        self.key = key
+        self.columns = columns
+        self.shape = shape
+
+    def __repr__(self):
+        return '<HDF5File {0}:{1} {2}>'.format(self.store.path, self.key, self.shape)
+
+    def read(self, channels=None):
+        ''' Returns the events (of the given channels). The events are read into memory. '''
+        return self.store.select(self.key, channels=channels)
+
+    def iter_chunks(self, chunk_size, channels=None):
+        for start in range(0, self.shape[0], chunk_size):
+            yield self.store.select(self.key, channels=channels, start=start, stop=start + chunk_size)
+
+
+class HDF5Store(object):
+    '''
+    Store keeping the events of each measurement in a table of an HDF5 file.
+    Requires PyTables.
+
+    Parameters
+    ----------
+    path : str
+        Path of the HDF5 file (created if needed).
+    complevel : int
+        Compression level (0 to 9) of the tables.
+    '''
+
+    def __init__(self, path, complevel=0):
+        if not hdf5_found:
+            raise ImportError('PyTables (tables) must be installed to store data in HDF5 files.')
+        self.path = os.path.abspath(path)
+        self.complevel = complevel
+        self._lock = threading.RLock()  # HDF5 files cannot be written from several threads at once
+
+    def __repr__(self):
+        return '<HDF5Store {0}>'.format(self.path)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (HDF5Store, (self.path, self.complevel))
+
+    def _open(self, mode):
+        from pandas import HDFStore
+        return HDFStore(self.path, mode=mode, complevel=self.complevel)
+
+    def write(self, chunks):
+        '''
+        Appends the events in chunks (an iterable of DataFrames) to a new table of the store.
+
+        Returns
+        -------
+        HDF5File
+        '''
+        key = 'm' + uuid.uuid4().hex
+        columns = []
+        num_events = 0
+        for chunk in chunks:
+            if num_events == 0 and not columns:
+                columns = list(chunk.columns)
+            with self._lock:
+                with self._open('a') as h5:
+                    h5.append(key, chunk, index=False)
+            num_events += chunk.shape[0]
+        return HDF5File(self, key, columns, (num_events, len(columns)))
+
+    def select(self, key, channels=None, start=None, stop=None):
+        with self._lock:
+            with self._open('r') as h5:
+                if key not in h5:  # nothing was written (no events)
+                    return DataFrame(columns=channels)
+                return h5.select(key, columns=channels, start=start, stop=stop)
+
+
+def get_store(store):
+    '''
+    Returns the store given by store.
+
+    * None : a MemmapStore in a temporary directory.
+    * str ending with .h5, .hdf5 or .hdf : an HDF5Store in that file.
+    * str : a MemmapStore in that directory.
+    * a store : returned as is.
+    '''
+    if store is None:
+        return MemmapStore()
+    if isinstance(store, string_types):
+        if os.path.splitext(store)[1].lower() in _hdf5_extensions:
+            return HDF5Store(store)
+        return MemmapStore(store)
+    return store
@@ -19,7 +19,7 @@ from __future__ import division
 import warnings
 
 from numpy import (log, log10, exp, where, sign, vectorize, min, max, linspace, logspace, r_, abs,
-                   asarray)
+                   asarray, dtype as np_dtype, float64)
 from numpy.lib.shape_base import apply_along_axis
 from scipy.optimize import brentq
 from scipy.interpolate import InterpolatedUnivariateSpline
@@ -27,6 +27,8 @@ from scipy.interpolate import InterpolatedUnivariateSpline
 from GoreUtilities import BaseObject
 from GoreUtilities.util import to_list
 
+from FlowCytometryTools.IO.fcsreader import get_dtype_policy
+
 _machine_max = 2 ** 18
 _l_mmax = log10(_machine_max)
 _display_max = 10 ** 4
@@ -325,6 +327,18 @@ def transform_frame(frame, transform, columns=None, direction='forward',
     return transformed
 
 
+def get_float_dtype(dtype=None):
+    '''
+    Returns the floating point type of transformed values for the given dtype
+    (see Transformation.transform).
+    '''
+    if dtype is None:
+        dtype = get_dtype_policy()
+    if dtype is None or np_dtype(dtype).kind != 'f':
+        dtype = float64
+    return dtype
+
+
 class Transformation(BaseObject):
     '''
     A transformation for flow cytometry data.
@@ -355,7 +369,7 @@ class Transformation(BaseObject):
     def __repr__(self):
         return repr(self.name)
 
-    def transform(self, x, use_spln=False, **kwargs):
+    def transform(self, x, use_spln=False, dtype=None, **kwargs):
         '''
         Apply transform to x
 
@@ -368,6 +382,10 @@ class Transformation(BaseObject):
             True - transform using the spline specified in self.slpn.
                     If self.spln is None, set the spline.
             False - transform using self.tfun
+        dtype: None | str | numpy.dtype
+            Floating point type of the transformed values (e.g., 'float32').
+            If None, the policy set by FlowCytometryTools.IO.fcsreader.set_dtype_policy is used.
+            Integer types (and the default policy) give float64.
         kwargs:
             Keyword arguments to be passed to self.set_spline.
             Only used if use_spln=True & self.spln=None.
@@ -376,14 +394,16 @@ class Transformation(BaseObject):
         -------
         Array of transformed values.
         '''
-        x = asarray(x, dtype=float)
+        dtype = get_float_dtype(dtype)
+        x = asarray(x, dtype=dtype)
 
         if use_spln:
             if self.spln is None:
                 self.set_spline(x.min(), x.max(), **kwargs)
-            return apply_along_axis(self.spln, 0, x)
+            y = apply_along_axis(self.spln, 0, x)
         else:
-            return self.tfun(x, *self.args, **self.kwargs)
+            y = self.tfun(x, *self.args, **self.kwargs)
+        return asarray(y, dtype=dtype)
 
     __call__ = transform
 
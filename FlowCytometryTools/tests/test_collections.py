@@ -0,0 +1,289 @@
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_equal
+from pandas import DataFrame
+
+from FlowCytometryTools import FCMeasurement, FCPlate, FCDiskCollection, ThresholdGate, DataCache, test_data_dir
+
+base_path = os.path.dirname(os.path.realpath(__file__))
+
+test_path = os.path.join(base_path, 'data', 'FlowCytometers',
+                         'HTS_BD_LSR-II', 'HTS_BD_LSR_II_Mixed_Specimen_001_D6_D06.fcs')
+
+
+def _dict2DF_cell_by_cell(plate, results, noneval, dropna=False):
+    """ Reference for OrderedCollection._dict2DF, filling the layout one well at a time. """
+    keys = dict((plate._positions[key], key) for key in results)
+    df = DataFrame([[results[keys[(row, col)]] if (row, col) in keys else noneval
+                     for col in plate.col_labels] for row in plate.row_labels],
+                   index=plate.row_labels, columns=plate.col_labels, dtype=object)
+    try:
+        df = df.astype(float)
+    except (TypeError, ValueError):
+        pass
+    if dropna:
+        df = df.dropna(axis=0, how='all').dropna(axis=1, how='all')
+    return df
+
+
+class TestCollections(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fc_measurement = FCMeasurement(ID='test', datafile=test_path)
+        cls.fc_plate = FCPlate('plate', measurements={'A1': cls.fc_measurement},
+                               position_mapper='name')
+
+    def test_data_cache(self):
+        size = DataCache._get_size(FCMeasurement(ID='A3', datafile=os.path.join(test_data_dir, 'RFP_Well_A3.fcs')).data)
+        cache = DataCache(int(2.5 * size))  # holds the data of two measurements
+        plate = FCPlate.from_dir('plate', test_data_dir, data_cache=cache)
+        a3, a4, b3, b4 = plate['A3'], plate['A4'], plate['B3'], plate['B4']
+        values = a4.data.values.copy()
+        a3.data
+        self.assertEqual(cache.size, 2 * size)
+
+        # The least recently used data is dropped, and read again when needed
+        a4.data  # touch
+        b3.data
+        self.assertEqual(cache.size, 2 * size)
+        self.assertIsNone(a3._data)
+        self.assertIsNotNone(a4._data)
+        self.assertIsNotNone(b3._data)
+        np.testing.assert_array_equal(a3.data.values, plate['A3'].data.values)
+        self.assertIsNone(a4._data)
+        self.assertIsNotNone(b3._data)
+        np.testing.assert_array_equal(a4.data.values, values)
+        self.assertIsNone(b3._data)
+
+        # Queued measurements share the cached data; it is counted once and dropped from all of them
+        queued = a4.transform('hlog', channels=['FSC-A'], b=10, apply_now=False)
+        self.assertIs(queued._data_cache, cache)
+        self.assertIsNotNone(queued._data)
+        self.assertEqual(cache.size, 2 * size)
+        b3.data
+        b4.data
+        self.assertIsNone(a4._data)
+        self.assertIsNone(queued._data)
+        self.assertEqual(cache.size, 2 * size)
+
+        # Copies hold their own data, which is not counted
+        copy = b4.copy()
+        self.assertIsNotNone(copy._data)
+        b3.data
+        a4.data
+        self.assertIsNone(b4._data)
+        self.assertIsNotNone(copy._data)
+        self.assertEqual(cache.size, 2 * size)
+
+        # Assigned data is never dropped
+        transformed = a3.transform('hlog', channels=['FSC-A'], b=10)
+        b4.set_data()
+        for measurement in plate.values():
+            measurement.data
+        self.assertEqual(cache.size, 2 * size)
+        self.assertIsNotNone(transformed._data)
+        self.assertIsNotNone(b4._data)
+
+        # The data of measurements that no longer exist is not counted
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+        measurement = FCMeasurement(ID='A3', datafile=a3.datafile)
+        measurement._data_cache = cache
+        measurement.data
+        self.assertEqual(cache.size, size)
+        del measurement
+        gc.collect()
+        self.assertEqual(cache.size, 0)
+
+    def test_copy_semantics(self):
+        measurement = FCMeasurement(ID='test', datafile=test_path)
+        measurement.set_data()
+        values = measurement.data.values.copy()
+
+        # Copies are independent of the measurement
+        copy = measurement.copy()
+        self.assertFalse(np.shares_memory(copy.data.values, measurement.data.values))
+        copy.data.iloc[0, 0] = -99
+        copy.meta['$TOT'] = 0
+        np.testing.assert_array_equal(measurement.data.values, values)
+        self.assertNotEqual(measurement.meta['$TOT'], 0)
+
+        # Queued measurements share the data until the queue is applied
+        queued = measurement.transform('hlog', channels=['FSC-A'], b=10, apply_now=False)
+        self.assertTrue(np.shares_memory(queued._data['SSC-A'].values, measurement.data['SSC-A'].values))
+        transformed = queued.apply_queued()
+        compensated = measurement.compensate(spillover=(['FSC-A', 'SSC-A'], [[1, 0.1], [0, 1]]))
+        np.testing.assert_array_equal(measurement.data.values, values)
+        self.assertFalse(np.array_equal(transformed.data['FSC-A'].values, values[:, 1]))
+        self.assertFalse(np.array_equal(compensated.data['SSC-A'].values, values[:, 4]))
+        unchanged = measurement.transform('hlog', apply_now=False)
+        unchanged.queue = []
+        unchanged = unchanged.apply_queued()
+        unchanged.data.iloc[0, 0] = -99
+        np.testing.assert_array_equal(measurement.data.values, values)
+
+        plate = FCPlate('plate', measurements={'A1': measurement}, position_mapper='name')
+        plate_copy = plate.copy()
+        self.assertTrue(plate_copy['A1'] is not measurement)
+        plate_copy['A1'].data.iloc[0, 0] = -99
+        np.testing.assert_array_equal(measurement.data.values, values)
+        self.assertEqual(plate_copy.get_positions(), plate.get_positions())
+
+    def test_read_meta_of_many_files(self):
+        expected = FCPlate.from_dir('plate', test_data_dir)
+        lazy = FCPlate.from_dir('plate', test_data_dir, readmeta=False)
+        self.assertTrue(all(measurement._meta is None for measurement in lazy.values()))
+        for key, measurement in lazy.items():
+            self.assertEqual(measurement.meta['$TOT'], expected[key].meta['$TOT'])
+            self.assertEqual(measurement.channel_names, expected[key].channel_names)
+            self.assertIsNotNone(measurement._meta)
+            self.assertIsNone(measurement._data)
+
+        for backend in ['thread', 'process']:
+            plate = FCPlate.from_dir('plate', test_data_dir, workers=2, backend=backend)
+            self.assertEqual(sorted(plate.keys()), sorted(expected.keys()))
+            for key, measurement in plate.items():
+                self.assertIsNotNone(measurement._meta)
+                self.assertEqual(measurement.meta['$TOT'], expected[key].meta['$TOT'])
+                self.assertEqual(measurement.channel_names, expected[key].channel_names)
+
+        path = tempfile.mkdtemp()
+        try:
+            for name in ['RFP_Well_A3.fcs', 'CFP_Well_A4.fcs']:
+                shutil.copy(os.path.join(test_data_dir, name), path)
+            with open(os.path.join(path, 'RFP_Well_B3.fcs'), 'wb') as f:
+                f.write(b'not an fcs file' * 10)
+            for workers in [1, 2]:
+                self.assertRaises(IOError, FCPlate.from_dir, 'plate', path, workers=workers)
+            # Without reading the meta data, the corrupt file is only noticed when accessed
+            plate = FCPlate.from_dir('plate', path, readmeta=False)
+            self.assertEqual(plate['A3'].meta['$TOT'], expected['A3'].meta['$TOT'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_counts_from_meta(self):
+        measurement = FCMeasurement(ID='test', datafile=test_path)
+        self.assertEqual(measurement.counts, measurement.meta['$TOT'])
+        self.assertEqual(measurement.shape, (measurement.meta['$TOT'], len(measurement.channel_names)))
+        self.assertIsNone(measurement._data)
+        self.assertEqual(measurement.shape, measurement.data.shape)
+
+        gated = measurement.gate(ThresholdGate(1000, 'SSC-A', 'above'), apply_now=False)
+        self.assertEqual(gated.counts, gated.apply_queued().data.shape[0])
+        self.assertEqual(self.fc_plate.counts(output_format='dict')['A1'], measurement.counts)
+
+    def test_plate_results_layout(self):
+        plate = FCPlate.from_dir('plate', test_data_dir)
+        results = {
+            'numbers': plate.apply(lambda measurement: measurement.counts, output_format='dict'),
+            'floats': plate.apply(lambda data: data['FSC-A'].mean(), applyto='data', output_format='dict'),
+            'arrays': plate.apply(lambda data: data['FSC-A'].values[:3], applyto='data', output_format='dict'),
+            'strings': plate.apply(lambda measurement: measurement.ID, output_format='dict'),
+            'mixed': dict((key, key if key.startswith('A') else 1.5) for key in plate.keys()),
+            'missing wells': {'A3': 1, 'C7': 2},
+            'layout': plate,
+        }
+        for name, result in results.items():
+            for noneval, dropna in [(np.nan, False), (np.nan, True), (0, False)]:
+                expected = _dict2DF_cell_by_cell(plate, result, noneval, dropna)
+                df = plate._dict2DF(result, noneval, dropna)
+                self.assertEqual(list(df.index), list(expected.index), name)
+                self.assertEqual(list(df.columns), list(expected.columns), name)
+                self.assertEqual(list(df.dtypes), list(expected.dtypes), name)
+                for row in df.index:
+                    for col in df.columns:
+                        if isinstance(expected.loc[row, col], FCMeasurement):
+                            self.assertIs(df.loc[row, col], expected.loc[row, col])
+                        else:
+                            np.testing.assert_array_equal(df.loc[row, col], expected.loc[row, col])
+
+        assert_equal(plate.apply(lambda measurement: measurement.counts).values,
+                     _dict2DF_cell_by_cell(plate, results['numbers'], np.nan).values)
+        dropped = plate.dropna()
+        self.assertEqual(dropped.row_labels, ['A', 'B', 'C'])
+        self.assertEqual(dropped.col_labels, [3, 4, 6, 7])
+        self.assertEqual(plate.layout.shape, (8, 12))
+
+    def test_filter_by_meta(self):
+        plate = FCPlate.from_dir('plate', test_data_dir, readmeta=False)
+        filtered = plate.filter_by_meta("$CYT == 'MACSQuant' and $TOT > 5000 and $SRC in ['A3', 'B4']")
+        self.assertEqual(sorted(filtered.keys()), ['A3', 'B4'])
+        self.assertEqual(sorted(plate.filter_by_meta(lambda table: table['$TOT'] > 10000).keys()), [])
+        self.assertRaises(KeyError, plate.filter_by_meta, '$NOT_A_KEYWORD > 0')
+
+        # The data of the measurements that do not satisfy the meta data query is not read
+        filtered = plate.filter(lambda data: data.shape[0] > 0, applyto='data', meta="$SRC == 'C7'")
+        self.assertEqual(list(filtered.keys()), ['C7'])
+        self.assertTrue(all(measurement._data is None for measurement in plate.values()))
+
+    def test_save_columnar(self):
+        gate = ThresholdGate(1000, 'SSC-A', 'above')
+        plate = self.fc_plate.transform('hlog', channels=['FSC-A'], b=10).gate(gate, apply_now=False)
+        path = tempfile.mkdtemp()
+        try:
+            saved_path = os.path.join(path, 'plate')
+            plate.save(saved_path, format='columnar')
+            loaded = FCPlate.load(saved_path)
+            measurement = loaded['A1']
+            self.assertIsNone(measurement._data)
+            self.assertEqual(measurement.counts, plate['A1'].counts)
+            self.assertEqual([name for name, params in measurement.history], ['transform', 'gate'])
+            self.assertEqual(loaded.get_positions(), plate.get_positions())
+            self.assertEqual(measurement.meta['$TOT'], plate['A1'].meta['$TOT'])
+            expected = plate['A1'].data
+            np.testing.assert_array_equal(measurement.data.values, expected.values)
+            np.testing.assert_array_equal(measurement.data.index, expected.index)
+            # The data is memory mapped from the saved file
+            base = measurement.data['SSC-A'].values
+            while base is not None and not isinstance(base, np.memmap):
+                base = base.base
+            self.assertIsInstance(base, np.memmap)
+            self.assertRaises(ValueError, loaded.save, saved_path, format='columnar')
+        finally:
+            shutil.rmtree(path)
+
+    def test_disk_collection(self):
+        gate = ThresholdGate(1000, 'SSC-A', 'above')
+        path = tempfile.mkdtemp()
+        try:
+            collection = FCDiskCollection.from_collection(self.fc_plate, store=path, chunk_size=1000)
+            self.assertEqual(collection.store.path, os.path.abspath(path))
+            gated = collection.transform('hlog', channels=['FSC-A'], b=10).gate(gate)
+            measurement = gated['A1']
+            self.assertIsNone(measurement._data)
+            self.assertEqual(measurement.queue, [])
+            self.assertEqual([name for name, params in measurement.history], ['transform', 'gate'])
+
+            expected = self.fc_plate.transform('hlog', channels=['FSC-A'], b=10).gate(gate)['A1'].data
+            self.assertEqual(measurement.counts, expected.shape[0])
+            np.testing.assert_allclose(measurement.data.values, expected.values)
+            np.testing.assert_array_equal(measurement.data.index, expected.index)
+
+            subsampled = gated.subsample(100)['A1']
+            self.assertEqual(subsampled.counts, 100)
+            self.assertTrue(subsampled.data.index.isin(expected.index).all())
+            np.testing.assert_array_equal(gated.subsample((0.0, 0.5))['A1'].data.values,
+                                          expected.values[:expected.shape[0] // 2])
+        finally:
+            shutil.rmtree(path)
+
+    def test_disk_collection_transform_does_not_depend_on_chunk_size(self):
+        plate = FCPlate.from_dir('plate', test_data_dir)
+        kwargs = dict(channels=['FSC-A', 'SSC-A'], b=10, share_transform=False)
+        expected = plate.transform('hlog', **kwargs)
+        paths = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        try:
+            results = [FCDiskCollection.from_collection(plate, store=path, chunk_size=chunk_size)
+                       .transform('hlog', **kwargs)
+                       for path, chunk_size in zip(paths, [500, 5000])]
+            for key in plate.keys():
+                for result in results:
+                    np.testing.assert_array_equal(result[key].data.values, expected[key].data.values)
+        finally:
+            for path in paths:
+                shutil.rmtree(path)
@@ -1,15 +1,24 @@
 from __future__ import print_function
 
+import bz2
+import gzip
+import io
 import os
+import pickle
+import shutil
+import tempfile
 import timeit
 import unittest
 import warnings
+import zipfile
 
 import numpy
 from numpy import array
 
 from fcsparser import parse as parse_fcs
 
+from FlowCytometryTools.IO import fcsreader
+
 base_path = os.path.dirname(os.path.realpath(__file__))
 
 file_formats = {
@@ -21,6 +30,61 @@ file_formats = {
                     'large fake fcs':    os.path.join(base_path, 'data', 'FlowCytometers', 'fake_large_fcs', 'fake_large_fcs.fcs'),
                }
 
+def make_fcs(data, channel_names, datatype='F', bits=None, byteord='1,2,3,4', ranges=None,
+             data_bytes=None, extra_keywords=None, nextdata=0):
+    """
+    Builds the content (bytes) of a minimal FCS 3.0 file holding the given events.
+
+    data_bytes can be used to provide an already encoded DATA segment (e.g., for bit packed data).
+    """
+    if extra_keywords is None:
+        extra_keywords = {}
+    data = numpy.asarray(data)
+    num_events, num_pars = data.shape
+    if bits is None:
+        bits = [data.dtype.itemsize * 8] * num_pars
+    if ranges is None:
+        ranges = [2 ** 18] * num_pars
+    if data_bytes is None:
+        endian = '<' if byteord == '1,2,3,4' else '>'
+        data_bytes = data.astype(data.dtype.newbyteorder(endian)).tobytes()
+
+    def build_text(begin_data, end_data):
+        keywords = [('$BEGINANALYSIS', '0'), ('$ENDANALYSIS', '0'),
+                    ('$BEGINSTEXT', '0'), ('$ENDSTEXT', '0'),
+                    ('$BEGINDATA', '{0:012d}'.format(begin_data)),
+                    ('$ENDDATA', '{0:012d}'.format(end_data)),
+                    ('$BYTEORD', byteord), ('$DATATYPE', datatype), ('$MODE', 'L'),
+                    ('$NEXTDATA', '{0:012d}'.format(nextdata)),
+                    ('$PAR', str(num_pars)), ('$TOT', str(num_events))]
+        for i, name in enumerate(channel_names):
+            keywords += [('$P{0}B'.format(i + 1), str(bits[i])), ('$P{0}E'.format(i + 1), '0,0'),
+                         ('$P{0}N'.format(i + 1), name), ('$P{0}R'.format(i + 1), str(ranges[i]))]
+        keywords += sorted(extra_keywords.items())
+        return ('/' + ''.join('{0}/{1}/'.format(k, v) for k, v in keywords)).encode('latin-1')
+
+    text_start = 58
+    text_length = len(build_text(0, 0))
+    data_start = text_start + text_length
+    data_end = data_start + len(data_bytes) - 1
+    text = build_text(data_start, data_end)
+    header = 'FCS3.0    ' + ''.join('{0:>8}'.format(v) for v in
+                                    [text_start, data_start - 1, 0, 0, 0, 0])
+    return header.encode('latin-1') + text + data_bytes
+
+def pack_bits(values, bit_widths, msb_first=True):
+    """ Packs integer events (events x parameters) into a bit stream (reference implementation). """
+    bits = []
+    for event in values:
+        for value, width in zip(event, bit_widths):
+            order = range(width - 1, -1, -1) if msb_first else range(width)
+            bits.extend((int(value) >> k) & 1 for k in order)
+    bits += [0] * (-len(bits) % 8)
+    bits = numpy.array(bits, dtype=numpy.uint8).reshape(-1, 8)
+    if not msb_first:
+        bits = bits[:, ::-1]
+    return numpy.packbits(bits.ravel()).tobytes()
+
 def check_data_segment(fcs_format, array_values):
     fname = file_formats[fcs_format]
     meta, matrix = parse_fcs(fname, output_format='ndarray')
@@ -159,35 +223,34 @@ class TestFCSReader(unittest.TestCase):
                   6.99999988079071044922e-01]])
         self.assertTrue(check_data_segment('LSR II fcs 3.0', values))
 
-    #def test_BD_LSR_II_auto_compensation(self):
-        #""" Tests auto compensation for DATA segment parsed from FCS (3.0 format) file produced by a HTS BD LSR-II flow cytometer """
-        #values = array([[ -2.85312500000000000000e+04,   1.00000000000000000000e+01,
-                  #0.00000000000000000000e+00,   7.00149963378906250000e+02,
-                  #1.65600000000000000000e+03,   2.77083515625000000000e+04,
-                  #6.83360908869141923105e+01,   5.41499977111816406250e+01,
-                  #1.60309407527416652783e+02,   1.20360000610351562500e+02,
-                  #2.00000002980232238770e-01],
-               #[ -4.94148789062500000000e+04,   8.00000000000000000000e+00,
-                  #0.00000000000000000000e+00,   1.27584997558593750000e+03,
-                  #2.27800000000000000000e+03,   3.67050507812500000000e+04,
-                  #1.26861305474787926073e+02,   1.33000001907348632812e+01,
-                  #1.57151863392994528112e+02,   9.48600006103515625000e+01,
-                  #4.00000005960464477539e-01],
-               #[ -5.86843203125000000000e+04,   1.40000000000000000000e+01,
-                  #0.00000000000000000000e+00,  -5.12049987792968750000e+02,
-                  #4.72000000000000000000e+02,   0.00000000000000000000e+00,
-                 #-7.98914648525230663978e+00,   8.55000019073486328125e+00,
-                  #1.71012164279341703832e+02,   8.56800003051757812500e+01,
-                  #5.00000000000000000000e-01],
-               #[ -3.85783984375000000000e+03,   4.32000000000000000000e+02,
-                  #0.00000000000000000000e+00,   2.76449981689453125000e+02,
-                  #1.33900000000000000000e+03,   1.35305644531250000000e+04,
-                 #-7.81109156139110325512e+01,   3.42000007629394531250e+01,
-                  #1.57003241830382449962e+02,   8.97599945068359375000e+01,
-                  #6.99999988079071044922e-01]])
-        ##self.checkTrue(check_data_segment('LSR II fcs 3.0', values))
-        ##self.assertTrue(1)
-        #warnings.warn('This test has not yet been implemented.')
+    def test_BD_LSR_II_auto_compensation(self):
+        """ Tests auto compensation for DATA segment parsed from FCS (3.0 format) file produced by a HTS BD LSR-II flow cytometer """
+        values = array([[ -2.85312500000000000000e+04,   1.00000000000000000000e+01,
+                  0.00000000000000000000e+00,   7.00149963378906250000e+02,
+                  1.65600000000000000000e+03,   2.77083515625000000000e+04,
+                  6.83360908869141923105e+01,   5.41499977111816406250e+01,
+                  1.60309407527416652783e+02,   1.20360000610351562500e+02,
+                  2.00000002980232238770e-01],
+               [ -4.94148789062500000000e+04,   8.00000000000000000000e+00,
+                  0.00000000000000000000e+00,   1.27584997558593750000e+03,
+                  2.27800000000000000000e+03,   3.67050507812500000000e+04,
+                  1.26861305474787926073e+02,   1.33000001907348632812e+01,
+                  1.57151863392994528112e+02,   9.48600006103515625000e+01,
+                  4.00000005960464477539e-01],
+               [ -5.86843203125000000000e+04,   1.40000000000000000000e+01,
+                  0.00000000000000000000e+00,  -5.12049987792968750000e+02,
+                  4.72000000000000000000e+02,   0.00000000000000000000e+00,
+                 -7.98914648525230663978e+00,   8.55000019073486328125e+00,
+                  1.71012164279341703832e+02,   8.56800003051757812500e+01,
+                  5.00000000000000000000e-01],
+               [ -3.85783984375000000000e+03,   4.32000000000000000000e+02,
+                  0.00000000000000000000e+00,   2.76449981689453125000e+02,
+                  1.33900000000000000000e+03,   1.35305644531250000000e+04,
+                 -7.81109156139110325512e+01,   3.42000007629394531250e+01,
+                  1.57003241830382449962e+02,   8.97599945068359375000e+01,
+                  6.99999988079071044922e-01]])
+        meta, data = fcsreader.parse_fcs(file_formats['LSR II fcs 3.0'], compensate=True, cache=False)
+        numpy.testing.assert_allclose(data.values[:4, :], values, rtol=1e-5)
 
     def test_Fortessa_data_segment(self):
         """ Tests DATA segment parsed from FCS (3.0 format) file produced by the Fortessa flow cytometer. """
@@ -297,14 +360,17 @@ class TestFCSReader(unittest.TestCase):
 
         print()
 
-        time = timeit.timeit(lambda : parse_fcs(fname, meta_data_only=True, output_format='DataFrame', reformat_meta=False), number=number)
-        print("Loading fcs file {0} times with meta_data only without reformatting of meta takes {1} per loop".format(time/number, number))
+        for parser_name, parser in [('fcsparser', parse_fcs), ('fcsreader', fcsreader.parse_fcs)]:
+            print(parser_name)
 
-        time = timeit.timeit(lambda : parse_fcs(fname, meta_data_only=True, output_format='DataFrame', reformat_meta=True), number=number)
-        print("Loading fcs file {0} times with meta_data only with reformatting of meta takes {1} per loop".format(time/number, number))
+            time = timeit.timeit(lambda : parser(fname, meta_data_only=True, output_format='DataFrame', reformat_meta=False), number=number)
+            print("Loading fcs file {0} times with meta_data only without reformatting of meta takes {1} per loop".format(time/number, number))
 
-        time = timeit.timeit(lambda : parse_fcs(fname, meta_data_only=False, output_format='DataFrame', reformat_meta=False), number=number)
-        print("Loading fcs file {0} times both meta and data but without reformatting of meta takes {1} per loop".format(time/number, number))
+            time = timeit.timeit(lambda : parser(fname, meta_data_only=True, output_format='DataFrame', reformat_meta=True), number=number)
+            print("Loading fcs file {0} times with meta_data only with reformatting of meta takes {1} per loop".format(time/number, number))
+
+            time = timeit.timeit(lambda : parser(fname, meta_data_only=False, output_format='DataFrame', reformat_meta=False), number=number)
+            print("Loading fcs file {0} times both meta and data but without reformatting of meta takes {1} per loop".format(time/number, number))
 
     def test_reading_corrupted_fcs_file(self):
         """ Raising exception when reading a corrupted fcs file. """
@@ -331,6 +397,417 @@ class TestFCSReader(unittest.TestCase):
                  -1.29600010e+01,   1.00000001e-01]], dtype=numpy.float32)
         self.assertTrue(check_data_segment('large fake fcs', values))
 
+class TestFCSParser(unittest.TestCase):
+    """ Tests for the features of the FCS parser in FlowCytometryTools.IO.fcsreader """
+
+    def test_memory_map(self):
+        """ Memory mapped DATA segment matches the data read into memory. """
+        for fcs_format in ['mq fcs 3.1', 'LSR II fcs 3.0']:
+            fname = file_formats[fcs_format]
+            meta, data = fcsreader.parse_fcs(fname, output_format='ndarray')
+            meta, data_mmap = fcsreader.parse_fcs(fname, output_format='ndarray', memory_map=True)
+            self.assertTrue(isinstance(data_mmap, numpy.memmap))
+            self.assertTrue(numpy.array_equal(data, data_mmap))
+
+            meta, df = fcsreader.parse_fcs(fname, output_format='DataFrame')
+            meta, df_mmap = fcsreader.parse_fcs(fname, output_format='DataFrame', memory_map=True)
+            self.assertTrue(df.equals(df_mmap))
+
+            parser = fcsreader.FCS_Parser(fname, memory_map=True)
+            column = parser.get_channel_data(1)
+            self.assertTrue(column.dtype.isnative)
+            self.assertTrue(numpy.array_equal(column, data[:, 1]))
+
+    def test_channel_selection(self):
+        """ Only the requested channels are read from the DATA segment. """
+        fname = file_formats['LSR II fcs 3.0']
+        meta, data = fcsreader.parse_fcs(fname)
+        channels = ['SSC-A', 'FSC-A']
+
+        for memory_map in [False, True]:
+            meta, subset = fcsreader.parse_fcs(fname, channels=channels, memory_map=memory_map)
+            self.assertEqual(list(subset.columns), channels)
+            self.assertTrue(data[channels].equals(subset))
+
+        meta, subset = fcsreader.parse_fcs(fname, channels='FSC-A', output_format='ndarray')
+        self.assertEqual(subset.shape, (data.shape[0], 1))
+        self.assertRaises(ValueError, fcsreader.parse_fcs, fname, channels=['not a channel'])
+
+    def test_memory_mapped_channel_selection_shape(self):
+        """ Memory mapped channel subsets are (events x channels), as for the other sources. """
+        values = numpy.arange(40, dtype=numpy.float32).reshape(10, 4)
+        content = make_fcs(values, ['a', 'b', 'c', 'd'])
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'test.fcs')
+            with open(path, 'wb') as f:
+                f.write(content)
+            for channels, columns in [(['b', 'd'], [1, 3]), (['d', 'b'], [3, 1]),
+                                      (['a', 'b', 'd'], [0, 1, 3]), (['c'], [2])]:
+                meta, mapped = fcsreader.parse_fcs(path, channels=channels, output_format='ndarray',
+                                                   memory_map=True)
+                meta, read = fcsreader.parse_fcs(io.BytesIO(content), channels=channels,
+                                                 output_format='ndarray', memory_map=True)
+                self.assertEqual(mapped.shape, read.shape)
+                self.assertEqual(mapped.shape, (10, len(channels)))
+                numpy.testing.assert_array_equal(mapped, values[:, columns])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_iter_events(self):
+        """ Streaming the DATA segment in blocks gives back all the events. """
+        fname = file_formats['LSR II fcs 3.0']
+        meta, data = fcsreader.parse_fcs(fname, output_format='ndarray')
+        parser = fcsreader.FCS_Parser(fname, read_data=False)
+
+        chunks = list(parser.iter_events(chunk_size=4000))
+        self.assertEqual([len(c) for c in chunks], [4000, 4000, 4000, 2945])
+        self.assertTrue(numpy.array_equal(numpy.vstack(chunks), data))
+
+        chunks = list(parser.iter_events(chunk_size=4000, channels=[3, 0]))
+        self.assertTrue(numpy.array_equal(numpy.vstack(chunks), data[:, [3, 0]]))
+
+    def test_analysis_segment(self):
+        """ The ANALYSIS segment is read when first accessed. """
+        values = numpy.arange(6, dtype=numpy.float32).reshape(3, 2)
+        content = make_fcs(values, ['A', 'B'])
+        parser = fcsreader.FCS_Parser(io.BytesIO(content))
+        self.assertEqual(parser.analysis, '')
+
+        analysis = b'/GATE/R1/'
+        start = len(content)
+        header = content[:42] + '{0:>8}{1:>8}'.format(start, start + len(analysis) - 1).encode('latin-1')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            parser = fcsreader.FCS_Parser(io.BytesIO(header + content[58:] + analysis), read_data=False)
+        self.assertEqual(parser.analysis, analysis)
+        numpy.testing.assert_array_equal(parser.data, values)
+
+    def test_multiple_datasets(self):
+        """ Data sets chained through $NEXTDATA are indexed and read individually. """
+        first = numpy.arange(30, dtype=numpy.float32).reshape(10, 3)
+        second = -numpy.arange(8, dtype=numpy.float32).reshape(4, 2)
+        first_bytes = make_fcs(first, ['A', 'B', 'C'])
+        first_bytes = make_fcs(first, ['A', 'B', 'C'], nextdata=len(first_bytes))
+        content = first_bytes + make_fcs(second, ['D', 'E'], byteord='4,3,2,1')
+
+        with tempfile.NamedTemporaryFile(suffix='.fcs', delete=False) as f:
+            f.write(content)
+        try:
+            datasets = fcsreader.index_datasets(f.name)
+            self.assertEqual(len(datasets), 2)
+            self.assertEqual([d['$TOT'] for d in datasets], [10, 4])
+            self.assertEqual(datasets[1]['offset'], len(first_bytes))
+
+            meta, data = fcsreader.parse_fcs(f.name, output_format='ndarray')
+            self.assertTrue(numpy.array_equal(data, first))
+            meta, data = fcsreader.parse_fcs(f.name, dataset=1)
+            self.assertEqual(list(data.columns), ['D', 'E'])
+            self.assertTrue(numpy.array_equal(data.values, second))
+            self.assertRaises(ValueError, fcsreader.parse_fcs, f.name, dataset=2)
+        finally:
+            os.remove(f.name)
+
+    def test_lru_cache(self):
+        """ The module level caches keep only their most recently used entries. """
+        cache = fcsreader._LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)  # 'b' is now the least recently used entry
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('b', cache)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertIsNone(cache.get('b'))
+        self.assertTrue(isinstance(fcsreader._dataset_index_cache, fcsreader._LRUCache))
+
+    def test_scan_metadata(self):
+        """ Meta data of several files is collected into a single table. """
+        paths = [file_formats['mq fcs 3.1'], file_formats['LSR II fcs 3.0']]
+        table = fcsreader.scan_metadata(paths, keys=['$CYT', '$PAR', '$NOT_A_KEYWORD'], workers=2)
+        self.assertEqual(list(table.index), paths)
+        self.assertEqual(list(table['$CYT']), ['MACSQuant', 'LSRII'])
+        self.assertEqual([int(x) for x in table['$PAR']], [19, 11])
+        self.assertTrue(table['$NOT_A_KEYWORD'].isnull().all())
+
+        table = fcsreader.scan_metadata(paths, output_format='dict')
+        meta = fcsreader.parse_fcs(paths[1], meta_data_only=True)
+        self.assertEqual(table['$CYT'][1], meta['$CYT'])
+
+        # Values that look like keywords are not taken for them
+        text = '/$P1N/$TOT/$TOT/5/A/SPILL//x/SPILL/1/$P2N/B//C/'
+        self.assertEqual(fcsreader._extract_keywords(text, ['$TOT', 'SPILL', '$P2N', 'B', '$PAR']),
+                         {'$TOT': '5', 'SPILL': '1', '$P2N': 'B/C', 'B': None, '$PAR': None})
+
+        corrupted = os.path.join(base_path, 'data', 'FlowCytometers', 'corrupted', 'corrupted.fcs')
+        self.assertRaises(ValueError, fcsreader.scan_metadata, [corrupted])
+        table = fcsreader.scan_metadata(paths + [corrupted], keys='$CYT', errors='ignore')
+        self.assertTrue(table['$CYT'].isnull()[corrupted])
+
+    def test_parse_cache(self):
+        """ Parsed files are stored in the cache and reopened from it. """
+        path = file_formats['mq fcs 3.1']
+        directory = tempfile.mkdtemp()
+        try:
+            cache = fcsreader.ParseCache(directory)
+            meta, data = fcsreader.parse_fcs(path, cache=False)
+            cached_meta, cached_data = fcsreader.parse_fcs(path, cache=cache)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            numpy.testing.assert_array_equal(cached_data.values, data.values)
+            self.assertEqual(list(cached_data.columns), list(data.columns))
+            self.assertEqual(cached_meta['$TOT'], meta['$TOT'])
+            raw_meta = fcsreader.parse_fcs(path, cache=cache, meta_data_only=True)
+            self.assertEqual([type(raw_meta[key]) for key in ['$TOT', '$PAR', '$P1B']], [int] * 3)
+
+            # Served from the cache
+            cached_meta, cached_data = fcsreader.parse_fcs(path, cache=cache, output_format='ndarray',
+                                                           channels=['V2-A', 'FSC-A'])
+            numpy.testing.assert_array_equal(cached_data, data[['V2-A', 'FSC-A']].values)
+            meta = fcsreader.parse_fcs(path, cache=cache, meta_data_only=True, reformat_meta=True)
+            self.assertIn('_channels_', meta)
+
+            # Least recently used entries are evicted when the cache gets too large
+            cache.max_size = 1
+            cache.evict()
+            self.assertEqual(cache.size, 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dtype(self):
+        """ The events are returned in the requested data type. """
+        path = file_formats['mq fcs 3.1']
+        meta, data = fcsreader.parse_fcs(path)
+        self.assertEqual(set(data.dtypes), set([numpy.dtype('float32')]))
+
+        meta, data64 = fcsreader.parse_fcs(path, dtype='float64')
+        self.assertEqual(set(data64.dtypes), set([numpy.dtype('float64')]))
+        numpy.testing.assert_array_equal(data64.values, data.values)
+
+        fcsreader.set_dtype_policy('float64')
+        try:
+            meta, data = fcsreader.parse_fcs(path, output_format='ndarray', memory_map=True)
+            self.assertEqual(data.dtype, numpy.dtype('float64'))
+            meta, data = fcsreader.parse_fcs(path, output_format='ndarray', dtype='float32')
+            self.assertEqual(data.dtype, numpy.dtype('float32'))
+        finally:
+            fcsreader.set_dtype_policy(None)
+
+        # Channels of different widths are combined into a single array
+        records = numpy.array([(1, 2), (3, 4)], dtype=[('a', 'u1'), ('b', '<u2')])
+        content = make_fcs(numpy.zeros((2, 2)), ['a', 'b'], datatype='I', bits=[8, 16],
+                           data_bytes=records.tobytes())
+        with tempfile.NamedTemporaryFile(suffix='.fcs', delete=False) as f:
+            f.write(content)
+        try:
+            meta, data = fcsreader.parse_fcs(f.name, output_format='ndarray', dtype='float32')
+            numpy.testing.assert_array_equal(data, numpy.array([[1, 2], [3, 4]], dtype='float32'))
+        finally:
+            os.remove(f.name)
+
+    def test_parse_many(self):
+        """ Several files are parsed concurrently. """
+        paths = [file_formats['mq fcs 3.1'], file_formats['LSR II fcs 3.0'], file_formats['mq fcs 2.0']]
+        expected = [fcsreader.parse_fcs(path) for path in paths]
+
+        for backend in ('thread', 'process'):
+            results = fcsreader.parse_many(paths, workers=2, backend=backend)
+            for (meta, data), (expected_meta, expected_data) in zip(results, expected):
+                self.assertEqual(meta['$TOT'], expected_meta['$TOT'])
+                numpy.testing.assert_array_equal(data.values, expected_data.values)
+
+        results = dict(fcsreader.parse_many(paths, workers=3, ordered=False, meta_data_only=True))
+        self.assertEqual(sorted(results), sorted(paths))
+        self.assertEqual(results[paths[1]]['$CYT'], 'LSRII')
+
+        corrupted = os.path.join(base_path, 'data', 'FlowCytometers', 'corrupted', 'corrupted.fcs')
+        self.assertRaises(ValueError, fcsreader.parse_many, paths + [corrupted], workers=2)
+        results = fcsreader.parse_many([corrupted] + paths, workers=2, errors='return', meta_data_only=True)
+        self.assertIsInstance(results[0], ValueError)
+        self.assertEqual(results[1]['$TOT'], expected[0][0]['$TOT'])
+
+    def test_text_segment(self):
+        """ Escaped delimiters are decoded and numeric keywords are converted on access. """
+        text = fcsreader._parse_text(b'/$CYT/A//B/$P1N/FSC//H/OWNER//NAME/x///EMPTY//NEXT/1/')
+        self.assertEqual(text, {'$CYT': 'A/B', '$P1N': 'FSC/H', 'OWNER/NAME': 'x/', 'EMPTY/NEXT': '1'})
+
+        extra_keywords = dict(('K{0}'.format(i), 'a|b' * (1 + i % 3)) for i in range(5000))
+        extra_keywords['SPILL'] = '2,A,B,1,0.1,0.2,1'
+        content = make_fcs(numpy.ones((3, 2), dtype=numpy.float32), ['A', 'B'],
+                           extra_keywords=extra_keywords)
+        with tempfile.NamedTemporaryFile(suffix='.fcs', delete=False) as f:
+            f.write(content)
+        try:
+            parser = fcsreader.FCS_Parser(f.name, read_data=False)
+            meta = parser.annotation
+            self.assertEqual(meta['K4'], 'a|ba|b')
+            self.assertEqual(meta['SPILL'], extra_keywords['SPILL'])
+            self.assertEqual(meta['$P1B'], 32)
+            self.assertEqual(dict(meta.items())['$P2B'], 32)
+            self.assertEqual(meta.copy()['$NEXTDATA'], 0)
+            self.assertEqual(pickle.loads(pickle.dumps(meta))['$TOT'], 3)
+            self.assertEqual(parser.get_channel_keys('N'), ['$P1N', '$P2N'])
+        finally:
+            os.remove(f.name)
+
+    def test_compressed_files(self):
+        """ Compressed files are decompressed while being read. """
+        path = file_formats['LSR II fcs 3.0']
+        meta, data = fcsreader.parse_fcs(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        compressed_files = [('.gz', gzip.GzipFile), ('.bz2', bz2.BZ2File)]
+        try:
+            import lzma
+            compressed_files.append(('.xz', lzma.LZMAFile))
+        except ImportError:
+            pass
+
+        directory = tempfile.mkdtemp()
+        try:
+            for extension, compressed_file in compressed_files:
+                compressed_path = os.path.join(directory, 'file.fcs' + extension)
+                with compressed_file(compressed_path, 'wb') as f:
+                    f.write(content)
+
+                compressed_meta, compressed_data = fcsreader.parse_fcs(compressed_path)
+                self.assertEqual(compressed_meta['$TOT'], meta['$TOT'])
+                numpy.testing.assert_array_equal(compressed_data.values, data.values)
+
+                compressed_meta, compressed_data = fcsreader.parse_fcs(compressed_path, memory_map=True,
+                                                                       channels=['SSC-A', 'FSC-A'])
+                numpy.testing.assert_array_equal(compressed_data.values, data[['SSC-A', 'FSC-A']].values)
+
+                parser = fcsreader.FCS_Parser(compressed_path, read_data=False)
+                chunks = list(parser.iter_events(chunk_size=5000))
+                numpy.testing.assert_array_equal(numpy.vstack(chunks), data.values)
+
+            # bz2 files may hold several streams; seeking backwards starts the decompression over
+            stream = fcsreader._BZ2Stream(io.BytesIO(bz2.compress(content[:1000]) + bz2.compress(content[1000:])))
+            stream.seek(500)
+            self.assertEqual(stream.read(1000), content[500:1500])
+            stream.seek(10)
+            self.assertEqual(stream.read(20), content[10:30])
+            self.assertEqual(stream.tell(), 30)
+            self.assertEqual(stream.read(), content[30:])
+
+            truncated_path = os.path.join(directory, 'truncated.fcs.bz2')
+            with bz2.BZ2File(truncated_path, 'wb') as f:
+                f.write(content[:-100])
+            self.assertRaises(ValueError, fcsreader.parse_fcs, truncated_path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_bytes_and_file_like_inputs(self):
+        """ FCS files can be parsed from bytes, file-like objects and zip archives. """
+        path = file_formats['LSR II fcs 3.0']
+        meta, data = fcsreader.parse_fcs(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        # On python 2 bytes are str; the content is told apart from paths by its first bytes
+        self.assertTrue(fcsreader._is_content(content))
+        self.assertTrue(fcsreader._is_content(bz2.compress(content[:100])))
+        self.assertFalse(fcsreader._is_content(path))
+        self.assertFalse(fcsreader._is_content(os.path.join('FCS3.0', 'BZh91AY&SY.fcs')))
+
+        for source in [content, bytearray(content), io.BytesIO(content), open(path, 'rb')]:
+            source_meta, source_data = fcsreader.parse_fcs(source, memory_map=True)
+            self.assertEqual(source_meta['$TOT'], meta['$TOT'])
+            numpy.testing.assert_array_equal(source_data.values, data.values)
+            source_meta, source_data = fcsreader.parse_fcs(source, channels=['SSC-A'])
+            numpy.testing.assert_array_equal(source_data.values, data[['SSC-A']].values)
+            if hasattr(source, 'close'):
+                self.assertFalse(source.closed)
+                source.close()
+
+        directory = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(directory, 'plate.zip')
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as f:
+                f.write(path, 'export/Well_A1.fcs')
+                f.write(file_formats['mq fcs 3.1'], 'export/Well_A2.fcs', compress_type=zipfile.ZIP_STORED)
+                f.writestr('export/notes.txt', 'not an FCS file')
+
+            members = fcsreader.list_zip_members(archive)
+            self.assertEqual([m.member for m in members], ['export/Well_A1.fcs', 'export/Well_A2.fcs'])
+            self.assertEqual(os.path.basename(members[0]), 'Well_A1.fcs')
+            member_meta, member_data = fcsreader.parse_fcs(members[0])
+            numpy.testing.assert_array_equal(member_data.values, data.values)
+            self.assertEqual(fcsreader.parse_fcs(members[1], meta_data_only=True)['$CYT'], 'MACSQuant')
+            self.assertEqual(pickle.loads(pickle.dumps(members[1])).member, 'export/Well_A2.fcs')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_spillover(self):
+        """ Spillover matrices are parsed from the TEXT segment and their inverse is shared. """
+        meta = fcsreader.parse_fcs(file_formats['LSR II fcs 3.0'], meta_data_only=True)
+        names, matrix = fcsreader.get_spillover(meta)
+        self.assertEqual(matrix.shape, (len(names), len(names)))
+        numpy.testing.assert_array_equal(numpy.diag(matrix), 1)
+        inverse = fcsreader.get_compensation_matrix(matrix)
+        self.assertIs(fcsreader.get_compensation_matrix(matrix.copy()), inverse)
+        numpy.testing.assert_allclose(numpy.dot(matrix, inverse), numpy.eye(len(names)), atol=1e-12)
+
+        # A matrix in use stays cached while many other matrices come and go
+        for i in range(300):
+            fcsreader.get_compensation_matrix(numpy.eye(2) + 0.001 * i * numpy.eye(2)[::-1])
+            self.assertIs(fcsreader.get_compensation_matrix(matrix), inverse)
+        self.assertEqual(len(fcsreader._compensation_matrices), 256)
+
+        values = numpy.ones((3, len(names)), dtype=numpy.float32)
+        self.assertEqual(fcsreader.apply_compensation(values, matrix).dtype, numpy.float32)
+
+        self.assertRaises(ValueError, fcsreader.parse_spillover, '2,A,B,1,0,0')
+        self.assertRaises(ValueError, fcsreader.parse_fcs, file_formats['mq fcs 3.1'], compensate=True)
+        self.assertRaises(ValueError, fcsreader.parse_fcs, file_formats['LSR II fcs 3.0'],
+                          channels=['FSC-A'], compensate=True)
+
+    def test_channel_table(self):
+        """ Channel properties are held in shared ChannelTables, looked up by channel name or number. """
+        fname = file_formats['LSR II fcs 3.0']
+        meta = fcsreader.parse_fcs(fname, meta_data_only=True, reformat_meta=True)
+        table = meta['_channels_']
+        self.assertTrue(isinstance(table, fcsreader.ChannelTable))
+        self.assertNotIn('$P1N', meta)
+        self.assertEqual(len(table), meta['$PAR'])
+        self.assertEqual(table.get('FSC-A', '$PnN'), 'FSC-A')
+        self.assertEqual(table.get(1, '$PnN'), table['$PnN'][0])
+        self.assertEqual(table.position('FSC-A'), list(meta['_channel_names_']).index('FSC-A'))
+        self.assertIsNone(table.get('not a channel', '$PnR'))
+
+        other = fcsreader.parse_fcs(fname, meta_data_only=True, reformat_meta=True)['_channels_']
+        self.assertIs(other, table)
+        self.assertIs(pickle.loads(pickle.dumps(table)), table)
+
+        frame = table.to_frame()
+        self.assertEqual(list(frame.columns), list(table.fields))
+        self.assertEqual(list(frame['$PnN']), list(table['$PnN']))
+
+    def test_bit_packed_integers(self):
+        """ Integer parameters with arbitrary bit widths are unpacked and masked to $PnR. """
+        numpy.random.seed(0)
+        widths = [10, 12, 18, 8]
+        values = numpy.column_stack([numpy.random.randint(0, 2 ** w, size=101) for w in widths])
+
+        for byteord, msb_first in [('4,3,2,1', True), ('1,2,3,4', False)]:
+            content = make_fcs(values, ['A', 'B', 'C', 'D'], datatype='I', bits=widths, byteord=byteord,
+                               ranges=[2 ** w for w in widths[:3]] + [100],
+                               data_bytes=pack_bits(values, widths, msb_first))
+            with tempfile.NamedTemporaryFile(suffix='.fcs', delete=False) as f:
+                f.write(content)
+            try:
+                meta, data = fcsreader.parse_fcs(f.name, output_format='ndarray')
+                expected = values.copy()
+                expected[:, 3] &= 127  # $PnR = 100 -> 7 bit mask
+                self.assertTrue(numpy.array_equal(data, expected))
+
+                parser = fcsreader.FCS_Parser(f.name, read_data=False)
+                chunks = list(parser.iter_events(chunk_size=7, channels=['C', 'A']))
+                self.assertTrue(numpy.array_equal(numpy.vstack(chunks), expected[:, [2, 0]]))
+            finally:
+                os.remove(f.name)
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=[__file__,'-vvs','-x'],
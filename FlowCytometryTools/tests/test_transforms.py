@@ -7,9 +7,10 @@ import unittest
 import numpy as np
 from numpy.testing import assert_almost_equal, assert_equal
 
-from FlowCytometryTools import FCMeasurement, FCPlate
+from FlowCytometryTools import FCMeasurement, FCPlate, ThresholdGate
 from FlowCytometryTools.core import transforms as trans
 from FlowCytometryTools.core.transforms import Transformation
+from FlowCytometryTools.core import sharedmem
 
 base_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -159,3 +160,88 @@ class TestTransforms(unittest.TestCase):
         for transformation, channels, kwargs in test_cases:
             self.fc_measurement.transform(transformation, channels=channels, **kwargs)
             self.fc_plate.transform(transformation, channels=channels, **kwargs)
+
+    def test_transform_dtype(self):
+        x = _xpos.astype(np.float32)
+        transformation = Transformation(transform='tlog', direction='forward')
+        self.assertEqual(transformation(x).dtype, np.float64)
+        self.assertEqual(transformation(x, dtype='float32').dtype, np.float32)
+        self.assertEqual(transformation(x, use_spln=True, dtype='float32').dtype, np.float32)
+
+        transformed = self.fc_measurement.transform('hlog', channels=['FSC-A'], dtype='float32')
+        self.assertEqual(transformed.data['FSC-A'].dtype, np.float32)
+        self.assertEqual(transformed.data['SSC-A'].dtype, self.fc_measurement.data['SSC-A'].dtype)
+
+    def test_transform_in_shared_memory_pool(self):
+        expected = self.fc_plate.transform('hlog', channels=['FSC-A', 'SSC-A'], b=10)
+        with sharedmem.SharedMemoryPool(2) as pool:
+            result = self.fc_plate.transform('hlog', channels=['FSC-A', 'SSC-A'], b=10, pool=pool)
+            counts = self.fc_plate.counts(pool=pool)
+        np.testing.assert_array_equal(result['A1'].data.values, expected['A1'].data.values)
+        assert_equal(counts.values, self.fc_plate.counts().values)
+
+    @unittest.skipIf(not os.path.isdir('/dev/shm'), 'requires /dev/shm')
+    def test_shared_memory_pool_releases_blocks(self):
+        from FlowCytometryTools.core.sharedmem import methodcaller
+        broken = self.fc_measurement.copy()
+        broken.data = broken.data[['SSC-A']]  # cannot be transformed
+        measurements = [self.fc_measurement, self.fc_measurement.copy(), broken, self.fc_measurement.copy()]
+        func = methodcaller('transform', 'hlog', channels=['FSC-A'], b=10, use_spln=False)
+        before = set(os.listdir('/dev/shm'))
+        with sharedmem.SharedMemoryPool(2) as pool:
+            results = pool.map(func, measurements[:2] * 5)
+            self.assertEqual(len(results), 10)
+            self.assertEqual(set(os.listdir('/dev/shm')), before)
+            for chunksize in [1, 2]:
+                self.assertRaises(KeyError, pool.map, func, measurements, chunksize=chunksize)
+                self.assertEqual(set(os.listdir('/dev/shm')), before)
+
+    def test_shared_frame_in_mapped_file(self):
+        # The blocks used where multiprocessing.shared_memory is not available (python < 3.8)
+        data = self.fc_measurement.data.iloc[::7]
+        block_type = sharedmem._SharedMemory
+        sharedmem._SharedMemory = sharedmem._FileBlock
+        try:
+            shm, frame = sharedmem.SharedFrame.from_frame(data)
+            self.assertTrue(os.path.isfile(frame.name))
+            shm.close()
+            result = frame.read()
+        finally:
+            sharedmem._SharedMemory = block_type
+        self.assertFalse(os.path.exists(frame.name))
+        np.testing.assert_array_equal(result.values, data.values)
+        np.testing.assert_array_equal(result.index, data.index)
+        self.assertEqual(list(result.columns), list(data.columns))
+
+    def test_transform_with_n_jobs(self):
+        plate = FCPlate('plate', measurements={'A1': self.fc_measurement, 'A2': self.fc_measurement.copy()},
+                        position_mapper='name')
+        expected = plate.transform('hlog', channels=['FSC-A'], b=10)
+        for backend in ['thread', 'process']:
+            result = plate.transform('hlog', channels=['FSC-A'], b=10, n_jobs=2, backend=backend)
+            for key in ['A1', 'A2']:
+                np.testing.assert_array_equal(result[key].data.values, expected[key].data.values)
+        self.assertRaises(ValueError, plate.counts, n_jobs=2, backend='cluster')
+
+    def test_apply_queued_transform_and_gate(self):
+        gate = ThresholdGate(1000, 'SSC-A', 'above')
+        kwargs = dict(channels=['FSC-A'], use_spln=False, b=10)
+        queued = self.fc_measurement.transform('hlog', apply_now=False, **kwargs)
+        queued = queued.gate(gate, apply_now=False)
+        self.assertIn('moved before step 1', queued.explain())
+
+        expected = self.fc_measurement.transform('hlog', **kwargs).gate(gate)
+        result = queued.apply_queued()
+        np.testing.assert_array_equal(result.data.values, expected.data.values)
+        self.assertEqual([name for name, params in result.history], ['transform', 'gate'])
+        self.assertEqual(result.queue, [])
+
+    def test_iter_chunks_with_queued_spline_transform(self):
+        gate = ThresholdGate(1000, 'SSC-A', 'above')
+        queued = (self.fc_measurement.transform('hlog', channels=['FSC-A', 'SSC-A'], b=10, apply_now=False)
+                  .gate(gate, apply_now=False))
+        expected = self.fc_measurement.transform('hlog', channels=['FSC-A', 'SSC-A'], b=10).gate(gate).data
+        for chunk_size in [500, 3000]:
+            chunks = list(queued.iter_chunks(chunk_size))
+            np.testing.assert_array_equal(np.vstack([chunk.values for chunk in chunks]), expected.values)
+        self.assertEqual(queued.queue[0][1]['transform'], 'hlog')  # the queue itself is left as is